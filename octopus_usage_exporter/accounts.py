@@ -0,0 +1,36 @@
+import json
+import logging
+from pydantic import BaseModel
+
+
+class account(BaseModel):
+    account_number: str
+    api_key: str
+    gas: bool | None = None
+    electric: bool | None = None
+
+
+def load_accounts(path):
+    with open(path) as accounts_file:
+        data = json.load(accounts_file)
+    if isinstance(data, dict):
+        data = data.get("accounts", [])
+    accounts = [account(**entry) for entry in data]
+    logging.info("Loaded {} account(s) from {}".format(len(accounts), path))
+    return accounts
+
+
+def configured_accounts(settings):
+    if settings.accounts_file:
+        accounts = load_accounts(settings.accounts_file)
+    elif settings.account_number and settings.api_key:
+        accounts = [account(account_number=settings.account_number, api_key=settings.api_key)]
+    else:
+        raise Exception("Either ACCOUNTS_FILE or both ACCOUNT_NUMBER and API_KEY must be set.")
+
+    for entry in accounts:
+        if entry.gas is None:
+            entry.gas = settings.gas
+        if entry.electric is None:
+            entry.electric = settings.electric
+    return accounts
@@ -0,0 +1,141 @@
+import argparse
+import json
+import logging
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import timedelta
+
+from documents import get_request
+from gauge_definitions import GaugeDefinitions
+from utils import from_iso, from_iso_timestamp
+
+# Telemetry fields exported as history, under the same names as the live NG metrics
+BACKFILL_READINGS = {"consumption": "consumption", "demand": "demand"}
+
+
+def parse_time(value):
+    parsed = from_iso(value)
+    return parsed if parsed.tzinfo else parsed.astimezone()
+
+
+def telemetry_windows(start, end, chunk):
+    window_start = start
+    while window_start < end:
+        window_end = min(window_start + chunk, end)
+        yield window_start, window_end
+        window_start = window_end
+
+
+class checkpoint_store:
+    """One JSON file per completed (meter, window), so an interrupted backfill resumes where it stopped. A run with a
+    different chunk size, grouping or set of readings never picks up another run's windows."""
+
+    def __init__(self, directory, readings=BACKFILL_READINGS):
+        self.directory = directory
+        self.readings = "-".join(sorted(readings))
+        os.makedirs(directory, exist_ok=True)
+
+    def path(self, device_id, window_start, window_end, grouping):
+        return os.path.join(self.directory, "{}_{}_{}_{}_{}.json".format(
+            device_id, int(window_start.timestamp()), int(window_end.timestamp()), grouping, self.readings))
+
+    def load(self, device_id, window_start, window_end, grouping):
+        path = self.path(device_id, window_start, window_end, grouping)
+        if not os.path.exists(path):
+            return None
+        with open(path) as checkpoint:
+            return json.load(checkpoint)
+
+    def save(self, device_id, window_start, window_end, grouping, rows):
+        path = self.path(device_id, window_start, window_end, grouping)
+        with open(path + ".tmp", "w") as checkpoint:
+            json.dump(rows, checkpoint)
+        os.replace(path + ".tmp", path)
+
+
+def fetch_window(client, meter, window_start, window_end, grouping):
+    response = client.execute(get_request("SmartMeterTelemetryHistory"), variable_values={
+        "deviceId": meter.device_id,
+        "start": window_start.isoformat(),
+        "end": window_end.isoformat(),
+        "grouping": grouping
+    })
+    return response["smartMeterTelemetry"] or []
+
+
+def backfill(jobs, start, end, grouping, chunk, workers, checkpoints):
+    """jobs is a list of (api connection, meter). Returns {device_id: [telemetry rows]} across the whole range."""
+    history = {meter.device_id: [] for _, meter in jobs}
+    windows = list(telemetry_windows(start, end, chunk))
+    fetched = 0
+
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="backfill") as pool:
+        pending = {}
+        for client, meter in jobs:
+            for window_start, window_end in windows:
+                rows = checkpoints.load(meter.device_id, window_start, window_end, grouping)
+                if rows is not None:
+                    history[meter.device_id].extend(rows)
+                    continue
+                pending[pool.submit(fetch_window, client, meter, window_start, window_end, grouping)] = (meter, window_start, window_end, time.time())
+
+        for future in as_completed(pending):
+            meter, window_start, window_end, requested_at = pending[future]
+            rows = future.result()
+            # A window that had not ended when it was fetched is still filling in, so it is fetched again next run
+            if window_end.timestamp() <= requested_at:
+                checkpoints.save(meter.device_id, window_start, window_end, grouping, rows)
+            history[meter.device_id].extend(rows)
+            fetched += 1
+            logging.info("Backfilled {} - {} readings from {} ({}/{} windows)".format(meter.device_id, len(rows), window_start.isoformat(), fetched, len(pending)))
+
+    return history
+
+
+def write_openmetrics(output, meters, history):
+    # OpenMetrics wants each family contiguous and each series in timestamp order
+    for reading, field in BACKFILL_READINGS.items():
+        name = "oe_meter_{}".format(reading)
+        output.write("# HELP {} {}\n".format(name, GaugeDefinitions[reading].value))
+        output.write("# TYPE {} gauge\n".format(name))
+        for meter in meters:
+            labels = ",".join('{}="{}"'.format(key, value) for key, value in meter.return_labels().items())
+            samples = {}
+            for row in history.get(meter.device_id, []):
+                if row.get(field) is not None and row.get("readAt"):
+                    samples[from_iso_timestamp(row["readAt"])] = float(row[field])
+            for timestamp in sorted(samples):
+                output.write("{}{{{}}} {} {}\n".format(name, labels, samples[timestamp], timestamp))
+    output.write("# EOF\n")
+
+
+def main(argv=None):
+    import octopus_usage_exporter as exporter_module
+
+    parser = argparse.ArgumentParser(description="Backfill historical smart meter telemetry as OpenMetrics text.")
+    parser.add_argument("--start", required=True, help="ISO 8601 start of the range, e.g. 2026-01-01")
+    parser.add_argument("--end", required=True, help="ISO 8601 end of the range")
+    parser.add_argument("--grouping", default="THIRTY_MINUTES", help="TelemetryGrouping passed to the API, e.g. THIRTY_MINUTES or ONE_HOUR")
+    parser.add_argument("--chunk-hours", type=int, default=24, help="Hours of telemetry requested per call")
+    parser.add_argument("--workers", type=int, default=4, help="Requests in flight at once")
+    parser.add_argument("--checkpoint-dir", default="backfill-checkpoints", help="Where completed windows are kept for resuming")
+    parser.add_argument("--output", required=True, help="OpenMetrics file to write")
+    args = parser.parse_args(argv)
+
+    jobs = []
+    config = exporter_module.load_settings()
+    for account in exporter_module.configured_accounts(config):
+        api_connection = exporter_module.get_connection(config, account.api_key)
+        discovered = exporter_module.get_device_id(config, api_connection, account.gas, account.electric, account.account_number)
+        jobs.extend((api_connection, meter) for meter in discovered)
+
+    history = backfill(jobs, parse_time(args.start), parse_time(args.end), args.grouping,
+                       timedelta(hours=args.chunk_hours), args.workers, checkpoint_store(args.checkpoint_dir))
+    with open(args.output, "w") as output:
+        write_openmetrics(output, [meter for _, meter in jobs], history)
+    logging.info("Wrote backfill for {} meter(s) to {}".format(len(jobs), args.output))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,43 @@
+from documents import batch_request
+from tariff_cache import agreement_key
+
+
+def build_batch_query(meters, stale_agreements=()):
+    # Telemetry is aliased per meter, only agreements missing from the tariff cache are fetched alongside it
+    variables = {"d{}".format(index): meter.device_id for index, meter in enumerate(meters)}
+    for index, (_, agreement_id) in enumerate(stale_agreements):
+        variables["a{}".format(index)] = agreement_id
+    query = batch_request(len(meters), tuple(operation for operation, _ in stale_agreements))
+    return query, variables
+
+
+def failed_aliases(errors):
+    """Top level aliases named in the paths of GraphQL errors, or None if any error is not tied to one."""
+    aliases = set()
+    for error in errors or []:
+        path = error.get("path") if isinstance(error, dict) else None
+        if not path:
+            return None
+        aliases.add(path[0])
+    return aliases or None
+
+
+def failed_agreements(stale_agreements, failed):
+    return {key for index, key in enumerate(stale_agreements) if "a{}".format(index) in failed}
+
+
+def split_batch_response(meters, stale_agreements, response, agreements, failed=frozenset()):
+    # Rebuild the response shape of a single meter query, so readings parse exactly as before. Meters whose
+    # telemetry or agreement alias failed are left out, and failed agreements are fetched again next time.
+    skipped = failed_agreements(stale_agreements, failed)
+    for index, key in enumerate(stale_agreements):
+        if key not in skipped:
+            agreements[key] = response["a{}".format(index)]
+    return [
+        (meter, {
+            "smartMeterTelemetry": response["t{}".format(index)],
+            meter.agreement_field: agreements[agreement_key(meter)]
+        })
+        for index, meter in enumerate(meters)
+        if "t{}".format(index) not in failed and agreement_key(meter) not in skipped
+    ]
@@ -0,0 +1,41 @@
+"""Per request auth overhead, RS256 verification on every call versus the expiry recorded once per token.
+
+Run from the octopus_usage_exporter directory:
+
+    python -m benchmarks.bench_auth
+"""
+import time
+from unittest.mock import patch
+
+from jose import jwt
+
+import octopus_api_connection as api_module
+from benchmarks.standin_api import signing_key
+from benchmarks.timing import cpu_per_call
+
+
+def signing_keys():
+    private_pem, public_key = signing_key("bench")
+    return private_pem, {"keys": [public_key]}
+
+
+def main(iterations=2000):
+    private_pem, key_set = signing_keys()
+    token = jwt.encode({"exp": int(time.time()) + 3600}, private_pem, algorithm="RS256", headers={"kid": "bench"})
+
+    keys = api_module.jwks_cache()
+    keys.keys = {key["kid"]: key for key in key_set["keys"]}
+    keys.fetched_at = time.time()
+    with patch.object(api_module.octopus_api_connection, "get_jwt"):
+        connection = api_module.octopus_api_connection(api_key="bench", jwks=keys)
+    connection.headers["Authorization"] = "JWT {}".format(token)
+
+    verify_every_call = cpu_per_call(lambda: jwt.decode(token, key=key_set, algorithms=["RS256"]), iterations)
+    with patch.object(api_module.token_manager, "schedule_refresh"):
+        cached = cpu_per_call(connection.check_jwt, iterations * 100)
+    print("RS256 verify per request:     {:10.2f} us".format(verify_every_call * 1e6))
+    print("cached expiry per request:    {:10.2f} us".format(cached * 1e6))
+
+
+if __name__ == "__main__":
+    main()
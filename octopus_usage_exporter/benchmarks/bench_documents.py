@@ -0,0 +1,52 @@
+"""Per-poll CPU spent preparing GraphQL requests, parsing on every poll versus the cached document registry.
+
+Run from the octopus_usage_exporter directory:
+
+    python -m benchmarks.bench_documents
+"""
+from gql import gql
+from graphql import print_ast
+
+from documents import meter_request, bind
+from batch_query import build_batch_query
+from electric_meter import electric_meter
+from gas_meter import gas_meter
+from benchmarks.timing import cpu_per_call
+
+
+# The query text exactly as get_jql_query used to embed it and hand to gql() on every poll
+ELECTRIC_QUERY = print_ast(meter_request("ElectricityAgreement").document)
+VARIABLES = {"deviceId": "00-AA-11-2C-3B-4D-5E-99", "agreementId": 12345}
+
+
+def poll_before():
+    request = gql(ELECTRIC_QUERY)
+    request.variable_values = VARIABLES
+    return {"query": print_ast(request.document), "variables": request.variable_values}
+
+
+def poll_after():
+    return bind(electric_meter().get_jql_query(), VARIABLES).payload
+
+
+BATCH_METERS = [electric_meter(device_id="e-1", meter_type="electric", agreement=1),
+                gas_meter(device_id="g-1", meter_type="gas", agreement=2)]
+
+
+def batch_poll_after():
+    query, variables = build_batch_query(BATCH_METERS, [("ElectricityAgreement", 1)])
+    return bind(query, variables).payload
+
+
+def main(iterations=2000):
+    before = cpu_per_call(poll_before, iterations)
+    after = cpu_per_call(poll_after, iterations)
+    batch = cpu_per_call(batch_poll_after, iterations)
+    print("parse + print every poll:   {:8.1f} us/poll".format(before * 1e6))
+    print("cached document registry:   {:8.1f} us/poll".format(after * 1e6))
+    print("cached batch (2 meters):    {:8.1f} us/poll".format(batch * 1e6))
+    print("speedup:                    {:8.1f}x".format(before / after))
+
+
+if __name__ == "__main__":
+    main()
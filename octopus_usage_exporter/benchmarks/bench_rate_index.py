@@ -0,0 +1,53 @@
+"""Current half hourly unit rate lookup, linear scan with ISO parsing versus the bisect index.
+
+Run from the octopus_usage_exporter directory:
+
+    python -m benchmarks.bench_rate_index
+"""
+import time
+from datetime import datetime, timedelta
+
+from rate_index import unit_rate_index
+from utils import from_iso
+from benchmarks.timing import cpu_per_call
+
+DAYS = 7
+
+
+def make_rates(days):
+    start = datetime.now().astimezone().replace(hour=0, minute=0, second=0, microsecond=0) - timedelta(days=days - 1)
+    return [{"validFrom": (start + timedelta(minutes=30 * i)).isoformat(),
+             "validTo": (start + timedelta(minutes=30 * (i + 1))).isoformat(),
+             "value": 20.0 + i % 48} for i in range(48 * days)]
+
+
+def linear_scan(unit_rates):
+    # The lookup electricity_tariff_parser performed on every poll
+    now = datetime.now().astimezone()
+    for rate in unit_rates:
+        if from_iso(rate["validFrom"]) <= now and now < from_iso(rate["validTo"]):
+            return rate["value"]
+
+
+def next_slots(index, timestamp, count):
+    # The slice price_forecast exports as the curve
+    start = index.slot_at(timestamp)
+    return index.values[start:start + count]
+
+
+def main(iterations=500):
+    unit_rates = make_rates(DAYS)
+    index = unit_rate_index(unit_rates)
+    build = cpu_per_call(lambda: unit_rate_index(unit_rates), 50)
+    scan = cpu_per_call(lambda: linear_scan(unit_rates), iterations)
+    lookup = cpu_per_call(lambda: index.rate_at(time.time()), iterations * 100)
+    curve = cpu_per_call(lambda: next_slots(index, time.time(), 48), iterations * 100)
+    print("{} slots over {} days".format(len(unit_rates), DAYS))
+    print("linear scan per poll:        {:10.2f} us".format(scan * 1e6))
+    print("bisect lookup per poll:      {:10.2f} us".format(lookup * 1e6))
+    print("next 48 slots per poll:      {:10.2f} us".format(curve * 1e6))
+    print("index build (once per fetch): {:9.2f} us".format(build * 1e6))
+
+
+if __name__ == "__main__":
+    main()
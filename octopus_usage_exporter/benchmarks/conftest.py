@@ -0,0 +1,119 @@
+import gc
+import json
+import logging
+import os
+import tracemalloc
+from datetime import datetime, timedelta, timezone
+from unittest.mock import MagicMock
+
+import pytest
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+from octopus_usage_exporter import octopus_usage_exporter as exporter_module
+
+FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures", "api_responses.json")
+
+# Memory measured for each benchmark, printed after the timing table
+memory_results = []
+
+
+def max_rss_kb():
+    # ru_maxrss is kilobytes on Linux, bytes on macOS
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss if resource else None
+
+
+def load_responses():
+    """The recorded API responses, with the half hourly rates moved to start at today's midnight so now is covered."""
+    with open(FIXTURES) as fixtures:
+        responses = json.load(fixtures)
+    rates = responses["ElectricityAgreement"]["tariff"]["unitRates"]
+    shift = datetime.now(timezone.utc).replace(hour=0, minute=0, second=0, microsecond=0) - datetime.fromisoformat(rates[0]["validFrom"])
+    for rate in rates:
+        rate["validFrom"] = (datetime.fromisoformat(rate["validFrom"]) + shift).isoformat()
+        rate["validTo"] = (datetime.fromisoformat(rate["validTo"]) + shift).isoformat()
+    return responses
+
+
+class recorded_client:
+    """Answers batched reading queries from the recorded responses. advance() moves readAt on, as between live polls."""
+
+    def __init__(self, responses):
+        self.responses = responses
+        self.telemetry = responses["SmartMeterTelemetry"][0]
+        self.read_at = datetime.now(timezone.utc) - timedelta(minutes=5)
+        self.calls = 0
+
+    def advance(self, seconds=10):
+        self.read_at += timedelta(seconds=seconds)
+
+    def execute(self, query, variable_values=None):
+        self.calls += 1
+        row = dict(self.telemetry, readAt=self.read_at.isoformat())
+        fields = {field.alias.value: field.name.value for field in query.document.definitions[0].selection_set.selections}
+        response = {}
+        for name in variable_values:
+            if name.startswith("d"):
+                response["t" + name[1:]] = [row]
+            else:
+                response[name] = self.responses["ElectricityAgreement" if fields[name] == "electricityAgreement" else "GasAgreement"]
+        return response
+
+
+@pytest.fixture(scope="module")
+def responses():
+    return load_responses()
+
+
+@pytest.fixture
+def fleet(request):
+    """request.param electricity meters, each on its own agreement, removed with all their series afterwards."""
+    config = exporter_module.load_settings()
+    fleet = [exporter_module.build_meter(config, "electric", "00-00-00-00-{:08d}".format(index), 100000 + index, "Agile Octopus", "A-{}".format(index // 2))
+             for index in range(request.param)]
+    exporter_module.tariffs._entries.clear()
+    yield fleet
+    schedule = MagicMock()
+    for meter in fleet:
+        exporter_module.retire_meter(meter, schedule)
+    exporter_module.tariffs._entries.clear()
+    gc.collect()
+
+
+@pytest.fixture
+def measure_memory(request):
+    def measure(fn, meters):
+        """Runs fn twice under tracemalloc, returning the peak allocation in bytes of the first run, which creates every
+        series and buffer, and of the second, warm run."""
+        gc.collect()
+        # pytest's log capture keeps every record, which would be counted as retained by the code under test
+        root = logging.getLogger()
+        handlers, root.handlers = root.handlers, [logging.NullHandler()]
+        tracemalloc.start()
+        try:
+            fn()
+            _, first = tracemalloc.get_traced_memory()
+            gc.collect()
+            tracemalloc.reset_peak()
+            start, _ = tracemalloc.get_traced_memory()
+            fn()
+            retained, peak = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+            root.handlers = handlers
+        memory_results.append((request.node.name, meters, first, peak - start, retained - start, max_rss_kb()))
+        return first, peak - start
+    return measure
+
+
+def pytest_terminal_summary(terminalreporter):
+    if not memory_results:
+        return
+    terminalreporter.section("memory")
+    terminalreporter.write_line("{:<48} {:>8} {:>14} {:>14} {:>14} {:>12}".format("benchmark", "meters", "first pass", "peak alloc", "retained", "max rss"))
+    for name, meters, first, peak, retained, rss in memory_results:
+        terminalreporter.write_line("{:<48} {:>8} {:>12.1f}KB {:>12.1f}KB {:>12.1f}KB {:>10}KB".format(
+            name, meters, first / 1024, peak / 1024, retained / 1024, rss if rss is not None else "-"))
@@ -0,0 +1,112 @@
+"""Scrape latency under concurrent scrapers, for the single threaded HTTPServer, the threaded metrics server rendering
+every scrape and the threaded server serving a cached exposition, with and without a stalled (half open) client.
+
+Run from the octopus_usage_exporter directory:
+
+    python -m benchmarks.load_metrics_server --scrapers 8 --scrapes 50 --meters 200
+"""
+import argparse
+import socket
+import threading
+import time
+import urllib.request
+from http.server import HTTPServer
+
+from prometheus_client import CollectorRegistry, Gauge, MetricsHandler
+
+from metrics_server import metrics_server, exporter_handler, poller_health, exposition_cache
+
+READINGS = ("consumption", "demand", "tariff_unit_rate", "tariff_standing_charge", "tariff_expiry", "tariff_days_remaining")
+
+
+def populated_registry(meters):
+    registry = CollectorRegistry()
+    for reading in READINGS:
+        gauge = Gauge("oe_meter_{}".format(reading), reading, ["device_id", "meter_type"], registry=registry)
+        for index in range(meters):
+            gauge.labels(device_id="00-00-00-00-00-{:06d}".format(index), meter_type="electric").set(index)
+    return registry
+
+
+class single_threaded_server(HTTPServer):
+    handle_error = metrics_server.handle_error
+
+
+def start_server(kind, registry):
+    if kind in ("threaded", "cached"):
+        exposition = exposition_cache(registry) if kind == "cached" else None
+        handler = type("handler", (exporter_handler.bind(poller_health(), exposition),), {"registry": registry})
+        server = metrics_server(("127.0.0.1", 0), handler)
+    else:
+        server = single_threaded_server(("127.0.0.1", 0), MetricsHandler.factory(registry))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def scraper(url, scrapes, timeout, latencies, failures):
+    request = urllib.request.Request(url, headers={"Accept-Encoding": "gzip"})
+    for _ in range(scrapes):
+        start = time.perf_counter()
+        try:
+            urllib.request.urlopen(request, timeout=timeout).read()
+        except OSError:
+            # A blocked server would time out every remaining scrape the same way
+            failures.append(scrapes - len(latencies))
+            return
+        latencies.append(time.perf_counter() - start)
+
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def run(kind, registry, scrapers, scrapes, stalled, timeout):
+    server = start_server(kind, registry)
+    url = "http://127.0.0.1:{}/metrics".format(server.server_address[1])
+    stalled_sockets = []
+    for _ in range(stalled):
+        sock = socket.create_connection(server.server_address)
+        sock.sendall(b"GET /metrics HTTP/1.1\r\n")
+        stalled_sockets.append(sock)
+
+    results = [([], []) for _ in range(scrapers)]
+    threads = [threading.Thread(target=scraper, args=(url, scrapes, timeout, latencies, failures)) for latencies, failures in results]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+
+    for sock in stalled_sockets:
+        sock.close()
+    server.shutdown()
+    server.server_close()
+
+    latencies = [latency for result in results for latency in result[0]]
+    failed = sum(sum(result[1]) for result in results)
+    if latencies:
+        print("{:9} stalled={} scrapes={:5} failed={:5} p50={:7.1f} ms p99={:7.1f} ms max={:7.1f} ms wall={:5.1f} s".format(
+            kind, stalled, len(latencies), failed, percentile(latencies, 0.5) * 1e3, percentile(latencies, 0.99) * 1e3,
+            max(latencies) * 1e3, elapsed))
+    else:
+        print("{:9} stalled={} scrapes={:5} failed={:5} every scrape timed out after {} s".format(kind, stalled, 0, failed, timeout))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--scrapers", type=int, default=8, help="Concurrent scraping clients")
+    parser.add_argument("--scrapes", type=int, default=50, help="Scrapes per client")
+    parser.add_argument("--meters", type=int, default=200, help="Meters exported, six series each")
+    parser.add_argument("--timeout", type=float, default=2.0, help="Scrape timeout in seconds")
+    args = parser.parse_args(argv)
+
+    registry = populated_registry(args.meters)
+    for kind in ("single", "threaded", "cached"):
+        for stalled in (0, 1):
+            run(kind, registry, args.scrapers, args.scrapes, stalled, args.timeout)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,171 @@
+"""Soak test of the exporter against the local stand-in API. The real octopus_api_connection, discovery and read_meters
+loop poll thousands of synthetic meters for --duration seconds while the stand-in injects latency and errors, and
+throughput, retry amplification and memory growth are reported every --report-every seconds.
+
+Run from the octopus_usage_exporter directory:
+
+    python -m benchmarks.soak --accounts 2000 --interval 60 --duration 14400 --server-error-rate 0.02 --rate-limit-rate 0.01
+
+The stand-in runs in this process unless --api points at one started with python -m benchmarks.standin_api, which
+keeps its memory out of the RSS reported for the exporter.
+"""
+import argparse
+import gc
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+import tracemalloc
+import urllib.request
+
+from prometheus_client import REGISTRY
+
+import octopus_usage_exporter as exporter_module
+from benchmarks.standin_api import GRAPHQL_PATH, JWKS_PATH, STATS_PATH, add_fault_arguments, faults_from, start, write_accounts_file
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+
+def rss_bytes():
+    # Current RSS where /proc is available, otherwise the peak so far
+    try:
+        with open("/proc/self/statm") as statm:
+            return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024 if resource else 0
+
+
+def api_stats(api):
+    with urllib.request.urlopen(api + STATS_PATH, timeout=10) as response:
+        return json.load(response)
+
+
+def client_errors():
+    return {kind: REGISTRY.get_sample_value("oe_api_errors_total", {"kind": kind}) or 0
+            for kind in ("rate_limit", "auth", "permanent", "transient")}
+
+
+def slope_per_hour(samples):
+    """Least squares growth per hour of (elapsed seconds, value) samples."""
+    if len(samples) < 2:
+        return 0.0
+    mean_t = sum(t for t, _ in samples) / len(samples)
+    mean_v = sum(v for _, v in samples) / len(samples)
+    spread = sum((t - mean_t) ** 2 for t, _ in samples)
+    return sum((t - mean_t) * (v - mean_v) for t, v in samples) / spread * 3600 if spread else 0.0
+
+
+class soak_report:
+    """Turns successive stand-in stats and process samples into report lines and a final summary."""
+
+    def __init__(self, warmup):
+        self.warmup = warmup
+        self.start = time.monotonic()
+        self.previous = (self.start, {})
+        self.rss = []
+        self.objects = []
+
+    def sample(self, stats):
+        now = time.monotonic()
+        elapsed = now - self.start
+        previous_time, previous = self.previous
+        self.previous = (now, stats)
+        window = {key: stats.get(key, 0) - previous.get(key, 0) for key in ("requests", "succeeded", "field:smartMeterTelemetry")}
+        rss = rss_bytes()
+        objects = len(gc.get_objects())
+        if elapsed >= self.warmup:
+            self.rss.append((elapsed, rss))
+            self.objects.append((elapsed, objects))
+        with exporter_module.meters_lock:
+            meters = len(exporter_module.meters)
+        errors = client_errors()
+        print("{:7.0f}s meters={:6} readings/s={:8.1f} requests/s={:6.1f} amplification={:5.2f} rate_limited={:6} "
+              "5xx={:6} auth={:4} tokens={:3} rss={:7.1f}MB objects={:8}".format(
+                  elapsed, meters, window["field:smartMeterTelemetry"] / (now - previous_time),
+                  window["requests"] / (now - previous_time), amplification(window), int(errors["rate_limit"]),
+                  stats.get("server_errors", 0), int(errors["auth"]), stats.get("field:obtainKrakenToken", 0),
+                  rss / 2 ** 20, objects), flush=True)
+
+    def summary(self, stats):
+        elapsed = time.monotonic() - self.start
+        print()
+        print("Ran {:.0f}s against {} accounts".format(elapsed, stats.get("accounts")))
+        print("Readings:           {} ({:.1f}/s)".format(stats.get("field:smartMeterTelemetry", 0), stats.get("field:smartMeterTelemetry", 0) / elapsed))
+        print("Requests:           {} sent, {} succeeded, {} rate limited, {} server errors, {} token rejections".format(
+            stats.get("requests", 0), stats.get("succeeded", 0), stats.get("rate_limited", 0), stats.get("server_errors", 0),
+            stats.get("auth_errors", 0)))
+        print("Retry amplification: {:.3f} requests per successful request".format(amplification(stats)))
+        print("Tokens issued:      {}, key set fetched {} time(s)".format(stats.get("field:obtainKrakenToken", 0), stats.get("jwks", 0)))
+        if self.rss:
+            print("RSS after warmup:   {:.1f}MB to {:.1f}MB, {:+.2f}MB/hour".format(
+                self.rss[0][1] / 2 ** 20, self.rss[-1][1] / 2 ** 20, slope_per_hour(self.rss) / 2 ** 20))
+            print("Live objects:       {} to {}, {:+.0f}/hour".format(self.objects[0][1], self.objects[-1][1], slope_per_hour(self.objects)))
+        else:
+            print("No samples after the {}s warmup, run for longer to measure memory growth".format(self.warmup))
+
+
+def amplification(stats):
+    succeeded = stats.get("succeeded", 0)
+    return stats.get("requests", 0) / succeeded if succeeded else 0.0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--api", help="Base URL of a running stand-in, otherwise one is started in this process")
+    parser.add_argument("--accounts", type=int, default=1000, help="Accounts to poll, each with an electricity and a gas meter")
+    parser.add_argument("--no-gas", action="store_true", help="Only poll electricity meters")
+    parser.add_argument("--duration", type=float, default=3600, help="Seconds to run")
+    parser.add_argument("--warmup", type=float, default=300, help="Seconds before memory samples count, covering discovery and first polls")
+    parser.add_argument("--report-every", type=float, default=60, help="Seconds between report lines")
+    parser.add_argument("--interval", type=int, default=60, help="Electricity polling interval in seconds")
+    parser.add_argument("--workers", type=int, default=8)
+    parser.add_argument("--batch-size", type=int, default=25)
+    parser.add_argument("--rate-limit", type=float, default=50.0, help="Exporter RATE_LIMIT in requests per second")
+    parser.add_argument("--rate-burst", type=int, default=50)
+    parser.add_argument("--async-transport", action="store_true")
+    parser.add_argument("--prom-port", type=int, default=0, help="Port for the exporter's /metrics, 0 for any free port")
+    parser.add_argument("--tracemalloc", action="store_true", help="Print the largest allocation growth after warmup at the end")
+    parser.add_argument("--log-level", default="WARNING")
+    add_fault_arguments(parser)
+    args = parser.parse_args(argv)
+
+    logging.getLogger().setLevel(args.log_level)
+    if args.api:
+        api = args.api.rstrip("/")
+    else:
+        server = start(accounts=args.accounts, faults=faults_from(args), token_ttl=args.token_ttl, seed=args.seed)
+        api = server.url
+
+    accounts_file = os.path.join(tempfile.mkdtemp(prefix="oe-soak-"), "accounts.json")
+    write_accounts_file(accounts_file, args.accounts, gas=not args.no_gas)
+    config = exporter_module.Settings(
+        api_url=api + GRAPHQL_PATH, jwks_url=api + JWKS_PATH, accounts_file=accounts_file, interval=args.interval,
+        workers=args.workers, batch_size=args.batch_size, rate_limit=args.rate_limit, rate_burst=args.rate_burst,
+        async_transport=args.async_transport, prom_port=args.prom_port, ng_metrics=True, rediscovery_interval=0,
+        config_file=None, state_file=None)
+    threading.Thread(target=exporter_module.exporter, args=(config,), name="exporter", daemon=True).start()
+
+    report = soak_report(args.warmup)
+    deadline = report.start + args.duration
+    tracing = False
+    while time.monotonic() < deadline:
+        time.sleep(max(0.0, min(args.report_every, deadline - time.monotonic())))
+        report.sample(api_stats(api))
+        if args.tracemalloc and not tracing and time.monotonic() - report.start >= args.warmup:
+            tracemalloc.start(10)
+            baseline, tracing = tracemalloc.take_snapshot(), True
+    report.summary(api_stats(api))
+    if tracing:
+        print()
+        print("Largest allocation growth since warmup:")
+        for stat in tracemalloc.take_snapshot().compare_to(baseline, "traceback")[:10]:
+            print("{:+10.1f}KB {:8} blocks  {}".format(stat.size_diff / 1024, stat.count_diff, stat.traceback[-1]))
+
+
+if __name__ == "__main__":
+    main()
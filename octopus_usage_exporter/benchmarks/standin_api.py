@@ -0,0 +1,374 @@
+"""A local stand-in for the Octopus GraphQL API and its JWKS, answering the exporter's token, account discovery,
+telemetry and agreement queries for thousands of synthetic accounts, with configurable latency, rate limit errors
+and server errors.
+
+Run from the octopus_usage_exporter directory, then point an exporter at it:
+
+    python -m benchmarks.standin_api --accounts 2000 --port 8081 --accounts-file soak_accounts.json
+    API_URL=http://127.0.0.1:8081/v1/graphql/ JWKS_URL=http://127.0.0.1:8081/jwks.json \\
+        ACCOUNTS_FILE=soak_accounts.json ELECTRIC=true GAS=true python octopus_usage_exporter.py
+
+Account n has one electricity meter on a half hourly tariff and one gas meter. GET /stats returns request counts.
+"""
+import argparse
+import json
+import math
+import random
+import secrets
+import threading
+import time
+import zlib
+from collections import Counter
+from datetime import datetime, timedelta, timezone
+from functools import lru_cache
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import rsa
+from graphql import ObjectValueNode, VariableNode, parse
+from jose import jwt
+from jose.utils import long_to_base64
+
+GRAPHQL_PATH = "/v1/graphql/"
+JWKS_PATH = "/jwks.json"
+STATS_PATH = "/stats"
+
+# Kraken error codes, as classified by octopus_api_connection
+RATE_LIMITED = {"message": "Too many requests.", "extensions": {"errorCode": "KT-CT-1199"}}
+TOKEN_REJECTED = {"message": "Invalid or expired token.", "extensions": {"errorCode": "KT-CT-1124"}}
+
+
+def account_number(index):
+    return "A-{:08d}".format(index)
+
+
+def account_index(number):
+    try:
+        return int(number[2:]) if number.startswith("A-") else None
+    except ValueError:
+        return None
+
+
+def device_id(index, fuel):
+    digits = "{:08X}".format(index)
+    return "-".join(["E0" if fuel == "electric" else "60", "00", "00", "00"] + [digits[i:i + 2] for i in range(0, 8, 2)])
+
+
+@lru_cache(maxsize=None)
+def rsa_keys():
+    # rsa is pure Python and slow to generate keys, so every stand-in in a process shares one pair
+    return rsa.newkeys(2048)
+
+
+def signing_key(kid):
+    """An RS256 private key as PEM and its public half as a JWK. Uses rsa, which python-jose already depends on, so no
+    crypto backend has to be installed."""
+    public_key, private_key = rsa_keys()
+    return private_key.save_pkcs1(), {"kty": "RSA", "alg": "RS256", "use": "sig", "kid": kid,
+                                      "n": long_to_base64(public_key.n).decode(), "e": long_to_base64(public_key.e).decode()}
+
+
+def write_accounts_file(path, accounts, api_key="sk_standin", gas=True, electric=True):
+    """An ACCOUNTS_FILE listing the first accounts synthetic accounts, all behind one API key."""
+    with open(path, "w") as accounts_file:
+        json.dump({"accounts": [{"account_number": account_number(index), "api_key": api_key, "gas": gas, "electric": electric}
+                                for index in range(accounts)]}, accounts_file)
+
+
+class fault_profile:
+    """What the stand-in does to requests. Rates are the chance of each request failing that way, max_rate caps the
+    requests answered per second before the rest are rate limited, as the real API does."""
+
+    def __init__(self, latency=0.0, jitter=0.0, rate_limit_rate=0.0, server_error_rate=0.0, max_rate=0.0,
+                 rate_limit_status=200):
+        self.latency = latency
+        self.jitter = jitter
+        self.rate_limit_rate = rate_limit_rate
+        self.server_error_rate = server_error_rate
+        self.max_rate = max_rate
+        # 200 answers with a KT-CT-1199 GraphQL error, 429 with an HTTP error
+        self.rate_limit_status = rate_limit_status
+
+
+@lru_cache(maxsize=256)
+def parse_fields(query):
+    """(response key, field name, argument nodes) for each root field of a query, parsed once per distinct query."""
+    operation = parse(query).definitions[0]
+    return [((field.alias or field.name).value, field.name.value, {argument.name.value: argument.value for argument in field.arguments})
+            for field in operation.selection_set.selections]
+
+
+def argument_value(node, variables):
+    if isinstance(node, VariableNode):
+        return variables.get(node.name.value)
+    if isinstance(node, ObjectValueNode):
+        return {field.name.value: argument_value(field.value, variables) for field in node.fields}
+    return getattr(node, "value", None)
+
+
+@lru_cache(maxsize=4)
+def half_hourly_rates(day):
+    """Unit rates for day and the day after, so the cached agreement always covers now."""
+    start = datetime.combine(day, datetime.min.time(), timezone.utc)
+    return [{"validFrom": (start + timedelta(minutes=30 * slot)).isoformat(),
+             "validTo": (start + timedelta(minutes=30 * (slot + 1))).isoformat(),
+             "value": round(20.0 + 10.0 * math.sin(slot * math.pi / 24), 3)} for slot in range(96)]
+
+
+class standin_api(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 128
+
+    def __init__(self, address, accounts=1000, faults=None, token_ttl=3600, seed=None):
+        super().__init__(address, standin_handler)
+        self.accounts = accounts
+        self.faults = faults or fault_profile()
+        self.token_ttl = token_ttl
+        self.started = time.time()
+        self.random = random.Random(seed)
+        self.kid = secrets.token_hex(8)
+        self.private_pem, public_key = signing_key(self.kid)
+        self.key_set = {"keys": [public_key]}
+        self.counts = Counter()
+        self.tokens = {}
+        self._lock = threading.Lock()
+        self._window = (0, 0)
+
+    @property
+    def url(self):
+        return "http://{}:{}".format(*self.server_address[:2])
+
+    def count(self, *keys):
+        with self._lock:
+            self.counts.update(keys)
+
+    def stats(self):
+        with self._lock:
+            return dict(self.counts, uptime=time.time() - self.started, accounts=self.accounts)
+
+    def fault(self):
+        """None, "rate_limit" or "server_error" for the request being answered."""
+        faults = self.faults
+        if faults.max_rate:
+            second = int(time.monotonic())
+            with self._lock:
+                window, answered = self._window
+                answered = answered + 1 if window == second else 1
+                self._window = (second, answered)
+            if answered > faults.max_rate:
+                return "rate_limit"
+        draw = self.random.random()
+        if draw < faults.rate_limit_rate:
+            return "rate_limit"
+        if draw < faults.rate_limit_rate + faults.server_error_rate:
+            return "server_error"
+        return None
+
+    def issue_token(self):
+        expiry = int(time.time()) + self.token_ttl
+        token = jwt.encode({"sub": "standin", "exp": expiry, "iat": int(time.time())}, self.private_pem, algorithm="RS256", headers={"kid": self.kid})
+        with self._lock:
+            now = time.time()
+            self.tokens = {issued: exp for issued, exp in self.tokens.items() if exp > now}
+            self.tokens[token] = expiry
+        return token
+
+    def authorised(self, authorization):
+        token = authorization.split(" ")[-1] if authorization else None
+        with self._lock:
+            return self.tokens.get(token, 0) > time.time()
+
+    def account(self, number):
+        index = account_index(number)
+        if index is None or index >= self.accounts:
+            return None
+        registers = [{"id": str(index), "name": "Standard", "unitRateType": "STANDARD", "identifier": "1"}]
+        return {
+            "id": str(index),
+            "electricityAgreements": [{
+                "id": 1000000 + index,
+                "tariff": {"displayName": "Agile Octopus"},
+                "meterPoint": {"id": str(index), "meters": [{
+                    "smartImportElectricityMeter": {"id": str(index), "deviceId": device_id(index, "electric")},
+                    "smartExportElectricityMeter": None,
+                    "registers": registers
+                }]}
+            }],
+            "gasAgreements": [{
+                "id": 2000000 + index,
+                "tariff": {"displayName": "Flexible Octopus"},
+                "meterPoint": {"id": str(index), "meters": [{
+                    "id": str(index),
+                    "smartGasMeter": {"id": str(index), "deviceId": device_id(index, "gas")},
+                    "registers": registers
+                }]}
+            }]
+        }
+
+    def telemetry(self, device):
+        # A reading every 10 seconds from a meter using a steady 300 to 1000 watts
+        read_at = int(time.time()) // 10 * 10
+        watts = 300 + zlib.crc32(device.encode()) % 700
+        return [{
+            "readAt": datetime.fromtimestamp(read_at, timezone.utc).isoformat(),
+            "consumption": round(watts * (read_at - 1.7e9) / 3600, 3),
+            "demand": float(watts),
+            "consumptionDelta": round(watts / 360, 3),
+            "costDelta": round(watts / 360 * 0.00025, 5)
+        }]
+
+    def electricity_agreement(self, agreement_id):
+        today = datetime.now(timezone.utc).date()
+        return {
+            "id": agreement_id, "isRevoked": False,
+            "validTo": (datetime.combine(today, datetime.min.time(), timezone.utc) + timedelta(days=365)).isoformat(),
+            "agreedFrom": "2025-01-01T00:00:00+00:00",
+            "tariff": {"id": "E-1R-AGILE-24-10-01-C", "displayName": "Agile Octopus", "standingCharge": 49.98336,
+                       "isExport": False, "unitRates": half_hourly_rates(today)}
+        }
+
+    def gas_agreement(self, agreement_id):
+        today = datetime.now(timezone.utc).date()
+        return {
+            "id": agreement_id, "isRevoked": False, "validFrom": "2025-01-01T00:00:00+00:00",
+            "validTo": (datetime.combine(today, datetime.min.time(), timezone.utc) + timedelta(days=365)).isoformat(),
+            "tariff": {"id": "G-1R-VAR-22-11-01-C", "displayName": "Flexible Octopus", "fullName": "Flexible Octopus",
+                       "standingCharge": 31.381455, "isExport": False, "unitRate": 6.134415}
+        }
+
+    def resolve(self, name, arguments):
+        if name == "obtainKrakenToken":
+            return {"token": self.issue_token()}
+        if name == "account":
+            return self.account(arguments.get("accountNumber") or "")
+        if name == "smartMeterTelemetry":
+            return self.telemetry(arguments.get("deviceId") or "")
+        if name == "electricityAgreement":
+            return self.electricity_agreement(arguments.get("id"))
+        if name == "gasAgreement":
+            return self.gas_agreement(arguments.get("id"))
+        raise KeyError(name)
+
+    def execute(self, payload, authorization):
+        """(status, body) answering one GraphQL request."""
+        try:
+            fields = parse_fields(payload["query"])
+        except Exception as e:
+            self.count("rejected")
+            return 400, {"errors": [{"message": "Invalid query: {}".format(e)}]}
+        variables = payload.get("variables") or {}
+        if any(name != "obtainKrakenToken" for _, name, _ in fields) and not self.authorised(authorization):
+            self.count("auth_errors")
+            return 200, {"data": None, "errors": [TOKEN_REJECTED]}
+        data = {}
+        for key, name, arguments in fields:
+            try:
+                data[key] = self.resolve(name, {argument: argument_value(node, variables) for argument, node in arguments.items()})
+            except KeyError:
+                self.count("rejected")
+                return 200, {"data": None, "errors": [{"message": "Cannot query field '{}'.".format(name)}]}
+            self.count("field:" + name)
+        self.count("succeeded")
+        return 200, {"data": data}
+
+
+class standin_handler(BaseHTTPRequestHandler):
+    # Keep-alive, as the exporter's pooled sessions expect
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_json(self, status, body):
+        encoded = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(encoded)))
+        self.end_headers()
+        self.wfile.write(encoded)
+
+    def do_GET(self):
+        if self.path == JWKS_PATH:
+            self.server.count("jwks")
+            self.send_json(200, self.server.key_set)
+        elif self.path == STATS_PATH:
+            self.send_json(200, self.server.stats())
+        else:
+            self.send_json(404, {"error": "not found"})
+
+    def do_POST(self):
+        payload = self.rfile.read(int(self.headers.get("Content-Length") or 0))
+        if self.path != GRAPHQL_PATH:
+            self.send_json(404, {"error": "not found"})
+            return
+        server = self.server
+        server.count("requests")
+        faults = server.faults
+        if faults.latency or faults.jitter:
+            time.sleep(faults.latency + server.random.uniform(0, faults.jitter))
+        fault = server.fault()
+        if fault == "rate_limit":
+            server.count("rate_limited")
+            if faults.rate_limit_status == 429:
+                self.send_json(429, {"errors": [RATE_LIMITED]})
+            else:
+                self.send_json(200, {"data": None, "errors": [RATE_LIMITED]})
+            return
+        if fault == "server_error":
+            server.count("server_errors")
+            self.send_json(server.random.choice((500, 502, 503)), {"error": "injected server error"})
+            return
+        try:
+            body = json.loads(payload)
+        except ValueError:
+            server.count("rejected")
+            self.send_json(400, {"errors": [{"message": "Request body is not JSON"}]})
+            return
+        self.send_json(*server.execute(body, self.headers.get("Authorization")))
+
+
+def start(address=("127.0.0.1", 0), **kwargs):
+    """A stand-in serving on its own thread. Port 0 picks a free port, see .url."""
+    server = standin_api(address, **kwargs)
+    threading.Thread(target=server.serve_forever, name="standin-api", daemon=True).start()
+    return server
+
+
+def add_fault_arguments(parser):
+    parser.add_argument("--latency", type=float, default=0.05, help="Seconds added to every API response")
+    parser.add_argument("--jitter", type=float, default=0.05, help="Up to this many further seconds, at random")
+    parser.add_argument("--rate-limit-rate", type=float, default=0.0, help="Fraction of requests answered as rate limited")
+    parser.add_argument("--rate-limit-status", type=int, choices=(200, 429), default=200,
+                        help="200 for a KT-CT-1199 GraphQL error, as the API sends, or 429")
+    parser.add_argument("--server-error-rate", type=float, default=0.0, help="Fraction of requests answered with a 5xx")
+    parser.add_argument("--max-rate", type=float, default=0.0, help="Requests answered per second before the rest are rate limited, 0 for no limit")
+    parser.add_argument("--token-ttl", type=int, default=3600, help="Seconds before issued tokens expire")
+    parser.add_argument("--seed", type=int, default=None, help="Seed for latency and fault injection")
+
+
+def faults_from(args):
+    return fault_profile(args.latency, args.jitter, args.rate_limit_rate, args.server_error_rate, args.max_rate, args.rate_limit_status)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8081)
+    parser.add_argument("--accounts", type=int, default=1000, help="Synthetic accounts, each with an electricity and a gas meter")
+    parser.add_argument("--accounts-file", help="Also write an ACCOUNTS_FILE listing every account")
+    add_fault_arguments(parser)
+    args = parser.parse_args(argv)
+
+    if args.accounts_file:
+        write_accounts_file(args.accounts_file, args.accounts)
+    server = standin_api((args.host, args.port), args.accounts, faults_from(args), args.token_ttl, args.seed)
+    print("Serving {} accounts at {}{} with keys at {}{}".format(args.accounts, server.url, GRAPHQL_PATH, server.url, JWKS_PATH))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()
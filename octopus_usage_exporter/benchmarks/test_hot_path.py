@@ -0,0 +1,149 @@
+"""The poll, parse, export and scrape hot path at 1, 100 and 10,000 meters, driven by recorded API responses.
+
+Run from the octopus_usage_exporter directory with the bench extra installed:
+
+    python -m pytest benchmarks --benchmark-autosave
+    python -m pytest benchmarks --benchmark-compare --benchmark-compare-fail=mean:15%
+
+The first run saves a baseline, the second fails if any mean regressed by more than 15%. Peak allocations of a warm pass
+are also held to the budgets below, which need no baseline and so gate every run.
+"""
+from types import SimpleNamespace
+
+import pytest
+
+pytest.importorskip("pytest_benchmark")
+
+from octopus_usage_exporter import octopus_usage_exporter as exporter_module
+from octopus_usage_exporter.metrics_server import exposition_cache
+from octopus_usage_exporter.tariff_cache import agreement_key, build_rate_index
+
+from .conftest import recorded_client
+
+SIZES = [1, 100, 10_000]
+BATCH_SIZE = 25
+
+# Peak bytes allocated for one pass, a fixed allowance plus so much per meter, with headroom over the current code.
+# The first pass also creates each meter's series and history, the warm pass should allocate little beyond its output.
+BASE_ALLOCATION = 512 * 1024
+FIRST_PASS_BUDGET = {
+    "parse": 1024,
+    "update": 12 * 1024,
+    "cycle": 12 * 1024,
+    "scrape": 8 * 1024,
+}
+ALLOCATION_BUDGET = {
+    "parse": 1024,
+    "update": 1024,
+    "cycle": 1024,
+    "scrape": 8 * 1024,
+}
+
+NG = SimpleNamespace(ng_metrics=True, tariff_forecast=False)
+LEGACY = SimpleNamespace(ng_metrics=False, tariff_forecast=False)
+
+
+def batches(meters):
+    for start in range(0, len(meters), BATCH_SIZE):
+        yield meters[start:start + BATCH_SIZE]
+
+
+def check_budget(stage, peaks, meters):
+    first, peak = peaks
+    budget = BASE_ALLOCATION + FIRST_PASS_BUDGET[stage] * meters
+    assert first <= budget, "{} first pass peaked at {} bytes for {} meters, budget {}".format(stage, first, meters, budget)
+    budget = BASE_ALLOCATION + ALLOCATION_BUDGET[stage] * meters
+    assert peak <= budget, "{} peaked at {} bytes for {} meters, budget {}".format(stage, peak, meters, budget)
+
+
+def polled(fleet, responses):
+    client = recorded_client(responses)
+    readings = []
+    for batch in batches(fleet):
+        readings.extend(exporter_module.get_energy_readings(client, batch))
+    return readings
+
+
+@pytest.mark.parametrize("fleet", SIZES, indirect=True)
+def test_parse_energy_reading(benchmark, measure_memory, fleet, responses):
+    telemetry = {"smartMeterTelemetry": responses["SmartMeterTelemetry"], "electricityAgreement": responses["ElectricityAgreement"]}
+    rate_index = build_rate_index(responses["ElectricityAgreement"])
+
+    def parse():
+        for meter in fleet:
+            exporter_module.parse_energy_reading(meter, telemetry, rate_index)
+
+    check_budget("parse", measure_memory(parse, len(fleet)), len(fleet))
+    benchmark(parse)
+
+
+@pytest.mark.parametrize("fleet", SIZES, indirect=True)
+def test_electricity_tariff_parser(benchmark, fleet, responses):
+    agreement = responses["ElectricityAgreement"]
+    rate_index = build_rate_index(agreement)
+    benchmark(lambda: [exporter_module.electricity_tariff_parser(agreement, rate_index) for _ in fleet])
+
+
+@pytest.mark.parametrize("config", [NG, LEGACY], ids=["ng", "legacy"])
+@pytest.mark.parametrize("fleet", SIZES, indirect=True)
+def test_update_readings(benchmark, measure_memory, fleet, responses, config):
+    readings = polled(fleet, responses)
+    step = iter(range(1, 10 ** 9))
+
+    def update():
+        # A new readAt each round, so every reading is exported rather than skipped as unchanged
+        offset = next(step)
+        for meter, values in readings:
+            exporter_module.update_readings(config, dict(values, read_at=values["read_at"] + offset), meter)
+
+    check_budget("update", measure_memory(update, len(fleet)), len(fleet))
+    benchmark(update)
+
+
+@pytest.mark.parametrize("fleet", SIZES, indirect=True)
+def test_update_gauge(benchmark, measure_memory, fleet):
+    """The legacy per meter gauges behind update_readings when NG_METRICS is off."""
+    def update():
+        for meter in fleet:
+            exporter_module.update_gauge("consumption", 1234.5, meter)
+            exporter_module.update_gauge("demand", 321.0, meter)
+
+    check_budget("update", measure_memory(update, len(fleet)), len(fleet))
+    benchmark(update)
+
+
+@pytest.mark.parametrize("fleet", SIZES, indirect=True)
+def test_poll_cycle(benchmark, measure_memory, fleet, responses):
+    """Batched request, parse and export for every meter, with agreements already cached as between tariff fetches."""
+    client = recorded_client(responses)
+    for batch in batches(fleet):
+        exporter_module.get_energy_readings(client, batch)
+    assert all(exporter_module.tariffs.get(agreement_key(meter)) is not None for meter in fleet)
+
+    def cycle():
+        client.advance()
+        for batch in batches(fleet):
+            for meter, readings in exporter_module.get_energy_readings(client, batch):
+                exporter_module.update_readings(NG, readings, meter)
+
+    check_budget("cycle", measure_memory(cycle, len(fleet)), len(fleet))
+    benchmark(cycle)
+
+
+@pytest.mark.parametrize("cached", [False, True], ids=["render", "cached"])
+@pytest.mark.parametrize("fleet", SIZES, indirect=True)
+def test_scrape(benchmark, measure_memory, fleet, responses, cached):
+    for meter, readings in polled(fleet, responses):
+        exporter_module.update_readings(NG, readings, meter)
+    exposition = exposition_cache()
+
+    def scrape():
+        if not cached:
+            exposition.invalidate()
+        _, rendered = exposition.get("text/plain")
+        return rendered
+
+    exposition.get("text/plain")
+    check_budget("scrape", measure_memory(scrape, len(fleet)), len(fleet))
+    rendered = benchmark(scrape)
+    assert rendered.plain.count(b"oe_meter_consumption{") >= len(fleet)
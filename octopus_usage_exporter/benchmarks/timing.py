@@ -0,0 +1,10 @@
+"""CPU timing shared by the micro benchmarks."""
+import time
+
+
+def cpu_per_call(fn, iterations):
+    fn()
+    start = time.process_time()
+    for _ in range(iterations):
+        fn()
+    return (time.process_time() - start) / iterations
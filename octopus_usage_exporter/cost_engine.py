@@ -0,0 +1,83 @@
+import logging
+import threading
+from datetime import datetime, timedelta, timezone
+from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
+from metrics import meter_spend_rate, meter_cost_today, meter_cost_projected
+from reading_collector import READ_AT
+
+
+def billing_zone(name="Europe/London"):
+    # Tariffs are billed per local day, slim images without tzdata fall back to UTC days
+    try:
+        return ZoneInfo(name)
+    except ZoneInfoNotFoundError:
+        logging.warning("Time zone {} not found, days will start at midnight UTC".format(name))
+        return timezone.utc
+
+
+def day_bounds(timestamp, zone):
+    """Epoch seconds of the start and end of the local day containing timestamp, 23 or 25 hours apart over DST."""
+    start = datetime.fromtimestamp(timestamp, zone).replace(hour=0, minute=0, second=0, microsecond=0)
+    # Aware arithmetic is wall clock, so this is the next local midnight
+    return start.timestamp(), (start + timedelta(days=1)).timestamp()
+
+
+class meter_day:
+    __slots__ = ("start", "end", "cost_at_start")
+
+    def __init__(self, start, end, cost_at_start):
+        self.start = start
+        self.end = end
+        self.cost_at_start = cost_at_start
+
+
+class cost_engine:
+    """Spend derived from each poll's readings and the meter's usage history: the current rate in pence per hour,
+    the cost so far today including the standing charge, and the cost the day is on course for. The day's opening
+    total is looked up once per day, so every other poll is a handful of arithmetic."""
+
+    def __init__(self, usage, zone=None):
+        self.usage = usage
+        self.zone = zone or billing_zone()
+        self._days = {}
+        self._lock = threading.Lock()
+
+    def spend_rate(self, history, readings, unit_rate, read_at):
+        """Pence per hour, from demand in watts at the unit rate, or the last hour's cost where there is no demand."""
+        demand = readings.get("demand")
+        if demand is not None and unit_rate is not None:
+            return float(demand) / 1000 * float(unit_rate)
+        return history.ring.since(read_at - 3600)[1]
+
+    def update(self, meter, readings, rate_index=None):
+        read_at = readings.get(READ_AT)
+        if read_at is None:
+            return
+        unit_rate = rate_index.rate_at(read_at) if rate_index is not None else None
+        if unit_rate is None:
+            unit_rate = readings.get("tariff_unit_rate")
+        standing_charge = float(readings.get("tariff_standing_charge") or 0)
+        history = self.usage.history(meter)
+
+        key = (meter.device_id, meter.meter_type)
+        with self._lock:
+            day = self._days.get(key)
+            if day is None or not day.start <= read_at < day.end:
+                start, end = day_bounds(read_at, self.zone)
+                day = self._days[key] = meter_day(start, end, history.cost - history.ring.since(start)[1])
+
+        spend = self.spend_rate(history, readings, unit_rate, read_at)
+        today = history.cost - day.cost_at_start + standing_charge
+        labels = {"device_id": meter.device_id, "meter_type": meter.meter_type}
+        meter_spend_rate.labels(**labels).set(spend)
+        meter_cost_today.labels(**labels).set(today)
+        meter_cost_projected.labels(**labels).set(today + spend * max(0.0, day.end - read_at) / 3600)
+
+    def remove(self, meter):
+        with self._lock:
+            self._days.pop((meter.device_id, meter.meter_type), None)
+        for gauge in (meter_spend_rate, meter_cost_today, meter_cost_projected):
+            try:
+                gauge.remove(meter.device_id, meter.meter_type)
+            except KeyError:
+                pass
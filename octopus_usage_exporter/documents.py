@@ -0,0 +1,125 @@
+import os
+from functools import lru_cache
+from gql import GraphQLRequest
+from graphql import (
+    ArgumentNode,
+    DocumentNode,
+    FieldNode,
+    NamedTypeNode,
+    NameNode,
+    NonNullTypeNode,
+    OperationDefinitionNode,
+    OperationType,
+    SelectionSetNode,
+    VariableDefinitionNode,
+    VariableNode,
+    parse,
+    print_ast
+)
+
+QUERIES_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "queries.gql")
+
+
+class prepared_request(GraphQLRequest):
+    # GraphQLRequest re-prints the document into a query string on every payload, this keeps the printed copy
+    def __init__(self, document, query_string=None, variable_values=None):
+        super().__init__(document, variable_values=variable_values)
+        self.query_string = query_string if query_string is not None else print_ast(document)
+
+    def bind(self, variable_values):
+        return prepared_request(self.document, self.query_string, variable_values)
+
+    @property
+    def payload(self):
+        payload = {"query": self.query_string}
+        if self.variable_values:
+            payload["variables"] = self.variable_values
+        return payload
+
+
+def load_documents(path=QUERIES_PATH):
+    with open(path) as queries_file:
+        source = parse(queries_file.read())
+    return {
+        definition.name.value: prepared_request(DocumentNode(definitions=(definition,)))
+        for definition in source.definitions
+        if isinstance(definition, OperationDefinitionNode)
+    }
+
+
+# Parsed once at import, every poll reuses the same DocumentNode and printed query
+documents = load_documents()
+
+
+def get_request(name):
+    return documents[name]
+
+
+def get_document(name):
+    return documents[name].document
+
+
+def bind(query, variable_values=None):
+    if isinstance(query, prepared_request):
+        return query.bind(variable_values)
+    return GraphQLRequest(query, variable_values=variable_values)
+
+
+def operation_field(operation_name):
+    # The root field of a single field operation, e.g. smartMeterTelemetry in SmartMeterTelemetry
+    return get_document(operation_name).definitions[0].selection_set.selections[0]
+
+
+def field_node(field, alias, argument, variable):
+    return FieldNode(
+        alias=NameNode(value=alias) if alias else None,
+        name=field.name,
+        arguments=(ArgumentNode(name=NameNode(value=argument), value=VariableNode(name=NameNode(value=variable))),),
+        directives=(),
+        selection_set=field.selection_set
+    )
+
+
+def variable_definition(variable, type_name):
+    return VariableDefinitionNode(
+        variable=VariableNode(name=NameNode(value=variable)),
+        type=NonNullTypeNode(type=NamedTypeNode(name=NameNode(value=type_name))),
+        directives=()
+    )
+
+
+def query_request(name, definitions, fields):
+    operation = OperationDefinitionNode(
+        operation=OperationType.QUERY,
+        name=NameNode(value=name),
+        variable_definitions=tuple(definitions),
+        directives=(),
+        selection_set=SelectionSetNode(selections=tuple(fields))
+    )
+    return prepared_request(DocumentNode(definitions=(operation,)))
+
+
+@lru_cache(maxsize=8)
+def meter_request(agreement_operation):
+    """Telemetry and agreement for a single meter in one request."""
+    return query_request(
+        "TariffsandMeterReadings",
+        [variable_definition("deviceId", "String"), variable_definition("agreementId", "ID")],
+        [field_node(operation_field("SmartMeterTelemetry"), None, "deviceId", "deviceId"),
+         field_node(operation_field(agreement_operation), None, "id", "agreementId")]
+    )
+
+
+@lru_cache(maxsize=256)
+def batch_request(meter_count, agreement_operations=()):
+    """Telemetry for meter_count meters aliased t0..tN, plus agreements aliased a0..aN. Fields are lifted from the
+    parsed operations, so a batch is built without re-parsing and cached per shape."""
+    definitions = []
+    fields = []
+    for index in range(meter_count):
+        definitions.append(variable_definition("d{}".format(index), "String"))
+        fields.append(field_node(operation_field("SmartMeterTelemetry"), "t{}".format(index), "deviceId", "d{}".format(index)))
+    for index, agreement_operation in enumerate(agreement_operations):
+        definitions.append(variable_definition("a{}".format(index), "ID"))
+        fields.append(field_node(operation_field(agreement_operation), "a{}".format(index), "id", "a{}".format(index)))
+    return query_request("BatchedMeterReadings", definitions, fields)
@@ -1,3 +1,4 @@
+from typing import ClassVar
 from pydantic import BaseModel
 from datetime import datetime
 class energy_meter(BaseModel):
@@ -8,6 +9,11 @@ class energy_meter(BaseModel):
     reading_types: list[str] | None = None
     agreement: int | None = None
     tariff_name: str | None = None
+    account_number: str | None = None
+
+    # Operation in queries.gql fetching this fuel's agreement and tariff, and the field it returns
+    agreement_operation: ClassVar[str] = ""
+    agreement_field: ClassVar[str] = ""
 
 
     def return_labels(self):
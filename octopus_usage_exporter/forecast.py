@@ -0,0 +1,75 @@
+import logging
+from metrics import tariff_unit_rate_forecast, tariff_window_min, tariff_window_avg, tariff_window_argmin
+
+# Upcoming windows summarised for load shifting, as (label, half hourly slots)
+WINDOWS = (("4h", 8), ("8h", 16), ("24h", 48))
+
+
+def summarise_windows(values, start=0):
+    # min/sum/index run over array slices in C, there is no per slot Python work. The windows are cut from every
+    # known rate, not just the slots exported as the forecast curve.
+    summaries = {}
+    for window, slots in WINDOWS:
+        rates = values[start:start + slots]
+        if len(rates) < slots:
+            # Rates are not published that far ahead yet, a shorter window would understate the spread
+            continue
+        cheapest = min(rates)
+        summaries[window] = (cheapest, sum(rates) / len(rates), rates.index(cheapest))
+    return summaries
+
+
+class price_forecast:
+    """Exports the upcoming unit rate curve from a cached rate index. The curve only moves when the
+    current half hour slot changes or the tariff is re-fetched, so other polls are a no-op."""
+
+    def __init__(self, slots=48):
+        self.slots = slots
+        self._published = {}
+
+    def update(self, meter, rate_index, timestamp):
+        start = rate_index.slot_at(timestamp)
+        previous = self._published.get(meter.device_id)
+        if previous and previous[0] is rate_index and previous[1] == start:
+            return
+        if start is None:
+            logging.debug("No published unit rate covers now for {}, clearing forecast".format(meter.device_id))
+            self.clear(meter)
+            return
+
+        labels = meter.return_labels()
+        values = rate_index.values[start:start + self.slots]
+        for slot, value in enumerate(values):
+            tariff_unit_rate_forecast.labels(slot=str(slot), **labels).set(value)
+        # Drop slots published last time that have since run past the end of the known rates
+        for slot in range(len(values), previous[2] if previous else 0):
+            tariff_unit_rate_forecast.remove(meter.device_id, meter.meter_type, str(slot))
+
+        summaries = summarise_windows(rate_index.values, start)
+        for window, _ in WINDOWS:
+            if window not in summaries:
+                remove_window(meter, window)
+                continue
+            cheapest, average, offset = summaries[window]
+            tariff_window_min.labels(window=window, **labels).set(cheapest)
+            tariff_window_avg.labels(window=window, **labels).set(average)
+            tariff_window_argmin.labels(window=window, **labels).set(offset)
+
+        self._published[meter.device_id] = (rate_index, start, len(values))
+
+    def clear(self, meter):
+        previous = self._published.pop(meter.device_id, None)
+        if previous is None:
+            return
+        for slot in range(previous[2]):
+            tariff_unit_rate_forecast.remove(meter.device_id, meter.meter_type, str(slot))
+        for window, _ in WINDOWS:
+            remove_window(meter, window)
+
+
+def remove_window(meter, window):
+    for gauge in (tariff_window_min, tariff_window_avg, tariff_window_argmin):
+        try:
+            gauge.remove(meter.device_id, meter.meter_type, window)
+        except KeyError:
+            pass
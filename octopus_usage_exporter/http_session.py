@@ -0,0 +1,121 @@
+import socket
+import time
+import requests
+from requests.adapters import HTTPAdapter
+from gql.transport.requests import RequestsHTTPTransport
+from urllib3.connection import HTTPConnection, HTTPSConnection
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+from urllib3.exceptions import ConnectTimeoutError, NameResolutionError, NewConnectionError
+from urllib3.util import connection
+from metrics import http_phase_seconds
+
+
+class phase_timing:
+    """Times the phases of each new connection and of every response, for urllib3 connection classes."""
+
+    def _new_conn(self):
+        # Resolves separately from connecting, which urllib3 does in a single create_connection call
+        start = time.perf_counter()
+        try:
+            addresses = socket.getaddrinfo(self._dns_host, self.port, 0, socket.SOCK_STREAM)
+        except socket.gaierror as e:
+            raise NameResolutionError(self.host, self, e) from e
+        resolved = time.perf_counter()
+        http_phase_seconds.labels("dns").observe(resolved - start)
+
+        error = None
+        for _, _, _, _, address in addresses:
+            try:
+                sock = connection.create_connection(address[:2], self.timeout, source_address=self.source_address,
+                                                    socket_options=self.socket_options)
+                break
+            except socket.timeout as e:
+                error = ConnectTimeoutError(self, "Connection to {} timed out. (connect timeout={})".format(self.host, self.timeout))
+                error.__cause__ = e
+            except OSError as e:
+                error = NewConnectionError(self, "Failed to establish a new connection: {}".format(e))
+                error.__cause__ = e
+        else:
+            raise error
+
+        self._connected_at = time.perf_counter()
+        http_phase_seconds.labels("connect").observe(self._connected_at - resolved)
+        return sock
+
+    def getresponse(self, *args, **kwargs):
+        # The request has been written by now, so this is the wait for the first byte of the response
+        start = time.perf_counter()
+        response = super().getresponse(*args, **kwargs)
+        http_phase_seconds.labels("ttfb").observe(time.perf_counter() - start)
+        return response
+
+
+class timed_http_connection(phase_timing, HTTPConnection):
+    pass
+
+
+class timed_https_connection(phase_timing, HTTPSConnection):
+    def connect(self):
+        super().connect()
+        http_phase_seconds.labels("tls").observe(time.perf_counter() - self._connected_at)
+
+
+class timed_http_pool(HTTPConnectionPool):
+    ConnectionCls = timed_http_connection
+
+
+class timed_https_pool(HTTPSConnectionPool):
+    ConnectionCls = timed_https_connection
+
+
+class pooled_adapter(HTTPAdapter):
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {"http": timed_http_pool, "https": timed_https_pool}
+
+
+def build_session(pool_size):
+    """A keep-alive session holding up to pool_size connections per host, one per concurrent poll."""
+    session = requests.Session()
+    adapter = pooled_adapter(pool_connections=4, pool_maxsize=max(1, pool_size))
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    session.headers["Accept-Encoding"] = "gzip"
+    return session
+
+
+class shared_session_transport(RequestsHTTPTransport):
+    """RequestsHTTPTransport normally opens a new session, and so new connections, for every execute. This one borrows
+    a long lived session and leaves it open on close."""
+
+    def __init__(self, session, **kwargs):
+        super().__init__(**kwargs)
+        self.shared_session = session
+
+    def connect(self):
+        self.session = self.shared_session
+
+    def close(self):
+        self.session = None
+
+
+def trace_phases():
+    """An httpx trace extension reporting the same phases. httpcore resolves inside connect_tcp, so no dns phase."""
+    started = {}
+    phases = {
+        "connection.connect_tcp": "connect",
+        "connection.start_tls": "tls",
+        "http11.receive_response_headers": "ttfb",
+        "http2.receive_response_headers": "ttfb",
+    }
+
+    async def trace(event_name, info):
+        event, _, stage = event_name.rpartition(".")
+        if event not in phases:
+            return
+        if stage == "started":
+            started[event] = time.perf_counter()
+        elif stage == "complete" and event in started:
+            http_phase_seconds.labels(phases[event]).observe(time.perf_counter() - started.pop(event))
+
+    return trace
@@ -0,0 +1,101 @@
+import json
+import logging
+import os
+import threading
+import time
+import requests
+from jose import jwt
+
+JWKS_URL = "https://auth.octopus.energy/.well-known/jwks.json"
+
+
+class jwks_cache:
+    """Signing keys of the auth host, indexed by kid and optionally kept on disk. Keys are only fetched when a token
+    names a kid that is not known yet, and a set older than ttl is refreshed in the background while still in use."""
+
+    def __init__(self, url=JWKS_URL, path=None, ttl=86400, timeout=10, min_interval=60, clock=time.time, session=None):
+        self.url = url
+        self.session = session
+        self.path = path
+        self.ttl = ttl
+        self.timeout = timeout
+        # Unknown kids never cause more than one fetch per min_interval
+        self.min_interval = min_interval
+        self.clock = clock
+        self.keys = {}
+        self.fetched_at = 0.0
+        self._last_attempt = None
+        self._lock = threading.Lock()
+        self._refreshing = False
+        self.load()
+
+    def load(self):
+        if not self.path or not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path) as cached:
+                saved = json.load(cached)
+            self.keys = {key.get("kid"): key for key in saved["keys"]}
+            self.fetched_at = saved["fetched_at"]
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            logging.warning("Ignoring unreadable JWKS cache {}: {}".format(self.path, e))
+
+    def save(self):
+        if not self.path:
+            return
+        with open(self.path + ".tmp", "w") as cached:
+            json.dump({"fetched_at": self.fetched_at, "keys": list(self.keys.values())}, cached)
+        os.replace(self.path + ".tmp", self.path)
+
+    def fetch(self):
+        with self._lock:
+            self._last_attempt = self.clock()
+            response = (self.session or requests).get(url=self.url, timeout=self.timeout)
+            response.raise_for_status()
+            self.keys = {key.get("kid"): key for key in response.json()["keys"]}
+            self.fetched_at = self.clock()
+            try:
+                self.save()
+            except OSError as e:
+                logging.warning("Failed to save JWKS cache {}: {}".format(self.path, e))
+        logging.info("Fetched {} signing key(s) from {}".format(len(self.keys), self.url))
+
+    def refresh_in_background(self):
+        with self._lock:
+            if self._refreshing:
+                return
+            self._refreshing = True
+        threading.Thread(target=self._background_fetch, name="jwks-refresh", daemon=True).start()
+
+    def _background_fetch(self):
+        try:
+            self.fetch()
+        except Exception as e:
+            logging.warning("Background JWKS refresh failed, keeping cached keys: {}".format(e))
+        finally:
+            self._refreshing = False
+
+    def key_set(self, token):
+        """A JWKS for verifying token: the key named by its kid, or every known key if the token names none."""
+        try:
+            kid = jwt.get_unverified_header(token).get("kid")
+        except jwt.JWTError:
+            kid = None
+        missing = not self.keys or (kid is not None and kid not in self.keys)
+        if missing and self.may_fetch():
+            try:
+                self.fetch()
+            except Exception as e:
+                logging.error("Failed to fetch JWKS from {}: {}".format(self.url, e))
+        elif self.keys and self.clock() - self.fetched_at > self.ttl:
+            self.refresh_in_background()
+        if kid is None:
+            return {"keys": list(self.keys.values())}
+        return {"keys": [self.keys[kid]] if kid in self.keys else []}
+
+    def may_fetch(self):
+        return self._last_attempt is None or self.clock() - self._last_attempt >= self.min_interval
+
+    def next_fetch(self):
+        """When key_set may next try to fetch keys it does not have."""
+        return self.clock() if self._last_attempt is None else self._last_attempt + self.min_interval
@@ -0,0 +1,96 @@
+from prometheus_client import REGISTRY, Counter, Gauge, Histogram
+from reading_collector import reading_collector
+
+
+scheduling_lag = Histogram(
+    "oe_scheduler_lag_seconds",
+    "Delay between a meter poll falling due and being dispatched",
+    buckets=(0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30, 60, 300)
+)
+
+token_refresh_seconds = Histogram(
+    "oe_token_refresh_seconds",
+    "Time taken to obtain a new API token",
+    buckets=(0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+)
+
+http_phase_seconds = Histogram(
+    "oe_http_phase_seconds",
+    "Time spent in each phase of API requests: dns, connect, tls and ttfb (time to first byte)",
+    ["phase"],
+    buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20)
+)
+
+api_request_budget = Gauge(
+    "oe_api_request_budget",
+    "Requests that can be sent to the API right now without waiting for the rate governor"
+)
+api_request_rate = Gauge(
+    "oe_api_request_rate",
+    "Requests per second currently allowed by the rate governor"
+)
+api_errors = Counter(
+    "oe_api_errors_total",
+    "Failed API requests by kind of error",
+    ["kind"]
+)
+
+tariff_unit_rate_forecast = Gauge(
+    "oe_meter_tariff_unit_rate_forecast",
+    "Published unit rate in pence per kWh for the half hourly slot this many slots from now",
+    ["device_id", "meter_type", "slot"]
+)
+tariff_window_min = Gauge(
+    "oe_meter_tariff_unit_rate_window_min",
+    "Cheapest published unit rate in pence per kWh over the upcoming window",
+    ["device_id", "meter_type", "window"]
+)
+tariff_window_avg = Gauge(
+    "oe_meter_tariff_unit_rate_window_avg",
+    "Average published unit rate in pence per kWh over the upcoming window",
+    ["device_id", "meter_type", "window"]
+)
+tariff_window_argmin = Gauge(
+    "oe_meter_tariff_unit_rate_window_argmin",
+    "Slot offset from now of the cheapest unit rate over the upcoming window",
+    ["device_id", "meter_type", "window"]
+)
+meter_energy_total = Counter(
+    "oe_meter_energy",
+    "Energy used in kWh, accumulated from the telemetry's consumptionDelta",
+    ["device_id", "meter_type"]
+)
+meter_cost_total = Counter(
+    "oe_meter_cost",
+    "Cost of the energy used in pence, accumulated from the telemetry's costDelta",
+    ["device_id", "meter_type"]
+)
+meter_energy_window = Gauge(
+    "oe_meter_energy_window",
+    "Energy used in kWh over the trailing window",
+    ["device_id", "meter_type", "window"]
+)
+meter_cost_window = Gauge(
+    "oe_meter_cost_window",
+    "Cost of the energy used in pence over the trailing window",
+    ["device_id", "meter_type", "window"]
+)
+meter_spend_rate = Gauge(
+    "oe_meter_spend_rate",
+    "Current spend in pence per hour, from demand at the current unit rate",
+    ["device_id", "meter_type"]
+)
+meter_cost_today = Gauge(
+    "oe_meter_cost_today",
+    "Cost so far today in pence, including the standing charge",
+    ["device_id", "meter_type"]
+)
+meter_cost_projected = Gauge(
+    "oe_meter_cost_today_projected",
+    "Cost in pence today will come to if the current spend rate holds until midnight",
+    ["device_id", "meter_type"]
+)
+
+# Latest reading per meter for NG metrics, stamped with the telemetry's readAt
+meter_readings = reading_collector()
+REGISTRY.register(meter_readings)
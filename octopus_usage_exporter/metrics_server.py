@@ -0,0 +1,145 @@
+import gzip
+import hashlib
+import itertools
+import sys
+import threading
+import time
+from http.server import ThreadingHTTPServer
+from prometheus_client import REGISTRY, MetricsHandler
+from prometheus_client.exposition import choose_encoder, gzip_accepted
+
+
+class poller_health:
+    """Liveness and readiness of the meter poller. The poll loop beats at least every heartbeat seconds, even when no
+    meter is due, and the exporter is ready once a reading has been collected."""
+
+    def __init__(self, heartbeat=30, clock=time.monotonic):
+        self.heartbeat = heartbeat
+        self.clock = clock
+        self.last_beat = None
+        self.has_readings = False
+
+    def beat(self):
+        self.last_beat = self.clock()
+
+    def polled(self):
+        self.has_readings = True
+
+    def alive(self):
+        return self.last_beat is not None and self.clock() - self.last_beat < 3 * self.heartbeat
+
+    def ready(self):
+        return self.alive() and self.has_readings
+
+
+class rendered_exposition:
+    __slots__ = ("etag", "gzip_etag", "plain", "gzipped", "rendered_at")
+
+    def __init__(self, body, rendered_at):
+        # Each content-coding is a different representation, so a cache never answers a plain request with gzip
+        digest = hashlib.sha1(body).hexdigest()
+        self.etag = '"{}"'.format(digest)
+        self.gzip_etag = '"{}-gz"'.format(digest)
+        self.plain = body
+        self.gzipped = gzip.compress(body, compresslevel=6)
+        self.rendered_at = rendered_at
+
+
+class exposition_cache:
+    """The /metrics body, rendered and gzipped once and served from memory until the readings change. Internal
+    metrics such as the scheduler lag still change between polls, so a render is also refreshed after max_age."""
+
+    def __init__(self, registry=REGISTRY, max_age=60, clock=time.monotonic):
+        self.registry = registry
+        self.max_age = max_age
+        self.clock = clock
+        self._rendered = {}
+        self._lock = threading.Lock()
+        # Bumped by every invalidation, so a render that raced a poll is never kept
+        self._generations = itertools.count()
+        self._generation = next(self._generations)
+
+    def invalidate(self):
+        self._generation = next(self._generations)
+        self._rendered = {}
+
+    def get(self, accept_header):
+        """(content type, rendered_exposition) for the format negotiated from accept_header."""
+        encoder, content_type = choose_encoder(accept_header)
+        rendered = self._rendered.get(content_type)
+        if rendered is None or self.clock() - rendered.rendered_at > self.max_age:
+            # Concurrent scrapes of a stale body wait for a single render
+            with self._lock:
+                rendered = self._rendered.get(content_type)
+                if rendered is None or self.clock() - rendered.rendered_at > self.max_age:
+                    generation = self._generation
+                    rendered = rendered_exposition(encoder(self.registry), self.clock())
+                    # A poll that invalidated the cache mid render may not be in this body, so it only serves this scrape
+                    if self._generation == generation:
+                        self._rendered = dict(self._rendered, **{content_type: rendered})
+        return content_type, rendered
+
+
+class exporter_handler(MetricsHandler):
+    # Applied to each client socket, so a half open connection is dropped rather than holding its thread forever
+    timeout = 10
+    health = None
+    exposition = None
+
+    def do_GET(self):
+        path, _, query = self.path.partition("?")
+        path = path.rstrip("/")
+        if path == "/healthz":
+            self.send_status(self.health.alive())
+        elif path == "/ready":
+            self.send_status(self.health.ready())
+        elif self.exposition is None or query:
+            # Filtered scrapes (name[]=...) are rare enough to render as they come
+            super().do_GET()
+        else:
+            self.send_exposition()
+
+    def send_exposition(self):
+        content_type, rendered = self.exposition.get(self.headers.get("Accept"))
+        compressed = gzip_accepted(self.headers.get("Accept-Encoding"))
+        etag = rendered.gzip_etag if compressed else rendered.etag
+        if self.headers.get("If-None-Match") == etag:
+            self.send_response(304)
+            self.send_header("Vary", "Accept-Encoding")
+            self.send_header("ETag", etag)
+            self.end_headers()
+            return
+        body = rendered.gzipped if compressed else rendered.plain
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        if compressed:
+            self.send_header("Content-Encoding", "gzip")
+        self.send_header("Vary", "Accept-Encoding")
+        self.send_header("ETag", etag)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_status(self, ok):
+        body = b"ok\n" if ok else b"unavailable\n"
+        self.send_response(200 if ok else 503)
+        self.send_header("Content-Type", "text/plain; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    @classmethod
+    def bind(cls, health, exposition=None):
+        return type(cls.__name__, (cls,), {"health": health, "exposition": exposition})
+
+
+class metrics_server(ThreadingHTTPServer):
+    """Each scrape is served on its own thread, so one slow scraper cannot hold up the others."""
+    daemon_threads = True
+    request_queue_size = 64
+
+    def handle_error(self, request, client_address):
+        # A scraper hanging up mid response is routine, anything else is reported as usual
+        if isinstance(sys.exc_info()[1], ConnectionError):
+            return
+        super().handle_error(request, client_address)
@@ -1,9 +1,13 @@
-from pydantic import BaseModel
+from pydantic import BaseModel, PrivateAttr
+import asyncio
+import importlib.util
 import logging
+import threading
+import time
 from datetime import datetime, timedelta
 from jose import jwt
-from gql import Client, gql
-from gql.transport.requests import RequestsHTTPTransport, log as requests_logger
+from gql import Client
+from gql.transport.requests import log as requests_logger
 from gql.transport.exceptions import (
     TransportQueryError,
     TransportConnectionFailed,
@@ -14,7 +18,13 @@ from gql.transport.exceptions import (
 )
 from urllib3.exceptions import ResponseError, RequestError, HTTPError
 import requests
-from tenacity import retry, wait_exponential, retry_if_exception_type, after_log
+from tenacity import retry, wait_exponential, retry_if_exception, after_log
+from documents import get_request, bind
+from metrics import token_refresh_seconds, api_errors
+from rate_governor import rate_governor
+from token_manager import token_manager, unverified_expiry
+from jwks_cache import jwks_cache
+from http_session import build_session, shared_session_transport, trace_phases
 
 logging.basicConfig(level=logging.INFO,
                     format='%(asctime)s - %(levelname)s - %(message)s')
@@ -22,65 +32,180 @@ logging.getLogger("requests.packages.urllib3").setLevel(logging.WARNING)
 requests_logger.setLevel(logging.WARNING)
 logger = logging.getLogger(__name__)
 
+RETRYABLE_ERRORS = (
+    TransportQueryError,
+    TransportConnectionFailed,
+    TransportServerError,
+    TransportProtocolError,
+    TransportAlreadyConnected,
+    TransportClosed,
+    ResponseError,
+    RequestError,
+    HTTPError,
+    requests.exceptions.RequestException
+)
+
+# Kraken error codes from the extensions of GraphQL errors
+RATE_LIMIT_ERROR_CODES = {"KT-CT-1199"}
+AUTH_ERROR_CODES = {"KT-CT-1124"}
+
+API_URL = "https://api.octopus.energy/v1/graphql/"
+
+
+def error_codes(e):
+    return {(error.get("extensions") or {}).get("errorCode") for error in (e.errors or []) if isinstance(error, dict)}
+
+
+def classify_error(e):
+    """rate_limit, auth (the token was refused), permanent (the query itself was rejected) or transient."""
+    if isinstance(e, TransportQueryError):
+        codes = error_codes(e)
+        if codes & RATE_LIMIT_ERROR_CODES:
+            return "rate_limit"
+        if codes & AUTH_ERROR_CODES:
+            return "auth"
+        return "permanent"
+    if isinstance(e, TransportServerError) and e.code == 429:
+        return "rate_limit"
+    return "transient"
+
+
+def is_retryable(e):
+    return isinstance(e, RETRYABLE_ERRORS) and classify_error(e) != "permanent"
+
+
+# Shared by the blocking and asyncio query paths, tenacity wraps coroutines transparently
+query_retry = retry(
+    retry=retry_if_exception(is_retryable),
+    wait=wait_exponential(multiplier=1, min=10, max=90),
+    after=after_log(logger, logging.WARN),
+)
+
+
+def log_query_error(e, kind=None):
+    kind = kind or classify_error(e)
+    if kind == "rate_limit":
+        logging.error("Rate limit hit, slowing down requests: {}".format(e))
+    elif kind == "auth":
+        logging.error("Token rejected, refreshing JWT: {}".format(e))
+    elif kind == "permanent":
+        logging.error("Query rejected, not retrying: {}".format(e))
+    elif isinstance(e, (TransportConnectionFailed, TransportServerError, TransportProtocolError, TransportAlreadyConnected, TransportClosed)):
+        logging.error("Transport error: {}".format(e))
+    elif isinstance(e, ResponseError):
+        logging.error("Response error: {}".format(e))
+    else:
+        logging.error("Error executing query: {}".format(e))
+
 
 class octopus_api_connection(BaseModel):
     model_config = {
         "arbitrary_types_allowed": True,
     }
     api_key: str
-    api_url: str = "https://api.octopus.energy/v1/graphql/"
+    api_url: str = API_URL
     headers: dict = {}
-    key: dict = {}
+    # Signing keys are fetched on first use and may be shared by every connection
+    jwks: jwks_cache = None
+    # Keep-alive session shared by every client of this connection, and usually by every connection
+    session: requests.Session = None
+    pool_size: int = 10
+    # Paces requests for every connection it is shared with
+    governor: rate_governor = None
     client: Client = None
+    token_store: object = None
+    # Seconds before expiry at which the token is replaced in the background
+    refresh_ahead: int = 300
+    _local: threading.local = PrivateAttr(default_factory=threading.local)
+    _tokens: token_manager = PrivateAttr(default=None)
+    _login_client: Client = PrivateAttr(default=None)
+    _async_session: object = PrivateAttr(default=None)
 
     def __init__(self, **data):
         super().__init__(**data)
-        self.key = requests.get(url="https://auth.octopus.energy/.well-known/jwks.json").json()
-        self.client = Client(
-            transport=RequestsHTTPTransport(
+        if self.session is None:
+            self.session = build_session(self.pool_size)
+        if self.jwks is None:
+            self.jwks = jwks_cache(session=self.session)
+        if self.governor is None:
+            self.governor = rate_governor()
+        self.client = self.build_client()
+        self._local.client = self.client
+        self._tokens = token_manager(self.headers, lambda: self.fetch_jwt(), self.verify_jwt, self.refresh_ahead, on_refresh=self.save_jwt)
+        if not self.restore_jwt():
+            self.get_jwt()
+
+    def restore_jwt(self):
+        # A token saved by a previous run is reused until shortly before it expires
+        if self.token_store is None:
+            return False
+        stored = self.token_store.load_token(self.api_key, (datetime.now() + timedelta(minutes=2)).timestamp())
+        if stored is None:
+            return False
+        self._tokens.set_token(stored[0])
+        logging.info("Restored JWT valid until {}".format(datetime.fromtimestamp(stored[1])))
+        return True
+
+    def save_jwt(self, token):
+        if self.token_store is not None:
+            self.token_store.save_token(self.api_key, token, jwt.get_unverified_claims(token)["exp"])
+
+    def build_client(self, headers=None):
+        # Each transport shares the headers dict, so a refreshed JWT is picked up by every client
+        return Client(
+            transport=shared_session_transport(
+                session=self.session,
                 url=self.api_url,
-                headers=self.headers,
+                headers=self.headers if headers is None else headers,
                 verify=True,
                 retries=0,
                 timeout=20),
             fetch_schema_from_transport=False
         )
-        self.get_jwt()
 
-    def check_jwt(self):
-        if self.headers.get("Authorization") is None:
-            logging.info("No JWT found, fetching new one")
-            self.get_jwt()
-            return
+    def thread_client(self):
+        # A gql transport holds a single session, so worker threads each get their own client
+        client = getattr(self._local, "client", None)
+        if client is None:
+            client = self.build_client()
+            self._local.client = client
+        return client
+
+    def verify_jwt(self, token):
+        # The RS256 signature is checked once per token, after that only the recorded expiry is compared
         try:
-            user_info = jwt.decode(self.headers["Authorization"].split(" ")[1], key=self.key , algorithms=["RS256"])
-            if (datetime.fromtimestamp(user_info["exp"]) > datetime.now() + timedelta(minutes=2)):
-                logging.debug("JWT valid until {}".format(datetime.fromtimestamp(user_info["exp"])))
-            else:
-                self.get_jwt()
+            keys = self.jwks.key_set(token)
+            if not keys["keys"]:
+                # Without the signing key, trust the token's own expiry until the keys can be fetched again rather
+                # than logging in for every request
+                expiry = jwt.get_unverified_claims(token)["exp"]
+                logging.warning("No signing key for the JWT, using its unverified expiry {} until the key set is available".format(
+                    datetime.fromtimestamp(expiry)))
+                return unverified_expiry(expiry, self.jwks.next_fetch())
+            user_info = jwt.decode(token, key=keys, algorithms=["RS256"])
         except (jwt.ExpiredSignatureError, jwt.JWTError) as e:
             logging.error("Hit error {} - {}, refreshing JWT".format(e.__class__.__name__, e))
-            self.get_jwt()
+            return None
+        logging.debug("JWT valid until {}".format(datetime.fromtimestamp(user_info["exp"])))
+        return user_info["exp"]
+
+    def jwt_needs_refresh(self):
+        return self._tokens.needs_refresh()
+
+    def check_jwt(self):
+        self._tokens.ensure()
+
+    def fetch_jwt(self):
+        # Logging in goes through its own client, so the token being replaced is never sent with the request
+        if self._login_client is None:
+            self._login_client = self.build_client(headers={})
+        start = time.perf_counter()
+        jwt_query = self.run_query(get_request("ObtainKrakenToken"), variable_values={"apiKey": self.api_key}, client=self._login_client)
+        token_refresh_seconds.observe(time.perf_counter() - start)
+        return jwt_query['obtainKrakenToken']['token']
 
     def get_jwt(self):
-        logging.info("Dropping headers")
-        self.headers.clear()
-        if not bool(self.headers):
-            logging.info("Dropped headers, refreshing JWT")
-        else:
-            logging.warning("Failed to drop headers, trying to refresh JWT anyway")
-        query = gql("""
-            mutation ObtainKrakenToken($apiKey: String!) {
-                obtainKrakenToken(input: { APIKey: $apiKey}) {
-                    token
-                }
-            }
-        """)
-        jwt_query = self.run_query(query, variable_values={"apiKey": self.api_key})
-
-        self.headers["Authorization"] = "JWT {}".format(jwt_query['obtainKrakenToken']['token'])
-
-        logging.info("JWT refresh success")
+        self._tokens.refresh()
         return "jwt_query['obtainKrakenToken']['token']"
 
     def get_client(self):
@@ -92,37 +217,79 @@ class octopus_api_connection(BaseModel):
         self.check_jwt()
         return self.run_query(query, variable_values)
 
-    @retry(
-        retry=retry_if_exception_type(
-            (
-                TransportQueryError,
-                TransportConnectionFailed,
-                TransportServerError,
-                TransportProtocolError,
-                TransportAlreadyConnected,
-                TransportClosed,
-                ResponseError,
-                RequestError,
-                HTTPError,
-                requests.exceptions.RequestException
-            )
-        ),
-        wait=wait_exponential(multiplier=1, min=10, max=90),
-        after=after_log(logger, logging.WARN),
-    )
-    def run_query(self, query, variable_values=None):
+    def query_failed(self, e, token):
+        """Logs e and feeds it back to the governor, returns True when the token it was sent with should be replaced."""
+        kind = classify_error(e)
+        api_errors.labels(kind).inc()
+        log_query_error(e, kind)
+        if kind == "rate_limit":
+            self.governor.on_rate_limited()
+        return kind == "auth" and token is not None
+
+    @query_retry
+    def run_query(self, query, variable_values=None, client=None):
+        # Logins go through their own client and must not try to refresh the token they are fetching
+        token = None if client else self._tokens.token()
+        self.governor.acquire()
         try:
-            return self.client.execute(query, variable_values=variable_values)
-        except TransportQueryError as e:
-            logging.error("Possible rate limit hit, increase call interval")
-            logging.error(e)
-            raise  # Raise to trigger retry
-        except (TransportConnectionFailed, TransportServerError, TransportProtocolError, TransportAlreadyConnected, TransportClosed) as e:
-            logging.error("Transport error: {}".format(e))
-            raise  # Raise to trigger retry
-        except ResponseError as e:
-            logging.error("Response error: {}".format(e))
+            result = (client or self.thread_client()).execute(bind(query, variable_values))
+        except Exception as e:
+            if self.query_failed(e, token):
+                self.refresh_rejected_jwt(token)
             raise  # Raise to trigger retry
+        self.governor.on_success()
+        return result
+
+    def refresh_rejected_jwt(self, token):
+        try:
+            self._tokens.refresh_if_current(token)
+        except Exception as e:
+            logging.error("Failed to refresh rejected JWT: {}".format(e))
+
+    async def async_session(self):
+        # Imported lazily so the blocking transport does not require httpx to be installed
+        import httpx
+        from gql.transport.httpx import HTTPXAsyncTransport
+
+        if self._async_session is None:
+            limits = httpx.Limits(max_connections=self.pool_size, max_keepalive_connections=self.pool_size)
+            client = Client(
+                transport=HTTPXAsyncTransport(url=self.api_url, verify=True, timeout=20, limits=limits,
+                                              http2=importlib.util.find_spec("h2") is not None,
+                                              headers={"Accept-Encoding": "gzip"}),
+                fetch_schema_from_transport=False
+            )
+            self._async_session = await client.connect_async()
+        return self._async_session
+
+    async def check_jwt_async(self):
+        # Refreshes go through the same single-flight path as the worker threads, off the event loop
+        if self._tokens.needs_refresh():
+            await asyncio.to_thread(self._tokens.ensure)
+
+    async def execute_async(self, query, variable_values=None):
+        await self.check_jwt_async()
+        return await self.run_query_async(query, variable_values)
+
+    @query_retry
+    async def run_query_async(self, query, variable_values=None):
+        session = await self.async_session()
+        token = self._tokens.token()
+        wait = self.governor.reserve()
+        if wait:
+            await asyncio.sleep(wait)
+        try:
+            # The httpx client copies headers when it connects, so the current JWT is sent per request
+            result = await session.execute(bind(query, variable_values),
+                                           extra_args={"headers": dict(self.headers), "extensions": {"trace": trace_phases()}})
         except Exception as e:
-            logging.error("Error executing query: {}".format(e))
+            if self.query_failed(e, token):
+                await asyncio.to_thread(self.refresh_rejected_jwt, token)
             raise  # Raise to trigger retry
+        self.governor.on_success()
+        return result
+
+    async def close_async(self):
+        if self._async_session is not None:
+            await self._async_session.client.close_async()
+            self._async_session = None
@@ -1,19 +1,36 @@
-from prometheus_client import MetricsHandler, Gauge
+from prometheus_client import REGISTRY, Gauge
 from datetime import datetime, timedelta
+import asyncio
 import logging
 import os
 import threading
 import time
-from http.server import HTTPServer
-from gql import gql
+from concurrent.futures import ThreadPoolExecutor
 from pydantic_settings import BaseSettings, SettingsConfigDict
+from gql.transport.exceptions import TransportQueryError
 
 
 from gas_meter import gas_meter
 from electric_meter import electric_meter
-from octopus_api_connection import octopus_api_connection
+from octopus_api_connection import octopus_api_connection, API_URL
+from accounts import configured_accounts
+from scheduler import meter_scheduler
+from batch_query import build_batch_query, split_batch_response, failed_aliases, failed_agreements
+from documents import get_request
+from tariff_cache import tariff_cache, agreement_key, build_rate_index
+from forecast import price_forecast
+from state_store import state_store
+from jwks_cache import jwks_cache, JWKS_URL
+from http_session import build_session
+from rate_governor import rate_governor
+from metrics_server import metrics_server, exporter_handler, poller_health, exposition_cache
+from metrics import meter_readings
+from reading_collector import READ_AT
+from reload_trigger import reload_trigger
+from rediscovery import rediscovery_schedule
+from usage_history import usage_tracker, CONSUMPTION_DELTA, COST_DELTA
+from cost_engine import cost_engine
 from utils import strip_device_id, from_iso, from_iso_timestamp
-from gauge_definitions import GaugeDefinitions
 
 
 logging.basicConfig(level=logging.INFO,
@@ -21,9 +38,44 @@ logging.basicConfig(level=logging.INFO,
 
 
 version = "0.1.8"
+# Legacy metrics only, NG metrics are served by the reading collector in metrics.py
 gauges = {}
+gauges_lock = threading.Lock()
 
 meters = []
+# Held while meters are added, retired or moved to a new agreement
+meters_lock = threading.RLock()
+# Accounts are rediscovered periodically, and early when an agreement turns out to be revoked
+rediscovery = rediscovery_schedule()
+
+# One connection (and so one JWT) per API key, shared by every account using that key
+connections = {}
+# Accounts are discovered in parallel at startup, so only one login per API key is made
+connection_locks = {}
+account_connections = {}
+
+# Agreements and tariffs change at most daily, so they are fetched separately from telemetry and cached
+tariffs = tariff_cache()
+forecasts = price_forecast()
+usage = usage_tracker()
+costs = cost_engine(usage)
+
+# Optional on-disk state, so a restart resumes rather than rediscovering and polling everything at once
+state = None
+
+# Auth host signing keys, shared by every connection and fetched on first use
+signing_keys = None
+# One keep-alive connection pool for every API and auth request
+http_session = None
+# Paces requests across every meter and account, backing off when the API reports a rate limit
+governor = None
+# Backs /healthz and /ready on the metrics port
+health = poller_health()
+# /metrics is rendered once per poll rather than once per scrape
+exposition = exposition_cache()
+
+# The current settings, built once and replaced whole when the settings are reloaded
+settings = None
 
 interval = 1800
 
@@ -37,11 +89,52 @@ class PrometheusEndpointServer(threading.Thread):
     def run(self):
         self.httpd.serve_forever()
 
+class AsyncPoller:
+    # Mirrors ThreadPoolExecutor.submit for coroutines, running them on an event loop in a background thread
+    def __init__(self, workers):
+        self.loop = asyncio.new_event_loop()
+        self.limit = asyncio.Semaphore(workers)
+        self.thread = threading.Thread(target=self.loop.run_forever, name="meter-poller-async", daemon=True)
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+
+    async def bounded(self, coroutine):
+        async with self.limit:
+            return await coroutine
+
+    def submit(self, fn, *args):
+        return asyncio.run_coroutine_threadsafe(self.bounded(fn(*args)), self.loop)
+
 class Settings(BaseSettings):
-    model_config = SettingsConfigDict()
+    model_config = SettingsConfigDict(frozen=True, extra="ignore")
+    config_file: str | None = None
     prom_port: int = 9120
-    account_number: str
-    api_key: str
+    account_number: str | None = None
+    api_key: str | None = None
+    accounts_file: str | None = None
+    workers: int = 4
+    jitter: float = 0.1
+    async_transport: bool = False
+    batch_size: int = 25
+    tariff_ttl: int = 3600
+    tariff_forecast: bool = False
+    forecast_slots: int = 48
+    usage_history: int = 2880
+    state_file: str | None = None
+    discovery_ttl: int = 86400
+    rediscovery_interval: int = 21600
+    api_url: str = API_URL
+    jwks_url: str = JWKS_URL
+    jwks_file: str | None = None
+    jwks_ttl: int = 86400
+    rate_limit: float = 1.0
+    rate_burst: int = 10
     gas: bool = False
     electric: bool = False
     ng_metrics: bool = False
@@ -49,13 +142,39 @@ class Settings(BaseSettings):
     tariff_remaining: bool = False
     interval: int = 1800
 
-def display_settings():
+# Read once at startup, a reload logs a warning rather than applying changes to these
+RESTART_SETTINGS = ("prom_port", "workers", "async_transport", "state_file", "api_url", "jwks_url", "jwks_file", "jwks_ttl",
+                    "usage_history", "ng_metrics", "config_file")
+
+def load_settings():
+    # CONFIG_FILE is a dotenv file read beneath the environment, so it can be edited and reloaded in place
+    config = Settings()
+    if config.config_file:
+        config = Settings(_env_file=config.config_file)
+    return config
+
+def display_settings(config):
     logging.info("Exporter settings:")
-    logging.info("Gas Scraping: {}".format("Enabled" if Settings().gas else "Disabled"))
-    logging.info("Electric Scraping: {}".format("Enabled" if Settings().electric else "Disabled"))
-    logging.info("NG Metrics: {}".format("Enabled" if Settings().ng_metrics else "Disabled"))
-    logging.info("Tariff Rates: {}".format("Enabled" if Settings().tariff_rates else "Disabled"))
-    logging.info("Tariff Remaining: {}".format("Enabled" if Settings().tariff_remaining else "Disabled"))
+    logging.info("Gas Scraping: {}".format("Enabled" if config.gas else "Disabled"))
+    logging.info("Electric Scraping: {}".format("Enabled" if config.electric else "Disabled"))
+    logging.info("NG Metrics: {}".format("Enabled" if config.ng_metrics else "Disabled"))
+    logging.info("Tariff Rates: {}".format("Enabled" if config.tariff_rates else "Disabled"))
+    logging.info("Tariff Remaining: {}".format("Enabled" if config.tariff_remaining else "Disabled"))
+    logging.info("Tariff Forecast: {}".format("{} slots".format(config.forecast_slots) if config.tariff_forecast else "Disabled"))
+    logging.info("Usage History: {} readings per meter".format(config.usage_history))
+    logging.info("Config File: {}".format(config.config_file or "Not set"))
+    logging.info("Accounts File: {}".format(config.accounts_file or "Not set"))
+    logging.info("Polling Workers: {}".format(config.workers))
+    logging.info("Polling Jitter: {:.0%} of interval".format(config.jitter))
+    logging.info("Async Transport: {}".format("Enabled" if config.async_transport else "Disabled"))
+    logging.info("Meters per Request: {}".format(config.batch_size))
+    logging.info("Tariff Cache TTL: {} seconds".format(config.tariff_ttl))
+    logging.info("State File: {}".format(config.state_file or "Not set"))
+    logging.info("Discovery Cache TTL: {} seconds".format(config.discovery_ttl))
+    logging.info("Rediscovery: {}".format("every {} seconds".format(config.rediscovery_interval) if config.rediscovery_interval else "Disabled"))
+    logging.info("API URL: {}".format(config.api_url))
+    logging.info("JWKS Cache File: {}".format(config.jwks_file or "Not set"))
+    logging.info("Rate Limit: {} requests per second, bursts of {}".format(config.rate_limit, config.rate_burst))
 
 def output_release_notes():
     logging.info("**********************************************************")
@@ -65,9 +184,9 @@ def output_release_notes():
     logging.info("See verbose release notes at github.com/josephrpalmer/octopus-usage-exporter")
     logging.info("**********************************************************")
 
-def start_prometheus_server():
+def start_prometheus_server(config):
     try:
-        httpd = HTTPServer(("0.0.0.0", Settings().prom_port), MetricsHandler)
+        httpd = metrics_server(("0.0.0.0", config.prom_port), exporter_handler.bind(health, exposition))
     except (OSError) as e:
         logging.error("Failed to start Prometheus server: %s", str(e))
         return
@@ -75,176 +194,188 @@ def start_prometheus_server():
     thread = PrometheusEndpointServer(httpd)
     thread.daemon = True
     thread.start()
-    logging.info("Exporting Prometheus /metrics/ on port %s", Settings().prom_port)
-
-def possible_meter_verification(meters, fuel):
-    possible_meters = [meter for meter in meters[0]["meterPoint"]["meters"] if meter.get("registers") and all(register["name"] == "Standard" for register in meter.get("registers", []))]
+    logging.info("Exporting Prometheus /metrics/ with /healthz and /ready on port %s", config.prom_port)
+
+def possible_meter_verification(agreements, fuel, device_field):
+    """(device id, agreement) of every meter with a standard register across agreements, each device once under the
+    first agreement it appears in."""
+    possible_meters = {}
+    for agreement in agreements:
+        for meter in agreement["meterPoint"]["meters"]:
+            # Only import meters are read, gas meters have no export side
+            if meter.get(device_field) is None or meter.get("smartExportElectricityMeter") is not None:
+                continue
+            if meter.get("registers") and all(register["name"] == "Standard" for register in meter["registers"]):
+                possible_meters.setdefault(meter[device_field]["deviceId"], agreement)
     if len(possible_meters) == 0:
         logging.error("Meter setup not supported. No smart import {} meters with a standard register were found.".format(fuel))
         raise Exception("Meter setup not supported. No smart import {} meters with a standard register were found.".format(fuel))
-    elif len(possible_meters) > 1:
-        logging.warning("Multiple smart import {} meters with a standard register were found. Using first available meter.".format(fuel))
-    
-    return possible_meters[0]
-
-def get_device_id(client, gas, electric):
-    gas_query = gql("""
-        query Account($accountNumber: String!) {
-            account(accountNumber: $accountNumber) {
-                id
-                gasAgreements {
-                id
-                ... on GasAgreementType {
-                    id
-                    tariff {
-                        displayName
-                    }
-                }
-                meterPoint {
-                    id
-                    meters {
-                    id
-                    smartGasMeter {
-                        id
-                        deviceId
-                    }
-                    registers {
-                        id
-                        identifier
-                        name
-                        unitRateType
-                    }
-                    }
-                }
-                }
-            }
-            }
-    """)
-
-    elec_query = gql("""
-        query Account($accountNumber: String!) {
-            account(accountNumber: $accountNumber) {
-                id
-                electricityAgreements {
-                id
-                ... on ElectricityAgreementType {
-                    id
-                    tariff {
-                        ... on StandardTariff {
-                            displayName
-                        }
-                        ... on DayNightTariff {
-                            displayName
-                        }
-                        ... on ThreeRateTariff {
-                            displayName
-                        }
-                        ... on HalfHourlyTariff {
-                            displayName
-                        }
-                        ... on PrepayTariff {
-                            displayName
-                        }
-                    }
-                }
-                meterPoint {
-                    id
-                    meters {
-                    smartImportElectricityMeter {
-                        id
-                        deviceId
-                    }
-                    smartExportElectricityMeter {
-                        id
-                        deviceId
-                    }
-                    registers {
-                        id
-                        name
-                        unitRateType
-                        identifier
-                    }
-                    }
-                }
-                }
-            }
-            }
-    """)
-
+    return list(possible_meters.items())
+
+def reading_types_for(config, meter_type):
+    tariff_readings = (["tariff_expiry", "tariff_days_remaining"] if config.tariff_remaining else []) + \
+        (["tariff_unit_rate", "tariff_standing_charge"] if config.tariff_rates else [])
+    if meter_type == "electric":
+        return ["consumption", "demand"] + tariff_readings
+    return ["consumption"] + tariff_readings
+
+def build_meter(config, meter_type, device_id, agreement, tariff_name, account_number):
+    if meter_type == "electric":
+        return electric_meter(
+            device_id=device_id,
+            meter_type="electric",
+            polling_interval=config.interval,
+            last_called=datetime.now() - timedelta(seconds=interval),
+            reading_types=reading_types_for(config, "electric"),
+            agreement=agreement,
+            tariff_name=tariff_name,
+            account_number=account_number
+        )
+    return gas_meter(device_id=device_id, meter_type="gas",
+                     polling_interval=1800,
+                     last_called=datetime.now()-timedelta(seconds=1800),
+                     reading_types=reading_types_for(config, "gas"),
+                     agreement=agreement,
+                     tariff_name=tariff_name,
+                     account_number=account_number)
+
+def fetch_account(config, client, account_number, refresh=False):
+    # Both fuels are discovered in one request, and the response is reused from the state file for DISCOVERY_TTL
+    if state is not None and not refresh:
+        cached = state.load_account(account_number, time.time() - config.discovery_ttl)
+        if cached is not None:
+            logging.info("Using meters discovered for account {} from the state file".format(account_number))
+            return cached
+    response = client.execute(get_request("Account"), variable_values={"accountNumber": account_number})
+    if state is not None:
+        state.save_account(account_number, response, time.time())
+    return response
+
+def select_meters(config, account, gas, electric, account_number):
+    selected = []
     if electric:
-        electric_query = client.execute(elec_query, variable_values={"accountNumber": Settings().account_number})
-        usable_smart_meters= [m for m in electric_query["account"]["electricityAgreements"] if m["meterPoint"]["meters"] and m["meterPoint"]["meters"][0]["smartImportElectricityMeter"] is not None and m["meterPoint"]["meters"][0]["smartExportElectricityMeter"] is None]
+        usable_smart_meters= [m for m in account["electricityAgreements"] if m["meterPoint"]["meters"] and any(meter["smartImportElectricityMeter"] is not None and meter["smartExportElectricityMeter"] is None for meter in m["meterPoint"]["meters"])]
         if len(usable_smart_meters) == 0:
             logging.error("No usable electricity smart meters found on the Octopus Energy account.")
-            return
-        logging.info("{} usable electricity meters of {} electricity meter(s) on the account".format(len(usable_smart_meters), len([m for m in electric_query["account"]["electricityAgreements"] if m["meterPoint"]["meters"] ])))
-        selected_smart_meter_device_id = possible_meter_verification(usable_smart_meters, "electric")["smartImportElectricityMeter"]["deviceId"]
-        selected_smart_meter_tariff = usable_smart_meters[0]["tariff"]["displayName"]
-        selected_agreement_id = usable_smart_meters[0]["id"]
-        meters.append(electric_meter(
-            device_id=selected_smart_meter_device_id,
-            meter_type="electric",
-            polling_interval=Settings().interval,
-            last_called=datetime.now() - timedelta(seconds=interval),
-            reading_types=["consumption", "demand"] +
-            (["tariff_expiry", "tariff_days_remaining"] if Settings().tariff_remaining else []) +
-            (["tariff_unit_rate", "tariff_standing_charge"] if Settings().tariff_rates else []),
-            agreement=selected_agreement_id,
-            tariff_name=selected_smart_meter_tariff
-        ))
-        logging.info("Electricity Meter has been found - {}".format(selected_smart_meter_device_id))
-        logging.info("Electricity Tariff information: {}".format(selected_smart_meter_tariff))
+        else:
+            logging.info("{} usable electricity meters of {} electricity meter(s) on the account".format(len(usable_smart_meters), len([m for m in account["electricityAgreements"] if m["meterPoint"]["meters"] ])))
+            for device_id, agreement in possible_meter_verification(usable_smart_meters, "electric", "smartImportElectricityMeter"):
+                selected.append(build_meter(config, "electric", device_id, agreement["id"], agreement["tariff"]["displayName"], account_number))
+                logging.info("Electricity Meter has been found - {}".format(device_id))
+                logging.info("Electricity Tariff information: {}".format(agreement["tariff"]["displayName"]))
     if gas:
-        gas_query = client.execute(gas_query, variable_values={"accountNumber": Settings().account_number})
-        usable_smart_meters = [m for m in gas_query["account"]["gasAgreements"] if m["meterPoint"]["meters"] and m["meterPoint"]["meters"][0]["smartGasMeter"] is not None]
+        usable_smart_meters = [m for m in account["gasAgreements"] if m["meterPoint"]["meters"] and any(meter["smartGasMeter"] is not None for meter in m["meterPoint"]["meters"])]
         if len(usable_smart_meters) == 0:
             logging.error("No usable gas smart meters found on the Octopus Energy account.")
-            return
-        logging.info("{} usable gas meters of {} gas meter(s) on the account".format(len(usable_smart_meters), len([m for m in gas_query["account"]["gasAgreements"] if m["meterPoint"]["meters"] and m["meterPoint"]["meters"][0]["smartGasMeter"] is not None])))
-        selected_smart_meter_device_id = possible_meter_verification(usable_smart_meters, "gas")["smartGasMeter"]["deviceId"]
-        selected_smart_meter_tariff = gas_query["account"]["gasAgreements"][0]["tariff"]["displayName"]
-        selected_agreement_id = gas_query["account"]["gasAgreements"][0]["id"]
-        meters.append(gas_meter(device_id=selected_smart_meter_device_id, meter_type="gas",
-                                   polling_interval=1800,
-                                   last_called=datetime.now()-timedelta(seconds=1800),
-                                   reading_types=["consumption"] +
-                                    (["tariff_expiry", "tariff_days_remaining"] if Settings().tariff_remaining else []) +
-                                    (["tariff_unit_rate", "tariff_standing_charge"] if Settings().tariff_rates else []),
-                                   agreement=selected_agreement_id,
-                                   tariff_name=selected_smart_meter_tariff))
-        logging.info("Gas Meter has been found - {}".format(selected_smart_meter_device_id))
-        logging.info("Gas Tariff information: {}".format(selected_smart_meter_tariff))
+        else:
+            logging.info("{} usable gas meters of {} gas meter(s) on the account".format(len(usable_smart_meters), len([m for m in account["gasAgreements"] if m["meterPoint"]["meters"]])))
+            for device_id, agreement in possible_meter_verification(usable_smart_meters, "gas", "smartGasMeter"):
+                selected.append(build_meter(config, "gas", device_id, agreement["id"], agreement["tariff"]["displayName"], account_number))
+                logging.info("Gas Meter has been found - {}".format(device_id))
+                logging.info("Gas Tariff information: {}".format(agreement["tariff"]["displayName"]))
+    return selected
+
+def get_device_id(config, client, gas, electric, account_number=None, refresh=False):
+    account_number = account_number or config.account_number
+    account = fetch_account(config, client, account_number, refresh)["account"]
+    selected = select_meters(config, account, gas, electric, account_number)
+    with meters_lock:
+        # A device reachable through more than one configured account is only read once
+        known = {(meter.device_id, meter.meter_type) for meter in meters}
+        added = [meter for meter in selected if (meter.device_id, meter.meter_type) not in known]
+        meters.extend(added)
+    return added
+
 
 
 def get_energy_reading(client, meter):
-    output_readings = {}
     # Dynamically build the query based on which agreement IDs are provided
     query = meter.get_jql_query()
     variables = {"deviceId": meter.device_id, "agreementId": meter.agreement}
 
+    return parse_energy_reading(meter, client.execute(query, variable_values=variables))
+
+def cached_agreements(meters):
+    agreements = {}
+    for meter in meters:
+        key = agreement_key(meter)
+        if key not in agreements:
+            agreements[key] = tariffs.get(key)
+    return agreements, [key for key, agreement in agreements.items() if agreement is None]
+
+def partial_batch_response(e):
+    """The data of a batch query that only partly failed and the aliases that failed. Raises e if the whole query failed."""
+    failed = failed_aliases(e.errors)
+    if e.data is None or failed is None:
+        raise e
+    return e.data, failed
+
+def parse_batch_response(meters, stale_agreements, response, agreements, failed=frozenset()):
+    split_response = split_batch_response(meters, stale_agreements, response, agreements, failed)
+    if len(split_response) < len(meters):
+        read = {id(meter) for meter, _ in split_response}
+        logging.error("Failed to read meters {}: their part of the batch query failed".format(
+            ", ".join(meter.device_id for meter in meters if id(meter) not in read)))
+    skipped = failed_agreements(stale_agreements, failed)
+    for key in stale_agreements:
+        if key in skipped:
+            continue
+        expiry = tariffs.put(key, agreements[key])
+        if state is not None and expiry is not None:
+            state.save_tariff(key, agreements[key], expiry)
+    return [(meter, parse_energy_reading(meter, meter_response, tariffs.rate_index(agreement_key(meter)))) for meter, meter_response in split_response]
+
+def get_energy_readings(client, meters):
+    agreements, stale_agreements = cached_agreements(meters)
+    query, variables = build_batch_query(meters, stale_agreements)
+    try:
+        response, failed = client.execute(query, variable_values=variables), frozenset()
+    except TransportQueryError as e:
+        response, failed = partial_batch_response(e)
+    return parse_batch_response(meters, stale_agreements, response, agreements, failed)
+
+async def get_energy_readings_async(client, meters):
+    agreements, stale_agreements = cached_agreements(meters)
+    query, variables = build_batch_query(meters, stale_agreements)
+    try:
+        response, failed = await client.execute_async(query, variable_values=variables), frozenset()
+    except TransportQueryError as e:
+        response, failed = partial_batch_response(e)
+    return parse_batch_response(meters, stale_agreements, response, agreements, failed)
+
+def parse_energy_reading(meter, reading_query_ex, rate_index=None):
+    output_readings = {}
     try:
-        reading_query_ex = client.execute(query, variable_values=variables)
         returned_telemetry = reading_query_ex["smartMeterTelemetry"][0]
+        if returned_telemetry.get("readAt"):
+            output_readings[READ_AT] = from_iso_timestamp(returned_telemetry["readAt"])
+        for field, key in (("consumptionDelta", CONSUMPTION_DELTA), ("costDelta", COST_DELTA)):
+            if returned_telemetry.get(field) is not None:
+                output_readings[key] = returned_telemetry[field]
 
         if meter.meter_type == "electric":
             if reading_query_ex["electricityAgreement"]["isRevoked"]:
                 logging.warning("Electricity agreement {} is revoked, no tariff information will be returned.".format(meter.agreement))
+                rediscovery.request(meter.account_number)
                 return {}
             if reading_query_ex["electricityAgreement"]["validTo"]:
                 valid_to = from_iso(reading_query_ex["electricityAgreement"]["validTo"])
                 if valid_to < datetime.now(valid_to.tzinfo):
                     logging.warning("Electricity agreement {} is no longer valid, no tariff information will be returned".format(meter.agreement))
+                    rediscovery.request(meter.account_number)
                     return {}
-            for key,value in electricity_tariff_parser(reading_query_ex["electricityAgreement"]).items():
+            for key,value in electricity_tariff_parser(reading_query_ex["electricityAgreement"], rate_index).items():
                 output_readings[key] = value
         elif meter.meter_type == "gas":
             if reading_query_ex["gasAgreement"]["isRevoked"]:
                 logging.warning("Gas agreement {} is revoked, no tariff information will be returned.".format(meter.agreement))
+                rediscovery.request(meter.account_number)
                 return {}
             if reading_query_ex["gasAgreement"]["validTo"]:
                 valid_to = from_iso(reading_query_ex["gasAgreement"]["validTo"])
                 if valid_to < datetime.now(valid_to.tzinfo):
                     logging.warning("Gas agreement {} is no longer valid, no tariff information will be returned".format(meter.agreement))
+                    rediscovery.request(meter.account_number)
                     return {}
                 output_readings["tariff_unit_rate"] = reading_query_ex["gasAgreement"]["tariff"]["unitRate"]
                 output_readings["tariff_standing_charge"] = reading_query_ex["gasAgreement"]["tariff"]["standingCharge"]
@@ -265,7 +396,7 @@ def get_energy_reading(client, meter):
     logging.info("Meter: {} - {} metrics collected".format(meter.device_id, len(output_readings)))
     return output_readings
 
-def electricity_tariff_parser(tariff):
+def electricity_tariff_parser(tariff, rate_index=None):
 
     output_map = {}
 
@@ -277,15 +408,9 @@ def electricity_tariff_parser(tariff):
     t = tariff["tariff"]
     if t.get("unitRates"):
         logging.debug("Octopus 'smart' tariff detected. Half hourly rates will be returned.")
-        # Find the unit rate valid for now
-        current_rate = None
-        for rate in t["unitRates"]:
-            valid_from = from_iso(rate["validFrom"])
-            valid_to = from_iso(rate["validTo"])
-            if valid_from <= now and now < valid_to:
-                current_rate = rate["value"]
-                break
-        output_map["tariff_unit_rate"] = current_rate
+        # Find the unit rate valid for now, the index is normally cached alongside the agreement
+        rate_index = rate_index or build_rate_index(tariff)
+        output_map["tariff_unit_rate"] = rate_index.rate_at(now.timestamp())
     elif t.get("dayRate") and t.get("nightRate") and t.get("offPeakRate"):
         logging.warning("Octopus 'three rate' tariff detected. Support for this tariff is not available yet.")
         return output_map
@@ -310,55 +435,345 @@ def update_gauge(key, value, meter):
     try:
         value = float(value)
         if key in meter.reading_types:
-            if amended_key not in gauges:
-                gauges[amended_key] = Gauge(amended_key, "Octopus Energy Gauge")
+            with gauges_lock:
+                if amended_key not in gauges:
+                    gauges[amended_key] = Gauge(amended_key, "Octopus Energy Gauge")
             gauges[amended_key].set(value)
     except (TypeError, ValueError):
             logging.warning("Value for {} is not a float: {} - labels: {}".format(key, value, meter.return_labels()))
 
 
-def update_gauge_ng(key: str, value, meter):
-    amended_key = "oe_meter_{}".format(key)
+def get_connection(config, api_key):
+    with connection_locks.setdefault(api_key, threading.Lock()):
+        if api_key not in connections:
+            connections[api_key] = octopus_api_connection(api_key=api_key, api_url=config.api_url, token_store=state, jwks=signing_keys,
+                                                          session=http_session, pool_size=config.workers, governor=governor)
+    return connections[api_key]
+
+
+def open_state(path):
+    global state
+    state = state_store(path)
+    restored = state.load_tariffs(time.time())
+    for key, agreement, expiry in restored:
+        tariffs.put(key, agreement, expiry)
+    logging.info("Using state file {}, {} cached agreement(s) restored".format(path, len(restored)))
+
+
+def restore_last_poll(config, meter):
+    # Resuming from the saved poll time spreads the first polls out as they were before the restart
+    last_poll = state.load_poll(meter)
+    if last_poll is None:
+        return
+    last_called, readings = last_poll
+    meter.last_called = datetime.fromtimestamp(last_called)
+    if time.time() - last_called < meter.polling_interval and readings:
+        update_readings(config, readings, meter)
+        exposition.invalidate()
+        health.polled()
+
+
+def record_polls(polled):
+    if state is not None:
+        try:
+            state.record_polls(polled)
+        except Exception as e:
+            logging.warning("Failed to save poll state: {}".format(e))
+
+
+def update_readings(config, readings, meter):
+    """Exports readings for meter, returning False if nothing changed since the last poll."""
+    if config.ng_metrics:
+        changed = meter_readings.update(meter, readings)
+    else:
+        changed = True
+        for r_type, value in readings.items():
+            update_gauge(r_type, value, meter)
+    if usage.update(meter, readings):
+        changed = True
+    if not readings:
+        return changed
+    rate_index = tariffs.rate_index(agreement_key(meter))
+    costs.update(meter, readings, rate_index)
+    if config.tariff_forecast and rate_index is not None:
+        forecasts.update(meter, rate_index, time.time())
+        changed = True
+    return changed
+
+
+def poll_meters(config, api_connection, meters):
     try:
-        value = float(value)
-        if key in meter.reading_types:
-            if not gauges.get(amended_key):
-                gauges[amended_key] = Gauge(amended_key, GaugeDefinitions[key].value, meter.return_labels())
-            gauges[amended_key].labels(**meter.return_labels()).set(value)
-    except (TypeError, ValueError):
-        logging.warning("Value for {} is not a float: {} - labels: {}".format(key, value, meter.return_labels()))
+        polled = get_energy_readings(api_connection, meters)
+        changed = [update_readings(config, readings, meter) for meter, readings in polled]
+        record_polls(polled)
+        if any(changed):
+            exposition.invalidate()
+        health.polled()
+    except Exception as e:
+        logging.error("Failed to read meters {}: {}".format(", ".join(meter.device_id for meter in meters), e))
 
 
-def read_meters(api_connection):
-    while True:
-        for meter in meters:
-            if (meter.last_called + timedelta(seconds=meter.polling_interval) <= datetime.now()):
-                meter.last_called = datetime.now()
-                for r_type, value in get_energy_reading(api_connection, meter).items():
-                    update_gauge_ng(r_type, value, meter) if Settings().ng_metrics else update_gauge(r_type, value, meter)
+async def poll_meters_async(config, api_connection, meters):
+    try:
+        polled = await get_energy_readings_async(api_connection, meters)
+        changed = [update_readings(config, readings, meter) for meter, readings in polled]
+        record_polls(polled)
+        if any(changed):
+            exposition.invalidate()
+        health.polled()
+    except Exception as e:
+        logging.error("Failed to read meters {}: {}".format(", ".join(meter.device_id for meter in meters), e))
+
+
+def batch_due_meters(due, batch_size):
+    # Group due meters by connection (one token can read every account behind an API key), then cap each request
+    groups = {}
+    for meter, nominal in due:
+        connection = account_connections.get(meter.account_number)
+        if connection is None:
+            # The account was removed while the meter was waiting to be polled
+            continue
+        groups.setdefault(id(connection), (connection, []))[1].append((meter, nominal))
+    for connection, group in groups.values():
+        for start in range(0, len(group), batch_size):
+            yield connection, group[start:start + batch_size]
+
+
+def first_poll_delay(meter):
+    return (meter.last_called + timedelta(seconds=meter.polling_interval) - datetime.now()).total_seconds()
+
+
+def start_account(config, account, poll_schedule=None):
+    """Logs in to account and starts reading its meters. Once the poll loop runs, poll_schedule is given and each meter
+    is scheduled as soon as it is found, and a failure is logged rather than raised."""
+    try:
+        api_connection = get_connection(config, account.api_key)
+        account_connections[account.account_number] = api_connection
+        added = get_device_id(config, api_connection, account.gas, account.electric, account.account_number)
+    except Exception as e:
+        if poll_schedule is None:
+            raise
+        logging.error("Meter discovery failed for account {}: {}".format(account.account_number, e))
+        return
+    for meter in added:
+        if state is not None:
+            restore_last_poll(config, meter)
+        logging.info("Starting to read {} meter every {} seconds".format(meter.meter_type, meter.polling_interval))
+        if poll_schedule is not None:
+            poll_schedule.schedule_after(meter, first_poll_delay(meter))
 
-        time.sleep(interval)
 
-def interval_rate_check():
+def read_meters(reloads=None, accounts=()):
+    """Polls every meter until interrupted, discovering accounts still to be started on their own threads meanwhile."""
+    poll_schedule = meter_scheduler(jitter=settings.jitter)
+    for meter in meters:
+        poll_schedule.schedule_after(meter, first_poll_delay(meter))
+    if accounts:
+        # Logins and discovery can retry for a long time, so accounts are started in parallel and meters are polled
+        # as soon as their account has been discovered, rather than after every account
+        discovery = ThreadPoolExecutor(max_workers=settings.workers, thread_name_prefix="account-discovery")
+        for account in accounts:
+            discovery.submit(start_account, settings, account, poll_schedule)
+        discovery.shutdown(wait=False)
+
+    if settings.async_transport:
+        poller, poll_task = AsyncPoller(settings.workers), poll_meters_async
+    else:
+        poller, poll_task = ThreadPoolExecutor(max_workers=settings.workers, thread_name_prefix="meter-poller"), poll_meters
+
+    with poller as pool:
+        while True:
+            # Wake at least once per heartbeat so /healthz can tell an idle poller from a dead one
+            health.beat()
+            if reloads is not None and reloads.pending():
+                reload_settings(poll_schedule)
+                reloads.watch(watched_files(settings))
+            # Each poll keeps the settings it was dispatched with, even if they are reloaded while it runs
+            config = settings
+            rediscovery.poll(lambda account_numbers, config=config: rediscover(config, poll_schedule, account_numbers))
+            due = poll_schedule.pop_due(timeout=health.heartbeat)
+            for connection, batch in batch_due_meters(due, max(1, config.batch_size)):
+                for meter, _ in batch:
+                    meter.last_called = datetime.now()
+                poll = pool.submit(poll_task, config, connection, [meter for meter, _ in batch])
+                # Only plan the next poll once this one finishes, so a slow meter never overlaps itself
+                poll.add_done_callback(lambda _, batch=batch: [poll_schedule.reschedule(meter, nominal) for meter, nominal in batch])
+
+def interval_rate_check(config):
     global interval
-    if Settings().interval > 1800:
+    if config.interval > 1800:
         interval = 1800
     else:
-        interval = Settings().interval
+        interval = config.interval
         if (interval <= 180):
             logging.warning("Attention! If you proceed with an interval below 60 you will likely hit an API rate limit set by Octopus Energy.")
 
 
-def exporter():
+def watched_files(config):
+    return [config.config_file, config.accounts_file]
+
+
+def retire_meter(meter, poll_schedule):
+    """Stops polling meter and drops every series exported for it."""
+    if meter in meters:
+        meters.remove(meter)
+    poll_schedule.remove(meter)
+    meter_readings.remove(meter)
+    usage.remove(meter)
+    costs.remove(meter)
+    forecasts.clear(meter)
+    suffix = "_{}_{}".format(strip_device_id(meter.device_id), meter.meter_type)
+    with gauges_lock:
+        for key in [key for key in gauges if key.endswith(suffix)]:
+            REGISTRY.unregister(gauges.pop(key))
+    exposition.invalidate()
+    logging.info("Stopped reading {} meter {}".format(meter.meter_type, meter.device_id))
+
+
+def sync_accounts(config, accounts, poll_schedule):
+    """Retires meters of accounts or fuels no longer configured and discovers meters for newly configured ones."""
+    logged_in = connect_accounts(config, accounts)
+    with meters_lock:
+        sync_account_meters(config, accounts, logged_in, poll_schedule)
+
+
+def connect_accounts(config, accounts):
+    """Logs in with the API key of each account whose key is new or changed, returning the accounts that have a
+    connection. An account whose login fails keeps its current connection and meters."""
+    logged_in = []
+    for account in accounts:
+        connection = account_connections.get(account.account_number)
+        if connection is None or connection.api_key != account.api_key:
+            try:
+                connection = get_connection(config, account.api_key)
+            except Exception as e:
+                logging.error("Login failed for account {}, keeping its current meters: {}".format(account.account_number, e))
+                continue
+            account_connections[account.account_number] = connection
+        logged_in.append(account)
+    return logged_in
+
+
+def sync_account_meters(config, accounts, logged_in, poll_schedule):
+    wanted = {(account.account_number, fuel) for account in accounts
+              for fuel, enabled in (("electric", account.electric), ("gas", account.gas)) if enabled}
+    for meter in list(meters):
+        if (meter.account_number, meter.meter_type) not in wanted:
+            retire_meter(meter, poll_schedule)
+    for account_number in set(account_connections) - {account.account_number for account in accounts}:
+        del account_connections[account_number]
+
+    present = {(meter.account_number, meter.meter_type) for meter in meters}
+    for account in logged_in:
+        missing = {fuel for account_number, fuel in wanted - present if account_number == account.account_number}
+        if not missing:
+            continue
+        try:
+            added = get_device_id(config, account_connections[account.account_number], "gas" in missing, "electric" in missing, account.account_number)
+        except Exception as e:
+            logging.error("Meter discovery failed for account {}: {}".format(account.account_number, e))
+            continue
+        for meter in added:
+            poll_schedule.schedule_after(meter, 0)
+
+
+def rediscover_account(config, account, poll_schedule):
+    """Looks the account up again and brings its meters up to date in place. A meter whose device is unchanged keeps
+    its series and schedule, even if it moved to a new agreement or tariff."""
+    connection = account_connections.get(account.account_number) or get_connection(config, account.api_key)
+    response = fetch_account(config, connection, account.account_number, refresh=True)["account"]
+    discovered = {(meter.device_id, meter.meter_type): meter for meter in select_meters(config, response, account.gas, account.electric, account.account_number)}
+    with meters_lock:
+        for meter in [meter for meter in meters if meter.account_number == account.account_number]:
+            found = discovered.pop((meter.device_id, meter.meter_type), None)
+            if found is None:
+                retire_meter(meter, poll_schedule)
+                continue
+            if (found.agreement, found.tariff_name) != (meter.agreement, meter.tariff_name):
+                logging.info("{} meter {} moved from agreement {} to {} ({})".format(meter.meter_type, meter.device_id, meter.agreement, found.agreement, found.tariff_name))
+                # The forecast and cached tariff belong to the old agreement, the new one is fetched on the next poll
+                forecasts.clear(meter)
+                tariffs.invalidate(agreement_key(meter))
+                meter.agreement = found.agreement
+                meter.tariff_name = found.tariff_name
+        known = {(meter.device_id, meter.meter_type) for meter in meters}
+        for key, meter in discovered.items():
+            if key in known:
+                continue
+            meters.append(meter)
+            poll_schedule.schedule_after(meter, 0)
+            logging.info("Starting to read {} meter every {} seconds".format(meter.meter_type, meter.polling_interval))
+
+
+def rediscover(config, poll_schedule, account_numbers=None):
+    """Rediscovers every configured account, or only those in account_numbers."""
+    for account in configured_accounts(config):
+        if account_numbers is not None and account.account_number not in account_numbers:
+            continue
+        try:
+            rediscover_account(config, account, poll_schedule)
+        except Exception as e:
+            logging.error("Meter rediscovery failed for account {}: {}".format(account.account_number, e))
+
+
+def reload_settings(poll_schedule):
+    """Applies changed settings to the running exporter. Exported series and cached state are kept, except for
+    meters that are no longer configured."""
+    global settings
+    try:
+        config = load_settings()
+        accounts = configured_accounts(config)
+    except Exception as e:
+        logging.error("Settings reload failed, keeping the current settings: {}".format(e))
+        return
+    ignored = [name.upper() for name in RESTART_SETTINGS if getattr(config, name) != getattr(settings, name)]
+    if ignored:
+        logging.warning("{} only take effect on restart".format(", ".join(ignored)))
+
+    interval_rate_check(config)
+    tariffs.ttl = config.tariff_ttl
+    forecasts.slots = config.forecast_slots
+    poll_schedule.jitter = config.jitter
+    rediscovery.set_interval(config.rediscovery_interval)
+    if governor is not None:
+        governor.reconfigure(config.rate_limit, config.rate_burst)
+    for meter in list(meters):
+        meter.reading_types = reading_types_for(config, meter.meter_type)
+        if meter.meter_type == "electric" and meter.polling_interval != config.interval:
+            meter.polling_interval = config.interval
+            # The next poll was planned with the old interval, so plan it again from the last one
+            poll_schedule.replan(meter, (meter.last_called + timedelta(seconds=meter.polling_interval) - datetime.now()).total_seconds())
+    settings = config
+    # Logins and discovery can retry for a long time, so they run on the rediscovery thread rather than the poll loop
+    rediscovery.submit(sync_accounts, config, accounts, poll_schedule)
+    logging.info("Settings reloaded")
+    display_settings(config)
+
+
+def exporter(config=None):
+    global settings, signing_keys, http_session, governor
+    settings = config = config or load_settings()
     output_release_notes()
-    display_settings()
-    interval_rate_check()
-    api_connection = octopus_api_connection(api_key=Settings().api_key)
-    get_device_id(api_connection, Settings().gas, Settings().electric)
-    for meter in meters:
-        logging.info("Starting to read {} meter every {} seconds".format(meter.meter_type, meter.polling_interval))
-    start_prometheus_server()
-    read_meters(api_connection)
+    display_settings(config)
+    interval_rate_check(config)
+    tariffs.ttl = config.tariff_ttl
+    forecasts.slots = config.forecast_slots
+    usage.size = config.usage_history
+    rediscovery.set_interval(config.rediscovery_interval)
+    http_session = build_session(config.workers)
+    governor = rate_governor(config.rate_limit, config.rate_burst)
+    signing_keys = jwks_cache(config.jwks_url, config.jwks_file, config.jwks_ttl, session=http_session)
+    if config.state_file:
+        open_state(config.state_file)
+    accounts = configured_accounts(config)
+    if len(accounts) == 1:
+        # There is nothing to poll without the only account, so failing to start it is raised
+        start_account(config, accounts[0])
+        accounts = []
+    start_prometheus_server(config)
+    reloads = reload_trigger(watched_files(config))
+    reloads.install()
+    read_meters(reloads, accounts)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,67 @@
+import threading
+import time
+from metrics import api_request_budget, api_request_rate
+
+
+class rate_governor:
+    """Token bucket shared by every request to the API. The refill rate adapts AIMD style: it is cut by decrease
+    whenever the API reports a rate limit and grows back by increase per successful request, up to max_rate."""
+
+    def __init__(self, max_rate=1.0, burst=10, min_rate=0.01, increase=0.02, decrease=0.5, clock=time.monotonic):
+        self.max_rate = max_rate
+        self.rate = max_rate
+        self.burst = burst
+        self.min_rate = min_rate
+        self.increase = increase
+        self.decrease = decrease
+        self.clock = clock
+        self.tokens = float(burst)
+        self.updated = clock()
+        self.paused_until = 0.0
+        self._lock = threading.Lock()
+        api_request_rate.set(self.rate)
+        api_request_budget.set(self.tokens)
+
+    def reconfigure(self, max_rate, burst):
+        with self._lock:
+            self._refill(self.clock())
+            self.max_rate = max_rate
+            self.rate = min(self.rate, max_rate)
+            self.burst = burst
+            self.tokens = min(self.tokens, burst)
+            api_request_rate.set(self.rate)
+
+    def _refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def reserve(self):
+        """Takes a token and returns how long the caller must wait before using it. Waiting callers hold a
+        reservation, so the bucket goes negative rather than letting them race for the next token."""
+        with self._lock:
+            now = self.clock()
+            self._refill(now)
+            self.tokens -= 1
+            api_request_budget.set(max(self.tokens, 0))
+            return max(0.0, -self.tokens / self.rate, self.paused_until - now)
+
+    def acquire(self, sleep=time.sleep):
+        wait = self.reserve()
+        if wait:
+            sleep(wait)
+
+    def on_success(self):
+        with self._lock:
+            self.rate = min(self.max_rate, self.rate + self.increase)
+            api_request_rate.set(self.rate)
+
+    def on_rate_limited(self, retry_after=None):
+        with self._lock:
+            now = self.clock()
+            self._refill(now)
+            self.rate = max(self.min_rate, self.rate * self.decrease)
+            self.tokens = min(self.tokens, 0.0)
+            # Nothing is sent until the API should have recovered
+            self.paused_until = max(self.paused_until, now + (retry_after if retry_after is not None else 1 / self.rate))
+            api_request_rate.set(self.rate)
+            api_request_budget.set(0)
@@ -0,0 +1,27 @@
+from array import array
+from bisect import bisect_right
+from utils import from_iso_timestamp
+
+
+class unit_rate_index:
+    """Half hourly unit rates parsed once into parallel arrays of epoch boundaries, sorted by start."""
+
+    def __init__(self, unit_rates):
+        rates = sorted((from_iso_timestamp(rate["validFrom"]), from_iso_timestamp(rate["validTo"]), float(rate["value"]))
+                       for rate in unit_rates)
+        self.starts = array("d", (rate[0] for rate in rates))
+        self.ends = array("d", (rate[1] for rate in rates))
+        self.values = array("d", (rate[2] for rate in rates))
+
+    def __len__(self):
+        return len(self.starts)
+
+    def slot_at(self, timestamp):
+        index = bisect_right(self.starts, timestamp) - 1
+        if index >= 0 and timestamp < self.ends[index]:
+            return index
+        return None
+
+    def rate_at(self, timestamp):
+        index = self.slot_at(timestamp)
+        return None if index is None else self.values[index]
@@ -0,0 +1,71 @@
+import threading
+import time
+from prometheus_client.core import GaugeMetricFamily
+from prometheus_client.registry import Collector
+from gauge_definitions import GaugeDefinitions
+
+# Key in a meter's readings holding the telemetry's readAt, in epoch seconds
+READ_AT = "read_at"
+
+# Readings measured by the meter, stamped with readAt. Tariff readings describe the present and carry no timestamp.
+TELEMETRY_READINGS = ("consumption", "demand")
+
+LABELS = ("device_id", "meter_type")
+
+
+class reading_collector(Collector):
+    """The latest reading of every meter, exposed as oe_meter_* samples carrying the telemetry's own timestamp.
+    Telemetry older than stale_after is no longer exposed, as Prometheus would reject samples that far back."""
+
+    def __init__(self, stale_after=3600, clock=time.time):
+        self.stale_after = stale_after
+        self.clock = clock
+        self._latest = {}
+        self._lock = threading.Lock()
+
+    def update(self, meter, readings):
+        """Records the readings of meter, returning False when they are the same as the last ones recorded."""
+        values = {}
+        for reading, value in readings.items():
+            if reading in meter.reading_types:
+                try:
+                    values[reading] = float(value)
+                except (TypeError, ValueError):
+                    pass
+        labels = meter.return_labels()
+        entry = (tuple(labels.get(name, "") for name in LABELS), values, readings.get(READ_AT))
+        key = (meter.device_id, meter.meter_type)
+        with self._lock:
+            if self._latest.get(key) == entry:
+                return False
+            self._latest[key] = entry
+        return True
+
+    def remove(self, meter):
+        with self._lock:
+            self._latest.pop((meter.device_id, meter.meter_type), None)
+
+    def describe(self):
+        return []
+
+    def collect(self):
+        now = self.clock()
+        families = {}
+        age = GaugeMetricFamily("oe_meter_reading_age_seconds", "Seconds since the meter's latest telemetry was read", labels=LABELS)
+        with self._lock:
+            latest = list(self._latest.values())
+        for label_values, values, read_at in latest:
+            fresh = read_at is not None and now - read_at < self.stale_after
+            if read_at is not None:
+                age.add_metric(label_values, max(0.0, now - read_at))
+            for reading, value in values.items():
+                timestamp = None
+                if reading in TELEMETRY_READINGS:
+                    if read_at is not None and not fresh:
+                        continue
+                    timestamp = read_at
+                if reading not in families:
+                    families[reading] = GaugeMetricFamily("oe_meter_{}".format(reading), GaugeDefinitions[reading].value, labels=LABELS)
+                families[reading].add_metric(label_values, value, timestamp=timestamp)
+        yield from families.values()
+        yield age
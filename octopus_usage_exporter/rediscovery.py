@@ -0,0 +1,55 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+
+class rediscovery_schedule:
+    """Decides when accounts are rediscovered: all of them every interval seconds, and sooner for accounts whose
+    agreement was found revoked, at most once per backoff. Rediscovery runs on its own thread, one at a time, so
+    polling carries on meanwhile."""
+
+    def __init__(self, interval=21600, backoff=900, clock=time.monotonic):
+        self.interval = interval
+        self.backoff = backoff
+        self.clock = clock
+        self.next_full = clock() + interval
+        self.next_early = clock()
+        self.stale = set()
+        self.running = None
+        self._lock = threading.Lock()
+        self._executor = None
+
+    def set_interval(self, interval):
+        if interval != self.interval:
+            self.interval = interval
+            self.next_full = self.clock() + interval
+
+    def request(self, account_number):
+        with self._lock:
+            self.stale.add(account_number)
+
+    def poll(self, run):
+        """Starts run(account_numbers) in the background if a rediscovery is due. account_numbers is None for all."""
+        if self.running is not None and not self.running.done():
+            return None
+        now = self.clock()
+        with self._lock:
+            if self.interval and now >= self.next_full:
+                account_numbers = None
+                self.next_full = now + self.interval
+                self.stale.clear()
+            elif self.stale and now >= self.next_early:
+                account_numbers = set(self.stale)
+                self.stale.clear()
+            else:
+                return None
+            self.next_early = now + self.backoff
+        return self.submit(run, account_numbers)
+
+    def submit(self, run, *args):
+        """Runs run(*args) on the rediscovery thread, after any rediscovery already started. Polls for rediscovery
+        wait until it has finished."""
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="meter-discovery")
+        self.running = self._executor.submit(run, *args)
+        return self.running
@@ -0,0 +1,42 @@
+import logging
+import os
+import signal
+import threading
+
+
+def modified_time(path):
+    try:
+        return os.stat(path).st_mtime_ns
+    except OSError:
+        return None
+
+
+class reload_trigger:
+    """Reload requests from SIGHUP or from a change to any watched file. The poll loop checks pending() each time it
+    wakes, so a reload is applied between polls and within a heartbeat of being requested."""
+
+    def __init__(self, paths=()):
+        self._requested = threading.Event()
+        self._mtimes = {}
+        self.watch(paths)
+
+    def watch(self, paths):
+        self._mtimes = {path: modified_time(path) for path in paths if path}
+
+    def install(self):
+        # Signal handlers can only be set from the main thread, and SIGHUP does not exist on Windows
+        if hasattr(signal, "SIGHUP") and threading.current_thread() is threading.main_thread():
+            signal.signal(signal.SIGHUP, lambda signum, frame: self.request())
+
+    def request(self):
+        self._requested.set()
+
+    def pending(self):
+        changed = [path for path, mtime in self._mtimes.items() if modified_time(path) != mtime]
+        for path in changed:
+            logging.info("{} has changed".format(path))
+            self._mtimes[path] = modified_time(path)
+        if self._requested.is_set():
+            self._requested.clear()
+            return True
+        return bool(changed)
@@ -0,0 +1,112 @@
+import heapq
+import itertools
+import random
+import threading
+import time
+from metrics import scheduling_lag
+
+
+class meter_scheduler:
+    """Min-heap of meters keyed on the monotonic time their next poll is due.
+
+    Polls are planned against a nominal timeline (previous nominal + polling_interval) so
+    API latency never accumulates into drift. Jitter is a random phase, up to a fraction of
+    the polling interval, drawn once per account. That spreads a fleet's polls apart while
+    meters on the same account stay aligned and can be fetched in one batched request.
+    """
+
+    def __init__(self, jitter=0.0, clock=time.monotonic, coalesce=1.0):
+        self.jitter = jitter
+        self.clock = clock
+        self.coalesce = coalesce
+        self._phases = {}
+        # Meters popped by pop_due whose poll has not rescheduled them yet, and those of them removed meanwhile.
+        # Both hold the meter itself, so an id is never matched against a different meter that reused it
+        self._in_flight = {}
+        self._removed = {}
+        self._heap = []
+        self._sequence = itertools.count()
+        self._condition = threading.Condition()
+
+    def __len__(self):
+        with self._condition:
+            return len(self._heap)
+
+    def _jitter_for(self, meter):
+        if not self.jitter:
+            return 0.0
+        account_number = getattr(meter, "account_number", None)
+        if account_number not in self._phases:
+            self._phases[account_number] = random.uniform(0, self.jitter)
+        return self._phases[account_number] * meter.polling_interval
+
+    def schedule(self, meter, nominal):
+        due = nominal + self._jitter_for(meter)
+        with self._condition:
+            if self._in_flight.get(id(meter)) is meter:
+                del self._in_flight[id(meter)]
+            if self._removed.get(id(meter)) is meter:
+                # The in flight poll of a removed meter finished, nothing refers to it any more
+                del self._removed[id(meter)]
+                return None
+            heapq.heappush(self._heap, (due, next(self._sequence), meter, nominal))
+            self._condition.notify()
+        return due
+
+    def schedule_after(self, meter, delay):
+        return self.schedule(meter, self.clock() + max(0.0, delay))
+
+    def reschedule(self, meter, nominal):
+        nominal += meter.polling_interval
+        now = self.clock()
+        if nominal < now:
+            # The poll overran one or more intervals, skip the missed slots rather than bursting
+            missed = int((now - nominal) // meter.polling_interval) + 1
+            nominal += missed * meter.polling_interval
+        return self.schedule(meter, nominal)
+
+    def remove(self, meter):
+        """Stops polling meter. A poll already in flight is not rescheduled when it finishes."""
+        with self._condition:
+            self._heap = [entry for entry in self._heap if entry[2] is not meter]
+            heapq.heapify(self._heap)
+            if self._in_flight.get(id(meter)) is meter:
+                self._removed[id(meter)] = meter
+
+    def replan(self, meter, delay):
+        """Moves the next poll of a waiting meter to delay seconds from now, for example after its polling interval
+        changed. A meter whose poll is in flight is planned from its new interval when that poll finishes."""
+        with self._condition:
+            if self._in_flight.get(id(meter)) is meter or not any(entry[2] is meter for entry in self._heap):
+                return None
+            self._heap = [entry for entry in self._heap if entry[2] is not meter]
+            heapq.heapify(self._heap)
+        return self.schedule_after(meter, delay)
+
+    def next_due(self):
+        with self._condition:
+            return self._heap[0][0] if self._heap else None
+
+    def pop_due(self, timeout=None):
+        """Block until at least one meter is due, then return every (meter, nominal) pair due
+        within the coalescing window, so near-simultaneous polls share a request."""
+        deadline = None if timeout is None else self.clock() + timeout
+        with self._condition:
+            while True:
+                now = self.clock()
+                if self._heap and self._heap[0][0] <= now:
+                    break
+                wake_at = self._heap[0][0] if self._heap else None
+                if deadline is not None:
+                    if now >= deadline:
+                        return []
+                    wake_at = deadline if wake_at is None else min(wake_at, deadline)
+                self._condition.wait(None if wake_at is None else wake_at - now)
+
+            due = []
+            while self._heap and self._heap[0][0] <= now + self.coalesce:
+                due_at, _, meter, nominal = heapq.heappop(self._heap)
+                scheduling_lag.observe(max(0.0, now - due_at))
+                self._in_flight[id(meter)] = meter
+                due.append((meter, nominal))
+            return due
@@ -0,0 +1,108 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS accounts (
+    account_number TEXT PRIMARY KEY,
+    response TEXT NOT NULL,
+    fetched_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS tariffs (
+    key TEXT PRIMARY KEY,
+    agreement TEXT NOT NULL,
+    expiry REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS tokens (
+    api_key_hash TEXT PRIMARY KEY,
+    token TEXT NOT NULL,
+    expiry REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS polls (
+    device_id TEXT NOT NULL,
+    meter_type TEXT NOT NULL,
+    last_called REAL NOT NULL,
+    readings TEXT NOT NULL,
+    PRIMARY KEY (device_id, meter_type)
+);
+"""
+
+
+def api_key_hash(api_key):
+    # Tokens are looked up by key, but the key itself is never written to disk
+    return hashlib.sha256(api_key.encode()).hexdigest()
+
+
+class state_store:
+    """Restart state kept in a single SQLite file: account discovery responses, cached agreements, tokens and each meter's last poll."""
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        # The -wal and -shm files hold the same tokens as the database, so all three are created owner only
+        previous_umask = os.umask(0o077)
+        try:
+            self._db = sqlite3.connect(path, check_same_thread=False)
+            with self._lock, self._db:
+                self._db.execute("PRAGMA journal_mode=WAL")
+                self._db.execute("PRAGMA synchronous=NORMAL")
+                self._db.executescript(SCHEMA)
+        finally:
+            os.umask(previous_umask)
+        # Files left by earlier versions may have been created with wider permissions
+        for restricted in (path, path + "-wal", path + "-shm"):
+            try:
+                os.chmod(restricted, 0o600)
+            except OSError:
+                pass
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+    def save_account(self, account_number, response, fetched_at):
+        with self._lock, self._db:
+            self._db.execute("INSERT OR REPLACE INTO accounts VALUES (?, ?, ?)", (account_number, json.dumps(response), fetched_at))
+
+    def load_account(self, account_number, fetched_after):
+        """The account discovery response saved for account_number, unless it was fetched before fetched_after."""
+        with self._lock:
+            row = self._db.execute("SELECT response FROM accounts WHERE account_number = ? AND fetched_at >= ?",
+                                   (account_number, fetched_after)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def save_tariff(self, key, agreement, expiry):
+        with self._lock, self._db:
+            self._db.execute("INSERT OR REPLACE INTO tariffs VALUES (?, ?, ?)", (json.dumps(key), json.dumps(agreement), expiry))
+
+    def load_tariffs(self, now):
+        """(key, agreement, expiry) for every cached agreement still valid at now, expired rows are dropped."""
+        with self._lock, self._db:
+            self._db.execute("DELETE FROM tariffs WHERE expiry <= ?", (now,))
+            rows = self._db.execute("SELECT key, agreement, expiry FROM tariffs").fetchall()
+        return [(tuple(json.loads(key)), json.loads(agreement), expiry) for key, agreement, expiry in rows]
+
+    def save_token(self, api_key, token, expiry):
+        with self._lock, self._db:
+            self._db.execute("INSERT OR REPLACE INTO tokens VALUES (?, ?, ?)", (api_key_hash(api_key), token, expiry))
+
+    def load_token(self, api_key, valid_until):
+        """The stored token for api_key as (token, expiry), provided it is still valid at valid_until."""
+        with self._lock:
+            return self._db.execute("SELECT token, expiry FROM tokens WHERE api_key_hash = ? AND expiry > ?",
+                                    (api_key_hash(api_key), valid_until)).fetchone()
+
+    def record_polls(self, polled):
+        """polled is a list of (meter, readings) from one request, written in a single transaction."""
+        with self._lock, self._db:
+            self._db.executemany("INSERT OR REPLACE INTO polls VALUES (?, ?, ?, ?)",
+                                 [(meter.device_id, meter.meter_type, meter.last_called.timestamp(), json.dumps(readings)) for meter, readings in polled])
+
+    def load_poll(self, meter):
+        """(last_called epoch, readings) from the meter's last successful poll, or None."""
+        with self._lock:
+            row = self._db.execute("SELECT last_called, readings FROM polls WHERE device_id = ? AND meter_type = ?",
+                                   (meter.device_id, meter.meter_type)).fetchone()
+        return (row[0], json.loads(row[1])) if row else None
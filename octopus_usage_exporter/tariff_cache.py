@@ -0,0 +1,66 @@
+import threading
+import time
+from utils import from_iso_timestamp
+from rate_index import unit_rate_index
+
+
+def agreement_key(meter):
+    return (meter.agreement_operation, meter.agreement)
+
+
+def build_rate_index(agreement):
+    unit_rates = (agreement.get("tariff") or {}).get("unitRates")
+    return unit_rate_index(unit_rates) if unit_rates else None
+
+
+def agreement_expiry(agreement, ttl, now, rate_index=None):
+    # Never serve an agreement past its own validTo, nor a half hourly tariff past its last published rate
+    expiry = now + ttl
+    if agreement.get("validTo"):
+        expiry = min(expiry, from_iso_timestamp(agreement["validTo"]))
+    if rate_index:
+        expiry = min(expiry, max(rate_index.ends))
+    return expiry
+
+
+class tariff_cache:
+    def __init__(self, ttl=3600, clock=time.time):
+        self.ttl = ttl
+        self.clock = clock
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            agreement, expiry, _ = entry
+            if expiry <= self.clock():
+                del self._entries[key]
+                return None
+            return agreement
+
+    def rate_index(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            return entry[2] if entry else None
+
+    def put(self, key, agreement, expiry=None):
+        """Caches agreement until expiry, by default derived from the ttl and the agreement itself. Returns the expiry."""
+        if agreement is None:
+            return None
+        # Half hourly rates are indexed once per fetch rather than scanned on every poll
+        rate_index = build_rate_index(agreement)
+        if expiry is None:
+            expiry = agreement_expiry(agreement, self.ttl, self.clock(), rate_index)
+        with self._lock:
+            self._entries[key] = (agreement, expiry, rate_index)
+        return expiry
+
+    def invalidate(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
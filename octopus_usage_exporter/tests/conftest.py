@@ -0,0 +1,13 @@
+from prometheus_client import REGISTRY
+
+
+class FakeClock:
+    def __init__(self, now=0.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+def sample(name, meter, **labels):
+    return REGISTRY.get_sample_value(name, dict(device_id=meter.device_id, meter_type=meter.meter_type, **labels))
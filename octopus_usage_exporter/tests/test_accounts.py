@@ -0,0 +1,44 @@
+import json
+import pytest
+from types import SimpleNamespace
+from octopus_usage_exporter import accounts
+
+
+def make_settings(**overrides):
+    settings = dict(accounts_file=None, account_number=None, api_key=None, gas=False, electric=True)
+    settings.update(overrides)
+    return SimpleNamespace(**settings)
+
+
+def test_load_accounts_list_and_mapping(tmp_path):
+    entries = [{"account_number": "A-1", "api_key": "k1", "gas": True}, {"account_number": "A-2", "api_key": "k1"}]
+    list_file = tmp_path / "list.json"
+    list_file.write_text(json.dumps(entries))
+    mapping_file = tmp_path / "mapping.json"
+    mapping_file.write_text(json.dumps({"accounts": entries}))
+
+    for path in (list_file, mapping_file):
+        loaded = accounts.load_accounts(str(path))
+        assert [a.account_number for a in loaded] == ["A-1", "A-2"]
+        assert loaded[0].gas is True
+        assert loaded[1].gas is None
+
+
+def test_configured_accounts_inherits_fuel_settings(tmp_path):
+    path = tmp_path / "accounts.json"
+    path.write_text(json.dumps([{"account_number": "A-1", "api_key": "k1", "gas": True}]))
+    loaded = accounts.configured_accounts(make_settings(accounts_file=str(path)))
+    assert loaded[0].gas is True
+    assert loaded[0].electric is True
+
+
+def test_configured_accounts_single_account_from_settings():
+    loaded = accounts.configured_accounts(make_settings(account_number="A-9", api_key="k9"))
+    assert len(loaded) == 1
+    assert loaded[0].account_number == "A-9"
+    assert loaded[0].api_key == "k9"
+
+
+def test_configured_accounts_requires_credentials():
+    with pytest.raises(Exception):
+        accounts.configured_accounts(make_settings())
@@ -0,0 +1,73 @@
+import io
+from datetime import datetime, timedelta, timezone
+from unittest.mock import MagicMock
+from octopus_usage_exporter import backfill
+from octopus_usage_exporter.electric_meter import electric_meter
+
+START = datetime(2026, 1, 1, tzinfo=timezone.utc)
+
+
+def rows_for(variables):
+    start = datetime.fromisoformat(variables["start"])
+    return {"smartMeterTelemetry": [
+        {"readAt": (start + timedelta(hours=h)).isoformat(), "consumption": 100.0 + h, "demand": None}
+        for h in range(0, 12, 6)
+    ]}
+
+
+def test_telemetry_windows_cover_range_without_overlap():
+    windows = list(backfill.telemetry_windows(START, START + timedelta(hours=30), timedelta(hours=12)))
+    assert windows == [(START, START + timedelta(hours=12)),
+                       (START + timedelta(hours=12), START + timedelta(hours=24)),
+                       (START + timedelta(hours=24), START + timedelta(hours=30))]
+
+
+def test_backfill_writes_sorted_openmetrics_and_resumes_from_checkpoints(tmp_path):
+    meter = electric_meter(device_id="00-AA", meter_type="electric")
+    client = MagicMock()
+    client.execute.side_effect = lambda query, variable_values: rows_for(variable_values)
+    checkpoints = backfill.checkpoint_store(str(tmp_path))
+
+    history = backfill.backfill([(client, meter)], START, START + timedelta(days=2), "THIRTY_MINUTES",
+                                timedelta(hours=12), 2, checkpoints)
+    assert client.execute.call_count == 4
+    assert client.execute.call_args.kwargs["variable_values"]["grouping"] == "THIRTY_MINUTES"
+
+    output = io.StringIO()
+    backfill.write_openmetrics(output, [meter], history)
+    lines = output.getvalue().splitlines()
+    samples = [line for line in lines if line.startswith("oe_meter_consumption{")]
+    assert len(samples) == 8
+    timestamps = [float(line.split()[-1]) for line in samples]
+    assert timestamps == sorted(timestamps)
+    assert samples[0] == 'oe_meter_consumption{{device_id="00-AA",meter_type="electric"}} 100.0 {}'.format(START.timestamp())
+    assert not any(line.startswith("oe_meter_demand{") for line in lines)
+    assert lines[-1] == "# EOF"
+
+    client.execute.reset_mock()
+    resumed = backfill.backfill([(client, meter)], START, START + timedelta(days=2), "THIRTY_MINUTES",
+                                timedelta(hours=12), 2, checkpoints)
+    client.execute.assert_not_called()
+    assert len(resumed["00-AA"]) == 8
+
+
+def test_checkpoints_are_keyed_by_whole_window_and_skip_unfinished_windows(tmp_path):
+    meter = electric_meter(device_id="00-AA", meter_type="electric")
+    client = MagicMock()
+    client.execute.side_effect = lambda query, variable_values: rows_for(variable_values)
+    checkpoints = backfill.checkpoint_store(str(tmp_path))
+    backfill.backfill([(client, meter)], START, START + timedelta(days=1), "THIRTY_MINUTES", timedelta(hours=12), 2, checkpoints)
+
+    # A different chunk size or grouping fetches its own windows rather than reusing these
+    client.execute.reset_mock()
+    backfill.backfill([(client, meter)], START, START + timedelta(days=1), "THIRTY_MINUTES", timedelta(hours=6), 2, checkpoints)
+    assert client.execute.call_count == 4
+    client.execute.reset_mock()
+    backfill.backfill([(client, meter)], START, START + timedelta(days=1), "ONE_HOUR", timedelta(hours=12), 2, checkpoints)
+    assert client.execute.call_count == 2
+
+    now = datetime.now(timezone.utc).replace(microsecond=0)
+    client.execute.reset_mock()
+    backfill.backfill([(client, meter)], now - timedelta(hours=12), now + timedelta(hours=12), "THIRTY_MINUTES", timedelta(hours=12), 2, checkpoints)
+    assert checkpoints.load("00-AA", now - timedelta(hours=12), now, "THIRTY_MINUTES") is not None
+    assert checkpoints.load("00-AA", now, now + timedelta(hours=12), "THIRTY_MINUTES") is None
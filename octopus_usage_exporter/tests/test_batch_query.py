@@ -0,0 +1,59 @@
+from graphql import print_ast
+from octopus_usage_exporter.batch_query import build_batch_query, split_batch_response, failed_aliases
+from octopus_usage_exporter.electric_meter import electric_meter
+from octopus_usage_exporter.gas_meter import gas_meter
+
+
+def make_meters():
+    return [
+        electric_meter(device_id="e-1", meter_type="electric", agreement=10),
+        electric_meter(device_id="e-2", meter_type="electric", agreement=10),
+        gas_meter(device_id="g-1", meter_type="gas", agreement=20),
+    ]
+
+
+def test_build_batch_query_aliases_each_meter_and_only_stale_agreements():
+    stale = [("GasAgreement", 20)]
+    query, variables = build_batch_query(make_meters(), stale)
+    printed = print_ast(query.document)
+    assert "t0: smartMeterTelemetry(deviceId: $d0)" in printed
+    assert "t2: smartMeterTelemetry(deviceId: $d2)" in printed
+    assert "a0: gasAgreement(id: $a0)" in printed
+    assert "electricityAgreement" not in printed
+    assert variables == {"d0": "e-1", "d1": "e-2", "d2": "g-1", "a0": 20}
+
+
+def test_build_batch_query_telemetry_only_when_all_agreements_cached():
+    query, variables = build_batch_query(make_meters())
+    printed = print_ast(query.document)
+    assert "Agreement" not in printed
+    assert "tariff" not in printed
+    assert variables == {"d0": "e-1", "d1": "e-2", "d2": "g-1"}
+
+
+def test_split_batch_response_merges_cached_and_fetched_agreements():
+    meters = make_meters()
+    stale = [("GasAgreement", 20)]
+    agreements = {("ElectricityAgreement", 10): {"isRevoked": False}, ("GasAgreement", 20): None}
+    response = {"t0": [{"consumption": 1}], "t1": [{"consumption": 2}], "t2": [{"consumption": 3}],
+                "a0": {"isRevoked": True}}
+    split = split_batch_response(meters, stale, response, agreements)
+    assert split[1] == (meters[1], {"smartMeterTelemetry": [{"consumption": 2}], "electricityAgreement": {"isRevoked": False}})
+    assert split[2] == (meters[2], {"smartMeterTelemetry": [{"consumption": 3}], "gasAgreement": {"isRevoked": True}})
+    assert agreements[("GasAgreement", 20)] == {"isRevoked": True}
+
+
+def test_failed_aliases_come_from_error_paths():
+    assert failed_aliases([{"message": "x", "path": ["t1", 0]}, {"message": "y", "path": ["a0"]}]) == {"t1", "a0"}
+    # An error without a path is not tied to any meter, so the whole query failed
+    assert failed_aliases([{"message": "x", "path": ["t1"]}, {"message": "denied"}]) is None
+
+
+def test_split_batch_response_leaves_out_failed_aliases():
+    meters = make_meters()
+    stale = [("ElectricityAgreement", 10), ("GasAgreement", 20)]
+    agreements = dict.fromkeys(stale)
+    response = {"t0": [{"consumption": 1}], "t1": None, "t2": [{"consumption": 3}], "a0": {"isRevoked": False}, "a1": None}
+    split = split_batch_response(meters, stale, response, agreements, {"t1", "a1"})
+    assert [meter.device_id for meter, _ in split] == ["e-1"]
+    assert agreements == {("ElectricityAgreement", 10): {"isRevoked": False}, ("GasAgreement", 20): None}
@@ -0,0 +1,63 @@
+import pytest
+from datetime import datetime, timedelta, timezone
+from zoneinfo import ZoneInfo
+from octopus_usage_exporter.cost_engine import cost_engine, day_bounds
+from octopus_usage_exporter.electric_meter import electric_meter
+from octopus_usage_exporter.gas_meter import gas_meter
+from octopus_usage_exporter.rate_index import unit_rate_index
+from octopus_usage_exporter.usage_history import usage_tracker
+from octopus_usage_exporter.tests.conftest import sample
+
+MIDNIGHT = datetime(2026, 1, 1, tzinfo=timezone.utc).timestamp()
+
+
+def reading(read_at, consumption, delta, cost, **extra):
+    return dict(read_at=read_at, consumption=consumption, consumption_delta=delta, cost_delta=cost, **extra)
+
+
+def test_day_bounds_follow_local_midnight_over_dst():
+    london = ZoneInfo("Europe/London")
+    start, end = day_bounds(datetime(2026, 3, 29, 12, tzinfo=london).timestamp(), london)
+    assert start == datetime(2026, 3, 29, tzinfo=london).timestamp()
+    assert end - start == 23 * 3600
+    assert day_bounds(MIDNIGHT + 60, timezone.utc) == (MIDNIGHT, MIDNIGHT + 86400)
+
+
+def test_spend_from_demand_at_the_slot_rate_and_day_cost_with_standing_charge():
+    meter = electric_meter(device_id="cost-1", meter_type="electric")
+    usage = usage_tracker(size=64)
+    costs = cost_engine(usage, zone=timezone.utc)
+    index = unit_rate_index([{"validFrom": datetime.fromtimestamp(MIDNIGHT + 1800 * i, timezone.utc).isoformat(),
+                              "validTo": datetime.fromtimestamp(MIDNIGHT + 1800 * (i + 1), timezone.utc).isoformat(),
+                              "value": 10.0 + i} for i in range(48)])
+
+    # The last reading of yesterday is not part of today's cost
+    yesterday = reading(MIDNIGHT - 60, 100.0, 1.0, 30.0, demand=0)
+    usage.update(meter, yesterday)
+    costs.update(meter, yesterday, index)
+
+    today = reading(MIDNIGHT + 12 * 3600, 102.0, 0.5, 20.0, demand=2000, tariff_unit_rate=99.0, tariff_standing_charge=50.0)
+    usage.update(meter, today)
+    costs.update(meter, today, index)
+
+    # Noon falls in slot 24, 2 kW at 34p
+    assert sample("oe_meter_spend_rate", meter) == 68.0
+    # 2 kWh since yesterday's reading, costed at the 40p/kWh of the latest delta, less the share used before midnight
+    today_cost = 80.0 * 43200 / 43260 + 50.0
+    assert sample("oe_meter_cost_today", meter) == pytest.approx(today_cost)
+    assert sample("oe_meter_cost_today_projected", meter) == pytest.approx(today_cost + 68.0 * 12)
+
+
+def test_gas_without_demand_spends_at_the_last_hours_rate():
+    meter = gas_meter(device_id="cost-2", meter_type="gas")
+    usage = usage_tracker(size=64)
+    costs = cost_engine(usage, zone=timezone.utc)
+    for minutes, consumption in ((0, 10.0), (30, 10.5), (60, 11.0)):
+        readings = reading(MIDNIGHT + 3600 + minutes * 60, consumption, 0.5, 3.0, tariff_unit_rate=6.0)
+        usage.update(meter, readings)
+        costs.update(meter, readings)
+    assert sample("oe_meter_spend_rate", meter) == 6.0
+    assert sample("oe_meter_cost_today", meter) == 9.0
+
+    costs.remove(meter)
+    assert sample("oe_meter_spend_rate", meter) is None
@@ -0,0 +1,46 @@
+from graphql import print_ast
+from octopus_usage_exporter import documents
+
+
+def test_registry_loads_every_operation():
+    for name in ("ObtainKrakenToken", "Account",
+                 "SmartMeterTelemetry", "ElectricityAgreement", "GasAgreement"):
+        assert documents.get_document(name).definitions[0].name.value == name
+
+
+def test_get_request_returns_the_cached_document():
+    first = documents.get_request("GasAgreement")
+    assert documents.get_request("GasAgreement") is first
+    assert documents.get_document("GasAgreement") is first.document
+
+
+def test_bind_reuses_printed_query():
+    request = documents.get_request("ObtainKrakenToken")
+    bound = documents.bind(request, {"apiKey": "key"})
+    assert bound.document is request.document
+    assert bound.payload == {"query": request.query_string, "variables": {"apiKey": "key"}}
+    assert request.variable_values is None
+
+
+def test_bind_accepts_query_strings():
+    bound = documents.bind("query Q { viewer { id } }", {"x": 1})
+    assert bound.variable_values == {"x": 1}
+    assert "viewer" in bound.payload["query"]
+
+
+def test_meter_request_combines_telemetry_and_agreement():
+    request = documents.meter_request("ElectricityAgreement")
+    assert documents.meter_request("ElectricityAgreement") is request
+    printed = print_ast(request.document)
+    assert "query TariffsandMeterReadings($deviceId: String!, $agreementId: ID!)" in printed
+    assert "smartMeterTelemetry(deviceId: $deviceId)" in printed
+    assert "electricityAgreement(id: $agreementId)" in printed
+
+
+def test_batch_request_is_cached_per_shape():
+    batch = documents.batch_request(2, ("GasAgreement",))
+    assert documents.batch_request(2, ("GasAgreement",)) is batch
+    printed = print_ast(batch.document)
+    assert "query BatchedMeterReadings($d0: String!, $d1: String!, $a0: ID!)" in printed
+    assert "t1: smartMeterTelemetry(deviceId: $d1)" in printed
+    assert "a0: gasAgreement(id: $a0)" in printed
@@ -0,0 +1,61 @@
+from array import array
+from datetime import datetime, timedelta, timezone
+from octopus_usage_exporter.electric_meter import electric_meter
+from octopus_usage_exporter.forecast import price_forecast, summarise_windows
+from octopus_usage_exporter.rate_index import unit_rate_index
+from octopus_usage_exporter.tests.conftest import sample
+
+START = datetime(2026, 1, 1, tzinfo=timezone.utc)
+
+
+def make_index(values):
+    return unit_rate_index([{"validFrom": (START + timedelta(minutes=30 * i)).isoformat(),
+                             "validTo": (START + timedelta(minutes=30 * (i + 1))).isoformat(),
+                             "value": value} for i, value in enumerate(values)])
+
+
+def test_summarise_windows_min_avg_argmin():
+    values = array("d", [30, 20, 10, 40] * 12)
+    summaries = summarise_windows(values)
+    assert summaries["4h"] == (10, 25, 2)
+    assert summaries["24h"] == (10, 25, 2)
+    # Windows that reach past the end of the known rates are left out rather than summarised from fewer slots
+    assert summarise_windows(array("d", [5, 1] * 6)) == {"4h": (1, 3, 1)}
+    assert summarise_windows(array("d", [9] * 40 + [5, 1] * 4), 40) == {"4h": (1, 3, 1)}
+
+
+def test_windows_use_every_known_rate_beyond_the_published_curve():
+    meter = electric_meter(device_id="forecast-2", meter_type="electric")
+    forecast = price_forecast(slots=4)
+    forecast.update(meter, make_index([20] * 20 + [5] + [20] * 27), START.timestamp())
+    assert sample("oe_meter_tariff_unit_rate_forecast", meter, slot="4") is None
+    assert sample("oe_meter_tariff_unit_rate_window_min", meter, window="4h") == 20
+    assert sample("oe_meter_tariff_unit_rate_window_min", meter, window="24h") == 5
+    assert sample("oe_meter_tariff_unit_rate_window_argmin", meter, window="24h") == 20
+
+    # Half an hour later fewer than 48 rates are left, so the 24h window is withdrawn
+    forecast.update(meter, make_index([20] * 20 + [5] + [20] * 27), (START + timedelta(minutes=30)).timestamp())
+    assert sample("oe_meter_tariff_unit_rate_window_min", meter, window="24h") is None
+    assert sample("oe_meter_tariff_unit_rate_window_min", meter, window="8h") == 20
+
+
+def test_update_publishes_curve_from_current_slot_and_drops_expired_slots():
+    meter = electric_meter(device_id="forecast-1", meter_type="electric")
+    forecast = price_forecast(slots=4)
+    index = make_index([10, 11, 12, 13, 14, 15, 16, 17, 18, 19])
+
+    forecast.update(meter, index, (START + timedelta(minutes=40)).timestamp())
+    assert [sample("oe_meter_tariff_unit_rate_forecast", meter, slot=str(s)) for s in range(4)] == [11, 12, 13, 14]
+    assert sample("oe_meter_tariff_unit_rate_window_min", meter, window="4h") == 11
+    assert sample("oe_meter_tariff_unit_rate_window_argmin", meter, window="4h") == 0
+
+    forecast.update(meter, index, (START + timedelta(hours=2, minutes=10)).timestamp())
+    assert [sample("oe_meter_tariff_unit_rate_forecast", meter, slot=str(s)) for s in range(4)] == [14, 15, 16, 17]
+    assert sample("oe_meter_tariff_unit_rate_window_min", meter, window="4h") is None
+
+    forecast.update(meter, index, (START + timedelta(hours=4)).timestamp())
+    assert [sample("oe_meter_tariff_unit_rate_forecast", meter, slot=str(s)) for s in range(4)] == [18, 19, None, None]
+
+    forecast.update(meter, index, (START + timedelta(hours=6)).timestamp())
+    assert sample("oe_meter_tariff_unit_rate_forecast", meter, slot="0") is None
+    assert sample("oe_meter_tariff_unit_rate_window_avg", meter, window="4h") is None
@@ -0,0 +1,57 @@
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from gql import Client, gql
+from prometheus_client import REGISTRY
+from octopus_usage_exporter.http_session import build_session, shared_session_transport
+
+
+class GraphQLHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    peers = []
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers["Content-Length"]))
+        GraphQLHandler.peers.append(self.client_address)
+        body = json.dumps({"data": {"ok": True}}).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def phase_count(phase):
+    return REGISTRY.get_sample_value("oe_http_phase_seconds_count", {"phase": phase}) or 0
+
+
+def test_transport_reuses_one_connection_and_times_phases():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), GraphQLHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    GraphQLHandler.peers = []
+    before = {phase: phase_count(phase) for phase in ("dns", "connect", "ttfb")}
+    try:
+        session = build_session(2)
+        url = "http://127.0.0.1:{}/graphql".format(server.server_address[1])
+        # Separate clients, as each worker thread has, still share the session's pool
+        for _ in range(3):
+            client = Client(transport=shared_session_transport(session=session, url=url, timeout=5))
+            assert client.execute(gql("query { ok }")) == {"ok": True}
+    finally:
+        server.shutdown()
+        server.server_close()
+
+    assert len(set(GraphQLHandler.peers)) == 1
+    assert phase_count("dns") - before["dns"] == 1
+    assert phase_count("connect") - before["connect"] == 1
+    assert phase_count("ttfb") - before["ttfb"] == 3
+
+
+def test_session_sized_for_workers():
+    session = build_session(8)
+    adapter = session.get_adapter("https://api.octopus.energy/")
+    assert adapter._pool_maxsize == 8
+    assert session.headers["Accept-Encoding"] == "gzip"
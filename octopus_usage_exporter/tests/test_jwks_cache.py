@@ -0,0 +1,62 @@
+import json
+from unittest.mock import patch, MagicMock
+from jose import jwt
+from octopus_usage_exporter.jwks_cache import jwks_cache
+from octopus_usage_exporter.tests.conftest import FakeClock
+
+
+def token_with_kid(kid):
+    return jwt.encode({"exp": 2000}, "secret", algorithm="HS256", headers={"kid": kid})
+
+
+def jwks_response(*kids):
+    response = MagicMock()
+    response.json.return_value = {"keys": [{"kid": kid, "kty": "RSA"} for kid in kids]}
+    return response
+
+
+def test_construction_makes_no_request():
+    with patch('octopus_usage_exporter.jwks_cache.requests.get') as get:
+        jwks_cache()
+    get.assert_not_called()
+
+
+def test_unknown_kid_fetched_once_then_served_from_disk(tmp_path):
+    path = str(tmp_path / "jwks.json")
+    clock = FakeClock(1000)
+    with patch('octopus_usage_exporter.jwks_cache.requests.get', return_value=jwks_response("k1", "k2")) as get:
+        cache = jwks_cache(path=path, clock=clock)
+        assert cache.key_set(token_with_kid("k2")) == {"keys": [{"kid": "k2", "kty": "RSA"}]}
+        cache.key_set(token_with_kid("k1"))
+        assert get.call_count == 1
+        assert get.call_args.kwargs["timeout"] == 10
+
+        restarted = jwks_cache(path=path, clock=clock)
+        assert restarted.key_set(token_with_kid("k1")) == {"keys": [{"kid": "k1", "kty": "RSA"}]}
+        assert get.call_count == 1
+    assert json.load(open(path))["fetched_at"] == 1000
+
+
+def test_unknown_kid_fetches_are_rate_limited():
+    clock = FakeClock(1000)
+    with patch('octopus_usage_exporter.jwks_cache.requests.get', return_value=jwks_response("k1")) as get:
+        cache = jwks_cache(clock=clock, min_interval=60)
+        cache.key_set(token_with_kid("rotated"))
+        # A token signed with a key that is not known cannot be checked against the other keys
+        assert cache.key_set(token_with_kid("rotated")) == {"keys": []}
+        assert get.call_count == 1
+        assert cache.next_fetch() == 1060
+        clock.now += 61
+        cache.key_set(token_with_kid("rotated"))
+        assert get.call_count == 2
+
+
+def test_stale_set_refreshed_in_background():
+    clock = FakeClock(1000)
+    with patch('octopus_usage_exporter.jwks_cache.requests.get', return_value=jwks_response("k1")):
+        cache = jwks_cache(clock=clock, ttl=600)
+        cache.key_set(token_with_kid("k1"))
+    clock.now += 601
+    with patch.object(jwks_cache, 'refresh_in_background') as refresh:
+        assert cache.key_set(token_with_kid("k1")) == {"keys": [{"kid": "k1", "kty": "RSA"}]}
+    refresh.assert_called_once()
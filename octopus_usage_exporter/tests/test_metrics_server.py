@@ -0,0 +1,114 @@
+import gzip
+import socket
+import threading
+import urllib.error
+import urllib.request
+from octopus_usage_exporter.metrics_server import metrics_server, exporter_handler, poller_health, exposition_cache
+from octopus_usage_exporter.tests.conftest import FakeClock
+
+
+def start(health):
+    server = metrics_server(("127.0.0.1", 0), exporter_handler.bind(health))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, "http://127.0.0.1:{}".format(server.server_address[1])
+
+
+def status(url):
+    try:
+        return urllib.request.urlopen(url, timeout=5).status
+    except urllib.error.HTTPError as e:
+        return e.code
+
+
+def test_health_endpoints_follow_poller():
+    clock = FakeClock()
+    health = poller_health(heartbeat=30, clock=clock)
+    server, base = start(health)
+    try:
+        assert status(base + "/healthz") == 503
+        health.beat()
+        assert status(base + "/healthz") == 200
+        assert status(base + "/ready") == 503
+        health.polled()
+        assert status(base + "/ready") == 200
+        clock.now += 91
+        assert status(base + "/healthz") == 503
+        assert status(base + "/ready") == 503
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def test_half_open_connection_does_not_block_scrapes():
+    server, base = start(poller_health())
+    stalled = socket.create_connection(server.server_address)
+    stalled.sendall(b"GET /metrics HTTP/1.1\r\n")
+    try:
+        request = urllib.request.Request(base + "/metrics", headers={"Accept-Encoding": "gzip"})
+        response = urllib.request.urlopen(request, timeout=5)
+        assert response.headers["Content-Encoding"] == "gzip"
+        assert b"# TYPE" in gzip.decompress(response.read())
+    finally:
+        stalled.close()
+        server.shutdown()
+        server.server_close()
+
+
+def test_cached_exposition_rendered_once_per_poll():
+    from prometheus_client import CollectorRegistry, Gauge
+    registry = CollectorRegistry()
+    gauge = Gauge("oe_test_reading", "reading", registry=registry)
+    gauge.set(1)
+    exposition = exposition_cache(registry, max_age=3600)
+    server = metrics_server(("127.0.0.1", 0), exporter_handler.bind(poller_health(), exposition))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = "http://127.0.0.1:{}/metrics".format(server.server_address[1])
+    try:
+        first = urllib.request.urlopen(urllib.request.Request(url, headers={"Accept-Encoding": "gzip"}), timeout=5)
+        etag = first.headers["ETag"]
+        assert b"oe_test_reading 1.0" in gzip.decompress(first.read())
+
+        # Served from the cache until the next poll invalidates it
+        gauge.set(2)
+        plain = urllib.request.urlopen(url, timeout=5)
+        assert b"oe_test_reading 1.0" in plain.read()
+        assert status_with_etag(url, etag, "gzip") == 304
+        # The plain body is its own representation, a gzip ETag never validates it
+        assert plain.headers["ETag"] != etag and plain.headers["Vary"] == "Accept-Encoding"
+        assert status_with_etag(url, etag) == 200
+        assert status_with_etag(url, plain.headers["ETag"]) == 304
+
+        exposition.invalidate()
+        assert status_with_etag(url, etag, "gzip") == 200
+        assert b"oe_test_reading 2.0" in urllib.request.urlopen(url, timeout=5).read()
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def test_render_racing_an_invalidation_is_not_cached():
+    from prometheus_client import CollectorRegistry, Gauge
+    registry = CollectorRegistry()
+    gauge = Gauge("oe_test_race", "reading", registry=registry)
+    gauge.set(1)
+
+    class polled_mid_render:
+        # The first render reads the registry, then a poll updates the gauge and invalidates the cache
+        renders = 0
+
+        def collect(self):
+            self.renders += 1
+            yield from registry.collect()
+            if self.renders == 1:
+                gauge.set(2)
+                exposition.invalidate()
+    exposition = exposition_cache(polled_mid_render(), max_age=3600)
+    _, stale = exposition.get("text/plain")
+    assert b"oe_test_race 1.0" in stale.plain
+    _, fresh = exposition.get("text/plain")
+    assert b"oe_test_race 2.0" in fresh.plain
+    assert exposition.get("text/plain")[1] is fresh
+
+
+def status_with_etag(url, etag, encoding="identity"):
+    return status(urllib.request.Request(url, headers={"If-None-Match": etag, "Accept-Encoding": encoding}))
@@ -1,5 +1,6 @@
+import asyncio
 import pytest
-from unittest.mock import patch, MagicMock
+from unittest.mock import patch, MagicMock, AsyncMock
 from datetime import datetime, timedelta
 from octopus_usage_exporter.octopus_api_connection import octopus_api_connection
 
@@ -19,14 +20,17 @@ def api_conn():
         mock_instance.execute.return_value = {'obtainKrakenToken': {'token': 'faketoken'}}
         mock_client.return_value = mock_instance
         conn = octopus_api_connection(api_key="dummy_api_key")
+        # Signing keys are available, so tokens are checked with the patched jwt.decode
+        conn.jwks.keys = {"k1": {"kid": "k1"}}
+        conn.jwks.fetched_at = datetime.now().timestamp()
         yield conn
 
 def test_check_jwt_valid(api_conn):
     with patch('octopus_usage_exporter.octopus_api_connection.jwt', DummyJWT):
         api_conn.headers["Authorization"] = "JWT faketoken"
-        with patch.object(octopus_api_connection, 'get_jwt') as mock_get_jwt:
+        with patch.object(octopus_api_connection, 'fetch_jwt') as mock_fetch_jwt:
             api_conn.check_jwt()
-            mock_get_jwt.assert_not_called()
+            mock_fetch_jwt.assert_not_called()
 
 def test_check_jwt_expired(api_conn):
     class ExpiredJWT:
@@ -36,6 +40,106 @@ def test_check_jwt_expired(api_conn):
             return {"exp": (datetime.now() - timedelta(minutes=5)).timestamp()}
     with patch('octopus_usage_exporter.octopus_api_connection.jwt', ExpiredJWT):
         api_conn.headers["Authorization"] = "JWT faketoken"
-        with patch.object(octopus_api_connection, 'get_jwt') as mock_get_jwt:
+        with patch.object(octopus_api_connection, 'fetch_jwt', return_value="newtoken") as mock_fetch_jwt:
             api_conn.check_jwt()
-            mock_get_jwt.assert_called_once()
+            mock_fetch_jwt.assert_called_once()
+        assert api_conn.headers["Authorization"] == "JWT newtoken"
+
+def test_execute_async_sends_current_jwt(api_conn):
+    session = MagicMock()
+    session.execute = AsyncMock(return_value={"smartMeterTelemetry": []})
+    with patch('octopus_usage_exporter.octopus_api_connection.jwt', DummyJWT), \
+         patch.object(octopus_api_connection, 'async_session', AsyncMock(return_value=session)):
+        api_conn.headers["Authorization"] = "JWT faketoken"
+        result = asyncio.run(api_conn.execute_async("query Q($deviceId: String!) { smartMeterTelemetry(deviceId: $deviceId) { readAt } }", variable_values={"deviceId": "abc"}))
+    assert result == {"smartMeterTelemetry": []}
+    request = session.execute.await_args.args[0]
+    assert request.variable_values == {"deviceId": "abc"}
+    extra_args = session.execute.await_args.kwargs["extra_args"]
+    assert extra_args["headers"] == {"Authorization": "JWT faketoken"}
+    assert callable(extra_args["extensions"]["trace"])
+
+def test_check_jwt_async_refreshes_expired_token(api_conn):
+    class ExpiredJWT:
+        @staticmethod
+        def decode(token, key, algorithms):
+            return {"exp": (datetime.now() - timedelta(minutes=5)).timestamp()}
+    with patch('octopus_usage_exporter.octopus_api_connection.jwt', ExpiredJWT), \
+         patch.object(octopus_api_connection, 'fetch_jwt', return_value="newtoken") as mock_fetch_jwt:
+        api_conn.headers["Authorization"] = "JWT faketoken"
+        asyncio.run(api_conn.check_jwt_async())
+        mock_fetch_jwt.assert_called_once()
+
+def test_stored_token_skips_login():
+    store = MagicMock()
+    store.load_token.return_value = ("storedtoken", (datetime.now() + timedelta(hours=1)).timestamp())
+    with patch('octopus_usage_exporter.octopus_api_connection.requests.get') as mock_get, \
+         patch('octopus_usage_exporter.octopus_api_connection.Client') as mock_client:
+        conn = octopus_api_connection(api_key="dummy_api_key", token_store=store)
+    # Neither a login nor a JWKS request is needed to start
+    mock_client.return_value.execute.assert_not_called()
+    mock_get.assert_not_called()
+    assert conn.headers["Authorization"] == "JWT storedtoken"
+
+def test_login_request_does_not_send_old_token(api_conn):
+    api_conn.headers["Authorization"] = "JWT oldtoken"
+    with patch.object(octopus_api_connection, 'build_client') as build_client:
+        build_client.return_value.execute.return_value = {'obtainKrakenToken': {'token': 'newtoken'}}
+        api_conn._login_client = None
+        assert api_conn.fetch_jwt() == "newtoken"
+    build_client.assert_called_once_with(headers={})
+
+def kraken_error(code):
+    from gql.transport.exceptions import TransportQueryError
+    return TransportQueryError("error", errors=[{"message": "error", "extensions": {"errorCode": code}}])
+
+def test_classify_kraken_errors():
+    from gql.transport.exceptions import TransportServerError
+    from octopus_usage_exporter.octopus_api_connection import classify_error
+    assert classify_error(kraken_error("KT-CT-1199")) == "rate_limit"
+    assert classify_error(kraken_error("KT-CT-1124")) == "auth"
+    assert classify_error(kraken_error("KT-CT-4301")) == "permanent"
+    assert classify_error(TransportServerError("Too Many Requests", 429)) == "rate_limit"
+    assert classify_error(TransportServerError("Bad Gateway", 502)) == "transient"
+
+def test_permanent_error_not_retried(api_conn):
+    client = MagicMock()
+    client.execute.side_effect = kraken_error("KT-CT-4301")
+    with pytest.raises(Exception):
+        api_conn.run_query("query { ok }", client=client)
+    assert client.execute.call_count == 1
+
+def test_rate_limit_and_auth_errors_handled(api_conn):
+    api_conn.headers["Authorization"] = "JWT faketoken"
+    with patch.object(api_conn.governor, 'on_rate_limited') as slowed:
+        assert not api_conn.query_failed(kraken_error("KT-CT-1199"), "faketoken")
+    slowed.assert_called_once()
+    assert api_conn.query_failed(kraken_error("KT-CT-1124"), "faketoken")
+    assert not api_conn.query_failed(kraken_error("KT-CT-1124"), None)
+
+def test_jwks_outage_does_not_log_in_for_every_request(api_conn):
+    import time
+    from jose import jwt
+    # The connection checks its key cache against the jwks_cache class it imported itself
+    from octopus_usage_exporter.octopus_api_connection import jwks_cache
+    session = MagicMock()
+    session.get.side_effect = ConnectionError("auth host unreachable")
+    api_conn.jwks = jwks_cache(session=session, min_interval=60)
+    token = jwt.encode({"exp": time.time() + 3600}, "secret", algorithm="HS256", headers={"kid": "k1"})
+    api_conn.headers["Authorization"] = "JWT " + token
+    try:
+        with patch.object(octopus_api_connection, 'fetch_jwt', return_value="newtoken") as fetch_jwt:
+            for _ in range(3):
+                api_conn.check_jwt()
+            fetch_jwt.assert_not_called()
+            assert session.get.call_count == 1
+
+            # Once another fetch is allowed the token is verified again, and refused with the real keys
+            api_conn.jwks.clock = api_conn._tokens.clock = lambda: time.time() + 61
+            session.get.side_effect = None
+            session.get.return_value.json.return_value = {"keys": [{"kid": "k1", "kty": "oct", "k": "c2VjcmV0"}]}
+            api_conn.check_jwt()
+            assert session.get.call_count == 2
+            fetch_jwt.assert_called_once()
+    finally:
+        api_conn._tokens.cancel()
@@ -1,7 +1,12 @@
+import asyncio
+import os
+import tempfile
+import threading
 import unittest
-from unittest.mock import patch, MagicMock
+from unittest.mock import patch, MagicMock, AsyncMock
 from types import SimpleNamespace
 from datetime import datetime, timedelta
+from gql.transport.exceptions import TransportQueryError
 
 # Import the module under test
 from octopus_usage_exporter import octopus_usage_exporter as exporter_module
@@ -16,11 +21,32 @@ class DummySettings:
         self.prom_port = 9120
         self.account_number = 'ACC123'
         self.api_key = 'API'
+        self.accounts_file = None
+        self.workers = 2
+        self.jitter = 0.0
+        self.async_transport = False
+        self.batch_size = 25
+        self.tariff_ttl = 3600
+        self.tariff_forecast = False
+        self.forecast_slots = 48
+        self.usage_history = 2880
+        self.state_file = None
+        self.discovery_ttl = 86400
+        self.rediscovery_interval = 0
+        self.api_url = 'https://api.example/graphql/'
+        self.jwks_url = 'https://auth.example/jwks.json'
+        self.jwks_file = None
+        self.jwks_ttl = 86400
+        self.rate_limit = 1.0
+        self.rate_burst = 10
+        self.config_file = None
         self.gas = electric
         self.electric = gas
 
 
 class DummyMeter:
+    agreement_operation = 'ElectricityAgreement'
+
     def __init__(self, device_id='dev123', meter_type='electric', reading_types=None):
         self.device_id = device_id
         self.meter_type = meter_type
@@ -29,6 +55,7 @@ class DummyMeter:
         self.last_called = datetime.now() - timedelta(seconds=20)
         self.agreement = 'agreement123'
         self.tariff_name = 'Tariff123'
+        self.account_number = None
 
     def get_jql_query(self):
         return 'QUERY'
@@ -110,27 +137,29 @@ class TestUpdateGauge(unittest.TestCase):
         exporter_module.update_gauge('consumption', 'NOTFLOAT', m)
         mock_warning.assert_called_once()
 
-    @patch.object(exporter_module, 'Gauge', GaugeStub)
-    def test_update_gauge_ng_creates_and_sets(self):
+    def test_update_readings_ng_uses_collector(self):
         m = DummyMeter(reading_types=['consumption'])
-        exporter_module.update_gauge_ng('consumption', 5.4, m)
-        g = exporter_module.gauges['oe_meter_consumption']
-        self.assertEqual(g._value, 5.4)
-        self.assertEqual(g._labels, m.return_labels())
+        collector = type(exporter_module.meter_readings)()
+        read_at = datetime.now().timestamp() - 60
+        config = DummySettings(ng_metrics=True)
+        with patch.object(exporter_module, 'meter_readings', collector):
+            self.assertTrue(exporter_module.update_readings(config, {'consumption': 5.4, 'read_at': read_at}, m))
+            self.assertFalse(exporter_module.update_readings(config, {'consumption': 5.4, 'read_at': read_at}, m))
+        self.assertEqual(exporter_module.gauges, {})
+        sample = next(family for family in collector.collect() if family.name == 'oe_meter_consumption').samples[0]
+        self.assertEqual((sample.value, sample.timestamp), (5.4, read_at))
 
 
 class TestIntervalRateCheck(unittest.TestCase):
     def test_interval_clamped(self):
-        with patch('octopus_usage_exporter.octopus_usage_exporter.Settings', side_effect=lambda: DummySettings(interval=5000)):
-            exporter_module.interval = 100
-            exporter_module.interval_rate_check()
-            self.assertEqual(exporter_module.interval, 1800)
+        exporter_module.interval = 100
+        exporter_module.interval_rate_check(DummySettings(interval=5000))
+        self.assertEqual(exporter_module.interval, 1800)
 
     def test_interval_set_and_warning(self):
-        with patch('octopus_usage_exporter.octopus_usage_exporter.Settings', side_effect=lambda: DummySettings(interval=120)):
-            exporter_module.interval = 1000
-            exporter_module.interval_rate_check()
-            self.assertEqual(exporter_module.interval, 120)
+        exporter_module.interval = 1000
+        exporter_module.interval_rate_check(DummySettings(interval=120))
+        self.assertEqual(exporter_module.interval, 120)
 
 
 class TestGetEnergyReading(unittest.TestCase):
@@ -141,7 +170,9 @@ class TestGetEnergyReading(unittest.TestCase):
         client.execute.return_value = {
             'smartMeterTelemetry': [{
                 'consumption': 12.3,
-                'demand': 1.1
+                'demand': 1.1,
+                'consumptionDelta': 0.02,
+                'costDelta': 0.5
             }],
             'electricityAgreement': {
                 'isRevoked': False,
@@ -161,9 +192,76 @@ class TestGetEnergyReading(unittest.TestCase):
         out = exporter_module.get_energy_reading(client, m)
         self.assertEqual(out['consumption'], 12.3)
         self.assertEqual(out['demand'], 1.1)
+        self.assertEqual(out['consumption_delta'], 0.02)
+        self.assertEqual(out['cost_delta'], 0.5)
         self.assertIn('tariff_unit_rate', out)
         self.assertIn('tariff_standing_charge', out)
 
+    def setUp(self):
+        exporter_module.tariffs._entries.clear()
+
+    def test_batched_readings_async(self):
+        client = MagicMock()
+        client.execute_async = AsyncMock(return_value={
+            't0': [{'consumption': 7.5, 'demand': 0.4}],
+            't1': [{'consumption': 2.5}],
+            'a0': {'isRevoked': False, 'validTo': None, 'tariff': {'isExport': False, 'unitRate': 0.2, 'standingCharge': 0.1}},
+            'a1': {'isRevoked': False, 'validTo': None, 'tariff': {'unitRate': 0.05, 'standingCharge': 0.3}}
+        })
+        electric = exporter_module.electric_meter(device_id='e-1', meter_type='electric', agreement=1, reading_types=['consumption', 'demand'])
+        gas = exporter_module.gas_meter(device_id='g-1', meter_type='gas', agreement=2, reading_types=['consumption'])
+        out = asyncio.run(exporter_module.get_energy_readings_async(client, [electric, gas]))
+        client.execute_async.assert_awaited_once()
+        self.assertIs(out[0][0], electric)
+        self.assertEqual(out[0][1]['consumption'], 7.5)
+        self.assertEqual(out[0][1]['demand'], 0.4)
+        self.assertEqual(out[0][1]['tariff_unit_rate'], 0.2)
+        self.assertIs(out[1][0], gas)
+        self.assertEqual(out[1][1], {'consumption': 2.5})
+
+    def test_batched_readings_reuse_cached_tariffs(self):
+        client = MagicMock()
+        electric = exporter_module.electric_meter(device_id='e-1', meter_type='electric', agreement=1, reading_types=['consumption', 'tariff_unit_rate'])
+        client.execute.return_value = {
+            't0': [{'consumption': 1.0}],
+            'a0': {'isRevoked': False, 'validTo': None, 'tariff': {'isExport': False, 'unitRate': 0.2, 'standingCharge': 0.1}}
+        }
+        exporter_module.get_energy_readings(client, [electric])
+        client.execute.return_value = {'t0': [{'consumption': 2.0}]}
+        out = exporter_module.get_energy_readings(client, [electric])
+        self.assertEqual(client.execute.call_args.kwargs['variable_values'], {'d0': 'e-1'})
+        self.assertEqual(out[0][1]['consumption'], 2.0)
+        self.assertEqual(out[0][1]['tariff_unit_rate'], 0.2)
+
+    def test_partial_batch_failure_only_fails_the_affected_meter(self):
+        agreement = {'isRevoked': False, 'validTo': None, 'tariff': {'isExport': False, 'unitRate': 0.2, 'standingCharge': 0.1}}
+        meters = [exporter_module.electric_meter(device_id='e-{}'.format(index), meter_type='electric', agreement=index, reading_types=['consumption'])
+                  for index in range(3)]
+        client = MagicMock()
+        client.execute.side_effect = TransportQueryError('failed', errors=[{'message': 'Unable to find device', 'path': ['t1']}], data={
+            't0': [{'consumption': 1.0}], 't1': None, 't2': [{'consumption': 3.0}], 'a0': agreement, 'a1': agreement, 'a2': agreement})
+        out = exporter_module.get_energy_readings(client, meters)
+        self.assertEqual([(meter.device_id, readings['consumption']) for meter, readings in out], [('e-0', 1.0), ('e-2', 3.0)])
+        self.assertIsNotNone(exporter_module.tariffs.get(('ElectricityAgreement', 1)))
+
+        # A failed agreement is not cached, so only that one is fetched again
+        client.execute.side_effect = TransportQueryError('failed', errors=[{'message': 'Timeout', 'path': ['a0', 'tariff']}], data={
+            't0': [{'consumption': 1.5}], 'a0': None})
+        self.assertEqual(exporter_module.get_energy_readings(client, [exporter_module.electric_meter(
+            device_id='e-9', meter_type='electric', agreement=9, reading_types=['consumption'])]), [])
+        self.assertIsNone(exporter_module.tariffs.get(('ElectricityAgreement', 9)))
+        client.execute.side_effect = None
+        client.execute.return_value = {'t0': [{'consumption': 1.0}], 't1': [{'consumption': 2.0}], 't2': [{'consumption': 3.0}], 'a0': agreement}
+        exporter_module.get_energy_readings(client, meters[:1] + [exporter_module.electric_meter(
+            device_id='e-9', meter_type='electric', agreement=9, reading_types=['consumption'])])
+        self.assertEqual(client.execute.call_args.kwargs['variable_values'], {'d0': 'e-0', 'd1': 'e-9', 'a0': 9})
+
+    def test_batch_failure_without_paths_is_raised(self):
+        client = MagicMock()
+        client.execute.side_effect = TransportQueryError('failed', errors=[{'message': 'Unauthorized'}], data=None)
+        with self.assertRaises(TransportQueryError):
+            exporter_module.get_energy_readings(client, [exporter_module.electric_meter(device_id='e-1', meter_type='electric', agreement=1)])
+
     def test_electric_revoked(self):
         client = MagicMock()
         client.execute.return_value = {
@@ -226,8 +324,7 @@ class TestGetDeviceId(unittest.TestCase):
         }
         client = MagicMock()
         client.execute.return_value = fake_response
-        with patch('octopus_usage_exporter.octopus_usage_exporter.Settings', side_effect=lambda: DummySettings(interval=900)):
-            exporter_module.get_device_id(client, gas=False, electric=True)
+        exporter_module.get_device_id(DummySettings(interval=900), client, gas=False, electric=True)
         self.assertEqual(len(exporter_module.meters), 1)
         m = exporter_module.meters[0]
         self.assertEqual(m.meter_type, 'electric')
@@ -252,8 +349,7 @@ class TestGetDeviceId(unittest.TestCase):
         }
         client = MagicMock()
         client.execute.return_value = fake_response
-        with patch('octopus_usage_exporter.octopus_usage_exporter.Settings', side_effect=lambda: DummySettings(interval=800)):
-            exporter_module.get_device_id(client, gas=True, electric=False)
+        exporter_module.get_device_id(DummySettings(interval=800), client, gas=True, electric=False)
         self.assertEqual(len(exporter_module.meters), 1)
         m = exporter_module.meters[0]
         self.assertEqual(m.meter_type, 'gas')
@@ -293,8 +389,7 @@ class TestGetDeviceId(unittest.TestCase):
         }
         client = MagicMock()
         client.execute.return_value = fake_response
-        with patch('octopus_usage_exporter.octopus_usage_exporter.Settings', side_effect=lambda: DummySettings(interval=900)):
-            exporter_module.get_device_id(client, gas=False, electric=True)
+        exporter_module.get_device_id(DummySettings(interval=900), client, gas=False, electric=True)
         
         # Should only have 1 meter (the one with registers)
         self.assertEqual(len(exporter_module.meters), 1)
@@ -319,36 +414,76 @@ class TestStartPrometheusServer(unittest.TestCase):
                 pass
             def start(self):
                 started['started'] = True
-        with patch('octopus_usage_exporter.octopus_usage_exporter.HTTPServer', return_value=FakeHTTP()), \
-             patch('octopus_usage_exporter.octopus_usage_exporter.PrometheusEndpointServer', FakeThread), \
-             patch('octopus_usage_exporter.octopus_usage_exporter.Settings', side_effect=lambda: DummySettings()):
-            exporter_module.start_prometheus_server()
+        with patch('octopus_usage_exporter.octopus_usage_exporter.metrics_server', return_value=FakeHTTP()), \
+             patch('octopus_usage_exporter.octopus_usage_exporter.PrometheusEndpointServer', FakeThread):
+            exporter_module.start_prometheus_server(DummySettings())
         self.assertTrue(started.get('created'))
         self.assertTrue(started.get('started'))
 
     def test_start_failure(self):
-        with patch('octopus_usage_exporter.octopus_usage_exporter.HTTPServer', side_effect=OSError('fail')), \
-             patch('octopus_usage_exporter.octopus_usage_exporter.Settings', side_effect=lambda: DummySettings()):
-            self.assertIsNone(exporter_module.start_prometheus_server())
+        with patch('octopus_usage_exporter.octopus_usage_exporter.metrics_server', side_effect=OSError('fail')):
+            self.assertIsNone(exporter_module.start_prometheus_server(DummySettings()))
 
 
 class TestReadMeters(unittest.TestCase):
-    @patch.object(exporter_module, 'update_gauge_ng')
     @patch.object(exporter_module, 'update_gauge')
-    def test_read_meters_single_iteration(self, mock_simple_update, mock_ng_update):
+    def test_read_meters_single_iteration(self, mock_simple_update):
         # Prepare
         m = DummyMeter(reading_types=['consumption'])
+        m.account_number = 'A-1'
         exporter_module.meters = [m]
         client = MagicMock()
-        with patch('octopus_usage_exporter.octopus_usage_exporter.get_energy_reading', return_value={'consumption': 3.3}), \
-             patch('octopus_usage_exporter.octopus_usage_exporter.Settings', side_effect=lambda: DummySettings(ng_metrics=False)), \
-             patch('octopus_usage_exporter.octopus_usage_exporter.time.sleep', side_effect=KeyboardInterrupt):
+        exporter_module.account_connections.clear()
+        exporter_module.account_connections['A-1'] = client
+        with patch('octopus_usage_exporter.octopus_usage_exporter.get_energy_readings', side_effect=lambda client, meters: [(meter, {'consumption': 3.3}) for meter in meters]), \
+             patch.object(exporter_module, 'settings', DummySettings(ng_metrics=False)), \
+             patch.object(exporter_module, 'rediscovery'), \
+             patch.object(exporter_module.meter_scheduler, 'pop_due', side_effect=[[(m, 0.0)], KeyboardInterrupt]):
             try:
-                exporter_module.read_meters(client)
+                exporter_module.read_meters()
             except KeyboardInterrupt:
                 pass
         mock_simple_update.assert_called_with('consumption', 3.3, m)
 
+    def test_read_meters_schedules_from_last_called(self):
+        m = DummyMeter(reading_types=['consumption'])
+        m.last_called = datetime.now()
+        exporter_module.meters = [m]
+        scheduled = []
+        with patch.object(exporter_module, 'settings', DummySettings()), \
+             patch.object(exporter_module, 'rediscovery'), \
+             patch.object(exporter_module.meter_scheduler, 'schedule_after', side_effect=lambda meter, delay: scheduled.append((meter, delay))), \
+             patch.object(exporter_module.meter_scheduler, 'pop_due', side_effect=KeyboardInterrupt):
+            try:
+                exporter_module.read_meters()
+            except KeyboardInterrupt:
+                pass
+        self.assertEqual(scheduled[0][0], m)
+        self.assertAlmostEqual(scheduled[0][1], m.polling_interval, delta=1)
+
+    def test_batch_due_meters_groups_by_connection(self):
+        shared, other = MagicMock(), MagicMock()
+        exporter_module.account_connections.clear()
+        exporter_module.account_connections.update({'A-1': shared, 'A-2': shared, 'A-3': other})
+        due = []
+        for index, account in enumerate(['A-1', 'A-2', 'A-1', 'A-3', 'A-9']):
+            m = DummyMeter(device_id='dev{}'.format(index))
+            m.account_number = account
+            due.append((m, float(index)))
+        batches = list(exporter_module.batch_due_meters(due, batch_size=2))
+        self.assertEqual([(c, [m.device_id for m, _ in b]) for c, b in batches],
+                         [(shared, ['dev0', 'dev1']), (shared, ['dev2']), (other, ['dev3'])])
+
+
+class TestAsyncPoller(unittest.TestCase):
+    def test_submit_runs_coroutines_on_background_loop(self):
+        async def double(value):
+            await asyncio.sleep(0)
+            return value * 2
+        with exporter_module.AsyncPoller(workers=2) as poller:
+            futures = [poller.submit(double, i) for i in range(5)]
+            self.assertEqual([f.result(timeout=5) for f in futures], [0, 2, 4, 6, 8])
+
 
 class TestExporter(unittest.TestCase):
     def test_exporter_orchestration(self):
@@ -357,9 +492,9 @@ class TestExporter(unittest.TestCase):
              patch('octopus_usage_exporter.octopus_usage_exporter.get_device_id') as gdid, \
              patch('octopus_usage_exporter.octopus_usage_exporter.start_prometheus_server') as sps, \
              patch('octopus_usage_exporter.octopus_usage_exporter.read_meters', side_effect=KeyboardInterrupt) as rm, \
-             patch('octopus_usage_exporter.octopus_usage_exporter.Settings', side_effect=lambda: DummySettings(electric=True)):
+             patch('octopus_usage_exporter.octopus_usage_exporter.reload_trigger'):
             try:
-                exporter_module.exporter()
+                exporter_module.exporter(DummySettings(electric=True))
             except KeyboardInterrupt:
                 pass
         irc.assert_called()
@@ -368,6 +503,334 @@ class TestExporter(unittest.TestCase):
         sps.assert_called()
         rm.assert_called()
 
+    def test_exporter_polls_before_discovering_several_accounts(self):
+        accounts = [SimpleNamespace(account_number='A-1', api_key='shared', gas=False, electric=True),
+                    SimpleNamespace(account_number='A-2', api_key='other', gas=True, electric=False)]
+        with patch.object(exporter_module, 'interval_rate_check'), \
+             patch.object(exporter_module, 'configured_accounts', return_value=accounts), \
+             patch.object(exporter_module, 'octopus_api_connection') as conn, \
+             patch.object(exporter_module, 'start_prometheus_server'), \
+             patch.object(exporter_module, 'read_meters') as rm, \
+             patch.object(exporter_module, 'reload_trigger'):
+            exporter_module.exporter(DummySettings())
+        conn.assert_not_called()
+        self.assertEqual(rm.call_args.args[1], accounts)
+
+        # With a single account there is nothing to poll, so it is started first and a failure is raised
+        with patch.object(exporter_module, 'interval_rate_check'), \
+             patch.object(exporter_module, 'configured_accounts', return_value=accounts[:1]), \
+             patch.object(exporter_module, 'octopus_api_connection', side_effect=Exception('login failed')), \
+             patch.object(exporter_module, 'read_meters') as rm, \
+             patch.object(exporter_module, 'reload_trigger'):
+            with self.assertRaises(Exception):
+                exporter_module.exporter(DummySettings())
+        rm.assert_not_called()
+
+    def test_started_accounts_share_connections_and_schedule_their_meters(self):
+        exporter_module.connections.clear()
+        exporter_module.account_connections.clear()
+        accounts = [SimpleNamespace(account_number='A-1', api_key='shared', gas=False, electric=True),
+                    SimpleNamespace(account_number='A-2', api_key='shared', gas=True, electric=False),
+                    SimpleNamespace(account_number='A-3', api_key='other', gas=True, electric=True),
+                    SimpleNamespace(account_number='A-4', api_key='bad', gas=True, electric=True)]
+
+        def connect(api_key, **kwargs):
+            if api_key == 'bad':
+                raise Exception('login failed')
+            return MagicMock(api_key=api_key)
+        schedule = MagicMock()
+        with patch.object(exporter_module, 'octopus_api_connection', side_effect=connect) as conn, \
+             patch.object(exporter_module, 'get_device_id', side_effect=lambda *args: [DummyMeter(device_id=args[-1])]) as gdid:
+            for account in accounts:
+                exporter_module.start_account(DummySettings(), account, schedule)
+        self.assertEqual(conn.call_count, 3)
+        self.assertEqual(gdid.call_count, 3)
+        self.assertIs(exporter_module.account_connections['A-1'], exporter_module.account_connections['A-2'])
+        self.assertIsNot(exporter_module.account_connections['A-1'], exporter_module.account_connections['A-3'])
+        self.assertNotIn('A-4', exporter_module.account_connections)
+        self.assertEqual([c.args[0].device_id for c in schedule.schedule_after.call_args_list], ['A-1', 'A-2', 'A-3'])
+
+    def test_read_meters_starts_accounts_in_the_background(self):
+        started = threading.Event()
+        accounts = [SimpleNamespace(account_number='A-1')]
+
+        def pop_due(timeout=None):
+            # The poll loop is already waiting for meters while the account is started
+            self.assertTrue(started.wait(5))
+            raise KeyboardInterrupt
+        exporter_module.meters = []
+        with patch.object(exporter_module, 'settings', DummySettings()), \
+             patch.object(exporter_module, 'rediscovery'), \
+             patch.object(exporter_module, 'start_account', side_effect=lambda *args: started.set()) as start_account, \
+             patch.object(exporter_module.meter_scheduler, 'pop_due', side_effect=pop_due):
+            with self.assertRaises(KeyboardInterrupt):
+                exporter_module.read_meters(None, accounts)
+        self.assertIs(start_account.call_args.args[1], accounts[0])
+        self.assertIsInstance(start_account.call_args.args[2], exporter_module.meter_scheduler)
+
+    def test_exporter_discovers_from_cached_account(self):
+        exporter_module.connections.clear()
+        exporter_module.account_connections.clear()
+        exporter_module.meters.clear()
+        store = MagicMock()
+        store.load_tariffs.return_value = []
+        store.load_account.return_value = {'account': {'electricityAgreements': [{
+            'id': 42,
+            'tariff': {'displayName': 'Agile'},
+            'meterPoint': {'meters': [{'smartImportElectricityMeter': {'deviceId': 'DEV-1'}, 'smartExportElectricityMeter': None,
+                                       'registers': [{'name': 'Standard'}]}]}
+        }], 'gasAgreements': []}}
+        store.load_poll.return_value = (datetime.now().timestamp() - 600, {'consumption': 5.0})
+        accounts = [SimpleNamespace(account_number='A-1', api_key='key', gas=False, electric=True)]
+        config = SimpleNamespace(**{**vars(DummySettings()), 'state_file': 'state.db'})
+        with patch('octopus_usage_exporter.octopus_usage_exporter.interval_rate_check'), \
+             patch('octopus_usage_exporter.octopus_usage_exporter.state_store', return_value=store), \
+             patch('octopus_usage_exporter.octopus_usage_exporter.configured_accounts', return_value=accounts), \
+             patch('octopus_usage_exporter.octopus_usage_exporter.octopus_api_connection') as conn, \
+             patch('octopus_usage_exporter.octopus_usage_exporter.update_readings') as update, \
+             patch('octopus_usage_exporter.octopus_usage_exporter.start_prometheus_server'), \
+             patch('octopus_usage_exporter.octopus_usage_exporter.read_meters'), \
+             patch('octopus_usage_exporter.octopus_usage_exporter.reload_trigger'):
+            try:
+                exporter_module.exporter(config)
+            finally:
+                exporter_module.state = None
+        conn.return_value.execute.assert_not_called()
+        self.assertEqual(store.load_account.call_args.args[0], 'A-1')
+        self.assertIs(conn.call_args.kwargs['token_store'], store)
+        self.assertEqual([(m.device_id, m.agreement, m.account_number) for m in exporter_module.meters], [('DEV-1', 42, 'A-1')])
+        # The first poll is planned from the saved poll time rather than immediately
+        self.assertGreater(exporter_module.meters[0].last_called, datetime.now() - timedelta(seconds=660))
+        update.assert_called_once_with(config, {'consumption': 5.0}, exporter_module.meters[0])
+        exporter_module.meters.clear()
+
+    def test_discovery_fetches_both_fuels_once_and_saves_the_response(self):
+        exporter_module.meters.clear()
+        response = {'account': {
+            'electricityAgreements': [{'id': 1, 'tariff': {'displayName': 'Agile'}, 'meterPoint': {'meters': [
+                {'smartImportElectricityMeter': {'deviceId': 'E-1'}, 'smartExportElectricityMeter': None, 'registers': [{'name': 'Standard'}]}]}}],
+            'gasAgreements': [{'id': 2, 'tariff': {'displayName': 'Fixed'}, 'meterPoint': {'meters': [
+                {'smartGasMeter': {'deviceId': 'G-1'}, 'registers': [{'name': 'Standard'}]}]}}]}}
+        client = MagicMock()
+        client.execute.return_value = response
+        store = MagicMock()
+        store.load_account.return_value = None
+        with patch.object(exporter_module, 'state', store):
+            exporter_module.get_device_id(DummySettings(), client, gas=True, electric=True, account_number='A-1')
+        self.assertEqual(client.execute.call_count, 1)
+        self.assertEqual(client.execute.call_args.kwargs['variable_values'], {'accountNumber': 'A-1'})
+        self.assertEqual(store.save_account.call_args.args[:2], ('A-1', response))
+        self.assertEqual([(m.meter_type, m.device_id, m.agreement) for m in exporter_module.meters], [('electric', 'E-1', 1), ('gas', 'G-1', 2)])
+        exporter_module.meters.clear()
+
+
+class TestSettingsReload(unittest.TestCase):
+    def setUp(self):
+        exporter_module.meters.clear()
+        exporter_module.account_connections.clear()
+
+    def tearDown(self):
+        exporter_module.meters.clear()
+        exporter_module.settings = None
+
+    def test_load_settings_reads_config_file_beneath_environment(self):
+        with tempfile.NamedTemporaryFile('w', suffix='.env', delete=False) as env_file:
+            env_file.write('INTERVAL=600\nBATCH_SIZE=5\nUNKNOWN_KEY=1\n')
+        try:
+            with patch.dict(os.environ, {'CONFIG_FILE': env_file.name, 'BATCH_SIZE': '7'}):
+                config = exporter_module.load_settings()
+        finally:
+            os.unlink(env_file.name)
+        self.assertEqual((config.interval, config.batch_size), (600, 7))
+        with self.assertRaises(Exception):
+            config.interval = 60
+
+    def test_reload_swaps_settings_and_syncs_meters(self):
+        electric = exporter_module.build_meter(DummySettings(), 'electric', 'DEV-E', 1, 'Agile', 'A-1')
+        exporter_module.meters.append(electric)
+        exporter_module.settings = DummySettings()
+        config = SimpleNamespace(**{**vars(DummySettings(interval=600)), 'tariff_rates': True})
+        schedule = MagicMock()
+
+        def discover(config, client, gas, electric, account_number=None):
+            self.assertEqual((gas, electric, account_number), (True, False, 'A-1'))
+            added = [exporter_module.build_meter(config, 'gas', 'DEV-G', 2, 'Fixed', account_number)]
+            exporter_module.meters.extend(added)
+            return added
+
+        accounts = [SimpleNamespace(account_number='A-1', api_key='key', gas=True, electric=True)]
+        with patch.object(exporter_module, 'load_settings', return_value=config), \
+             patch.object(exporter_module, 'configured_accounts', return_value=accounts), \
+             patch.object(exporter_module, 'rediscovery', self.inline_rediscovery()), \
+             patch.object(exporter_module, 'get_connection', return_value=MagicMock(api_key='key')), \
+             patch.object(exporter_module, 'get_device_id', side_effect=discover):
+            exporter_module.reload_settings(schedule)
+        self.assertIs(exporter_module.settings, config)
+        self.assertEqual([m.device_id for m in exporter_module.meters], ['DEV-E', 'DEV-G'])
+        # The existing meter is updated in place rather than replaced
+        self.assertIs(exporter_module.meters[0], electric)
+        self.assertEqual(electric.polling_interval, 600)
+        self.assertIn('tariff_unit_rate', electric.reading_types)
+        schedule.schedule_after.assert_called_once_with(exporter_module.meters[1], 0)
+
+        accounts[0].electric = False
+        with patch.object(exporter_module, 'load_settings', return_value=config), \
+             patch.object(exporter_module, 'configured_accounts', return_value=accounts), \
+             patch.object(exporter_module, 'rediscovery', self.inline_rediscovery()), \
+             patch.object(exporter_module, 'get_connection') as get_connection:
+            exporter_module.reload_settings(schedule)
+        self.assertEqual([m.device_id for m in exporter_module.meters], ['DEV-G'])
+        schedule.remove.assert_called_once_with(electric)
+        # The API key is unchanged, so the account keeps its connection
+        get_connection.assert_not_called()
+
+    def test_reload_replans_meters_whose_interval_changed(self):
+        exporter_module.settings = DummySettings()
+        recent = exporter_module.build_meter(DummySettings(), 'electric', 'DEV-E1', 1, 'Agile', 'A-1')
+        overdue = exporter_module.build_meter(DummySettings(), 'electric', 'DEV-E2', 2, 'Agile', 'A-1')
+        recent.polling_interval = overdue.polling_interval = 1800
+        recent.last_called = datetime.now() - timedelta(seconds=30)
+        overdue.last_called = datetime.now() - timedelta(seconds=300)
+        exporter_module.meters.extend([recent, overdue])
+        schedule = exporter_module.meter_scheduler()
+        for meter in (recent, overdue):
+            schedule.schedule_after(meter, 1800 - (datetime.now() - meter.last_called).total_seconds())
+        with patch.object(exporter_module, 'load_settings', return_value=DummySettings(interval=60)), \
+             patch.object(exporter_module, 'configured_accounts', return_value=[]), \
+             patch.object(exporter_module, 'rediscovery'):
+            exporter_module.reload_settings(schedule)
+        now = schedule.clock()
+        due = sorted((entry[0] - now, entry[2].device_id) for entry in schedule._heap)
+        self.assertEqual([device_id for _, device_id in due], ['DEV-E2', 'DEV-E1'])
+        self.assertAlmostEqual(due[0][0], 0, delta=1)
+        self.assertAlmostEqual(due[1][0], 30, delta=1)
+
+    def test_reload_syncs_accounts_off_the_poll_loop(self):
+        exporter_module.settings = DummySettings()
+        accounts = [SimpleNamespace(account_number='A-1', api_key='key', gas=True, electric=True)]
+        with patch.object(exporter_module, 'load_settings', return_value=DummySettings()), \
+             patch.object(exporter_module, 'configured_accounts', return_value=accounts), \
+             patch.object(exporter_module, 'rediscovery') as rediscovery, \
+             patch.object(exporter_module, 'get_connection') as get_connection:
+            exporter_module.reload_settings(MagicMock())
+        get_connection.assert_not_called()
+        self.assertIs(rediscovery.submit.call_args.args[0], exporter_module.sync_accounts)
+
+    def test_failed_login_keeps_the_account_meters_and_connection(self):
+        config = DummySettings()
+        electric = exporter_module.build_meter(config, 'electric', 'DEV-E', 1, 'Agile', 'A-1')
+        gas = exporter_module.build_meter(config, 'gas', 'DEV-G', 2, 'Fixed', 'A-2')
+        exporter_module.meters.extend([electric, gas])
+        old = exporter_module.account_connections['A-1'] = MagicMock(api_key='old')
+        exporter_module.account_connections['A-2'] = MagicMock(api_key='other')
+        accounts = [SimpleNamespace(account_number='A-1', api_key='new', gas=True, electric=True),
+                    SimpleNamespace(account_number='A-2', api_key='other', gas=True, electric=True)]
+        schedule = MagicMock()
+        with patch.object(exporter_module, 'get_connection', side_effect=Exception('bad key')), \
+             patch.object(exporter_module, 'get_device_id') as get_device_id:
+            exporter_module.sync_accounts(config, accounts, schedule)
+        self.assertEqual(exporter_module.meters, [electric, gas])
+        self.assertIs(exporter_module.account_connections['A-1'], old)
+        schedule.remove.assert_not_called()
+        # Only the account that is still logged in looks for its missing meter
+        self.assertEqual(get_device_id.call_args.args[2:], (False, True, 'A-2'))
+
+    def inline_rediscovery(self):
+        rediscovery = MagicMock()
+        rediscovery.submit.side_effect = lambda run, *args: run(*args)
+        return rediscovery
+
+    def test_invalid_reload_keeps_current_settings(self):
+        current = exporter_module.settings = DummySettings()
+        with patch.object(exporter_module, 'load_settings', side_effect=ValueError('bad interval')):
+            exporter_module.reload_settings(MagicMock())
+        self.assertIs(exporter_module.settings, current)
+
+
+class TestRediscovery(unittest.TestCase):
+    def setUp(self):
+        exporter_module.meters.clear()
+        exporter_module.account_connections.clear()
+
+    def tearDown(self):
+        exporter_module.meters.clear()
+
+    def account_response(self, electric_device, electric_agreement, gas_device=None):
+        response = {'electricityAgreements': [{'id': electric_agreement, 'tariff': {'displayName': 'Agile {}'.format(electric_agreement)}, 'meterPoint': {'meters': [
+            {'smartImportElectricityMeter': {'deviceId': electric_device}, 'smartExportElectricityMeter': None, 'registers': [{'name': 'Standard'}]}]}}],
+            'gasAgreements': []}
+        if gas_device:
+            response['gasAgreements'] = [{'id': 9, 'tariff': {'displayName': 'Fixed'}, 'meterPoint': {'meters': [
+                {'smartGasMeter': {'deviceId': gas_device}, 'registers': [{'name': 'Standard'}]}]}}]
+        return {'account': response}
+
+    def test_rediscovery_updates_adds_and_retires_meters_in_place(self):
+        config = DummySettings()
+        account = SimpleNamespace(account_number='A-1', api_key='key', gas=True, electric=True)
+        electric = exporter_module.build_meter(config, 'electric', 'E-1', 1, 'Agile 1', 'A-1')
+        other = exporter_module.build_meter(config, 'electric', 'E-9', 5, 'Agile 5', 'A-2')
+        exporter_module.meters.extend([electric, other])
+        connection = MagicMock()
+        exporter_module.account_connections['A-1'] = connection
+        schedule = MagicMock()
+        exporter_module.tariffs.put(('ElectricityAgreement', 1), {'id': 1})
+        exporter_module.tariffs.put(('ElectricityAgreement', 5), {'id': 5})
+
+        # Tariff switch: same device, new agreement, and a gas meter appears
+        connection.execute.return_value = self.account_response('E-1', 2, gas_device='G-1')
+        exporter_module.rediscover_account(config, account, schedule)
+        self.assertIsNone(exporter_module.tariffs.get(('ElectricityAgreement', 1)))
+        self.assertIsNotNone(exporter_module.tariffs.get(('ElectricityAgreement', 5)))
+        self.assertIs(exporter_module.meters[0], electric)
+        self.assertEqual((electric.agreement, electric.tariff_name), (2, 'Agile 2'))
+        self.assertEqual([m.device_id for m in exporter_module.meters], ['E-1', 'E-9', 'G-1'])
+        schedule.schedule_after.assert_called_once_with(exporter_module.meters[2], 0)
+        schedule.remove.assert_not_called()
+
+        # The electricity meter is replaced and the gas meter has gone
+        connection.execute.return_value = self.account_response('E-2', 3)
+        with patch.object(exporter_module, 'meter_readings') as readings:
+            exporter_module.rediscover_account(config, account, schedule)
+        self.assertEqual([m.device_id for m in exporter_module.meters], ['E-9', 'E-2'])
+        self.assertEqual([c.args[0].device_id for c in schedule.remove.call_args_list], ['E-1', 'G-1'])
+        self.assertEqual([c.args[0].device_id for c in readings.remove.call_args_list], ['E-1', 'G-1'])
+
+    def test_every_usable_meter_is_read_under_its_own_agreement(self):
+        def electricity(agreement, *devices, export=None):
+            return {'id': agreement, 'tariff': {'displayName': 'Tariff {}'.format(agreement)}, 'meterPoint': {'meters': [
+                {'smartImportElectricityMeter': {'deviceId': device}, 'smartExportElectricityMeter': export, 'registers': [{'name': 'Standard'}]}
+                for device in devices]}}
+        response = {'electricityAgreements': [electricity(1, 'E-1'), electricity(2, 'E-2', 'E-1'), electricity(3, 'E-3', export={'deviceId': 'X'})],
+                    'gasAgreements': []}
+        selected = exporter_module.select_meters(DummySettings(), response, False, True, 'A-1')
+        self.assertEqual([(m.device_id, m.agreement, m.tariff_name) for m in selected], [('E-1', 1, 'Tariff 1'), ('E-2', 2, 'Tariff 2')])
+
+        # Rediscovery matches meters by device, so a second meter of the same fuel is kept alongside the first
+        exporter_module.meters.extend(selected[:1])
+        connection = MagicMock()
+        connection.execute.return_value = {'account': response}
+        exporter_module.account_connections['A-1'] = connection
+        schedule = MagicMock()
+        account = SimpleNamespace(account_number='A-1', api_key='key', gas=False, electric=True)
+        exporter_module.rediscover_account(DummySettings(), account, schedule)
+        self.assertEqual([m.device_id for m in exporter_module.meters], ['E-1', 'E-2'])
+        schedule.remove.assert_not_called()
+
+    def test_revoked_agreement_requests_rediscovery(self):
+        m = DummyMeter()
+        m.account_number = 'A-7'
+        with patch.object(exporter_module, 'rediscovery') as schedule:
+            out = exporter_module.parse_energy_reading(m, {'smartMeterTelemetry': [{}], 'electricityAgreement': {'isRevoked': True}})
+        self.assertEqual(out, {})
+        schedule.request.assert_called_once_with('A-7')
+
+    def test_rediscover_limits_to_requested_accounts(self):
+        accounts = [SimpleNamespace(account_number='A-1'), SimpleNamespace(account_number='A-2')]
+        with patch.object(exporter_module, 'configured_accounts', return_value=accounts), \
+             patch.object(exporter_module, 'rediscover_account', side_effect=[Exception('offline')]) as rediscover_account:
+            exporter_module.rediscover(DummySettings(), MagicMock(), {'A-2'})
+        self.assertEqual(rediscover_account.call_args.args[1].account_number, 'A-2')
+
 
 if __name__ == '__main__':
     unittest.main()
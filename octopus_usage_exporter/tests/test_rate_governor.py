@@ -0,0 +1,41 @@
+from prometheus_client import REGISTRY
+from octopus_usage_exporter.rate_governor import rate_governor
+from octopus_usage_exporter.tests.conftest import FakeClock
+
+
+def test_burst_then_paced_at_rate():
+    clock = FakeClock()
+    governor = rate_governor(max_rate=2.0, burst=3, clock=clock)
+    assert [governor.reserve() for _ in range(3)] == [0.0, 0.0, 0.0]
+    # Each further request queues behind the previous reservation
+    assert governor.reserve() == 0.5
+    assert governor.reserve() == 1.0
+    clock.now += 1.0
+    assert governor.reserve() == 0.5
+
+
+def test_rate_limit_halves_rate_and_pauses():
+    clock = FakeClock()
+    governor = rate_governor(max_rate=1.0, burst=5, clock=clock)
+    governor.on_rate_limited(retry_after=30)
+    assert governor.rate == 0.5
+    assert governor.reserve() == 30
+    assert REGISTRY.get_sample_value("oe_api_request_rate") == 0.5
+
+
+def test_successes_recover_rate_up_to_max():
+    governor = rate_governor(max_rate=1.0, min_rate=0.1, increase=0.25, clock=FakeClock())
+    for _ in range(5):
+        governor.on_rate_limited()
+    assert governor.rate == 0.1
+    for _ in range(10):
+        governor.on_success()
+    assert governor.rate == 1.0
+
+
+def test_reconfigure_caps_rate_and_budget():
+    governor = rate_governor(max_rate=2.0, burst=10, increase=1.0, clock=FakeClock())
+    governor.reconfigure(0.5, 3)
+    assert (governor.rate, governor.tokens) == (0.5, 3)
+    governor.on_success()
+    assert governor.rate == 0.5
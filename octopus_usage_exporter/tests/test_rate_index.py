@@ -0,0 +1,25 @@
+from datetime import datetime, timedelta, timezone
+from octopus_usage_exporter.rate_index import unit_rate_index
+
+START = datetime(2026, 1, 1, tzinfo=timezone.utc)
+
+
+def make_rates(count, shuffle=False):
+    rates = [{"validFrom": (START + timedelta(minutes=30 * i)).isoformat(),
+              "validTo": (START + timedelta(minutes=30 * (i + 1))).isoformat(),
+              "value": float(i)} for i in range(count)]
+    return list(reversed(rates)) if shuffle else rates
+
+
+def test_rate_at_finds_covering_slot_regardless_of_input_order():
+    index = unit_rate_index(make_rates(96, shuffle=True))
+    assert len(index) == 96
+    assert index.rate_at(START.timestamp()) == 0.0
+    assert index.rate_at((START + timedelta(hours=10, minutes=15)).timestamp()) == 20.0
+    assert index.rate_at((START + timedelta(hours=47, minutes=59)).timestamp()) == 95.0
+
+
+def test_rate_at_outside_published_rates():
+    index = unit_rate_index(make_rates(4))
+    assert index.rate_at((START - timedelta(minutes=1)).timestamp()) is None
+    assert index.rate_at((START + timedelta(hours=2)).timestamp()) is None
@@ -0,0 +1,48 @@
+from types import SimpleNamespace
+from octopus_usage_exporter.reading_collector import reading_collector
+from octopus_usage_exporter.tests.conftest import FakeClock
+
+
+def meter(device_id="dev-1", reading_types=("consumption", "demand", "tariff_unit_rate")):
+    return SimpleNamespace(device_id=device_id, meter_type="electric", reading_types=list(reading_types),
+                           return_labels=lambda: {"device_id": device_id, "meter_type": "electric"})
+
+
+def samples(collector):
+    return {(family.name, sample.labels["device_id"]): (sample.value, sample.timestamp)
+            for family in collector.collect() for sample in family.samples}
+
+
+def test_telemetry_stamped_with_read_at_and_tariffs_unstamped():
+    collector = reading_collector(clock=FakeClock(10_000))
+    collector.update(meter(), {"consumption": 12.5, "demand": 300, "tariff_unit_rate": 24.5, "read_at": 9_900.0})
+    assert samples(collector) == {
+        ("oe_meter_consumption", "dev-1"): (12.5, 9_900.0),
+        ("oe_meter_demand", "dev-1"): (300.0, 9_900.0),
+        ("oe_meter_tariff_unit_rate", "dev-1"): (24.5, None),
+        ("oe_meter_reading_age_seconds", "dev-1"): (100.0, None),
+    }
+
+
+def test_unchanged_readings_reported_and_stale_telemetry_dropped():
+    clock = FakeClock(10_000)
+    collector = reading_collector(stale_after=3600, clock=clock)
+    readings = {"consumption": 12.5, "tariff_unit_rate": 24.5, "read_at": 9_900.0}
+    assert collector.update(meter(), readings)
+    assert not collector.update(meter(), dict(readings))
+    assert collector.update(meter(), dict(readings, consumption=13.0))
+
+    clock.now += 3600
+    exposed = samples(collector)
+    assert ("oe_meter_consumption", "dev-1") not in exposed
+    assert exposed[("oe_meter_tariff_unit_rate", "dev-1")] == (24.5, None)
+    assert exposed[("oe_meter_reading_age_seconds", "dev-1")] == (3700.0, None)
+
+
+def test_readings_not_requested_are_ignored_and_meters_removed():
+    collector = reading_collector(clock=FakeClock(10_000))
+    collector.update(meter("dev-1", ("consumption",)), {"consumption": 1.0, "demand": 2.0, "read_at": 9_990.0})
+    collector.update(meter("dev-2", ("consumption",)), {"consumption": 3.0, "read_at": 9_990.0})
+    assert ("oe_meter_demand", "dev-1") not in samples(collector)
+    collector.remove(meter("dev-1"))
+    assert [key for key in samples(collector) if key[1] == "dev-1"] == []
@@ -0,0 +1,43 @@
+from octopus_usage_exporter.rediscovery import rediscovery_schedule
+from octopus_usage_exporter.tests.conftest import FakeClock
+
+
+def run_due(schedule):
+    calls = []
+    started = schedule.poll(calls.append)
+    if started is not None:
+        started.result(timeout=5)
+    return calls
+
+
+def test_full_rediscovery_every_interval():
+    clock = FakeClock(1000.0)
+    schedule = rediscovery_schedule(interval=600, clock=clock)
+    assert run_due(schedule) == []
+    clock.now += 600
+    assert run_due(schedule) == [None]
+    assert run_due(schedule) == []
+
+
+def test_revoked_accounts_rediscovered_early_with_backoff():
+    clock = FakeClock(1000.0)
+    schedule = rediscovery_schedule(interval=0, backoff=900, clock=clock)
+    schedule.request("A-1")
+    schedule.request("A-2")
+    assert run_due(schedule) == [{"A-1", "A-2"}]
+    # Still revoked on the next poll, so retried only after the backoff
+    schedule.request("A-1")
+    assert run_due(schedule) == []
+    clock.now += 900
+    assert run_due(schedule) == [{"A-1"}]
+
+
+def test_interval_change_restarts_the_countdown():
+    clock = FakeClock(1000.0)
+    schedule = rediscovery_schedule(interval=600, clock=clock)
+    clock.now += 500
+    schedule.set_interval(300)
+    clock.now += 200
+    assert run_due(schedule) == []
+    clock.now += 100
+    assert run_due(schedule) == [None]
@@ -0,0 +1,23 @@
+import os
+from octopus_usage_exporter.reload_trigger import reload_trigger
+
+
+def test_request_is_pending_once():
+    reloads = reload_trigger()
+    assert not reloads.pending()
+    reloads.request()
+    assert reloads.pending()
+    assert not reloads.pending()
+
+
+def test_watched_file_change_is_pending_once(tmp_path):
+    path = tmp_path / "exporter.env"
+    path.write_text("INTERVAL=900\n")
+    reloads = reload_trigger([str(path), None])
+    assert not reloads.pending()
+    path.write_text("INTERVAL=600\n")
+    os.utime(path, ns=(0, os.stat(path).st_mtime_ns + 1_000_000_000))
+    assert reloads.pending()
+    assert not reloads.pending()
+    path.unlink()
+    assert reloads.pending()
@@ -0,0 +1,104 @@
+from types import SimpleNamespace
+from octopus_usage_exporter.scheduler import meter_scheduler
+from octopus_usage_exporter.tests.conftest import FakeClock
+
+
+def make_meter(device_id, polling_interval=60):
+    return SimpleNamespace(device_id=device_id, polling_interval=polling_interval)
+
+
+def test_pop_due_returns_only_due_meters_in_deadline_order():
+    clock = FakeClock(1000.0)
+    scheduler = meter_scheduler(clock=clock)
+    late, early, future = make_meter("late"), make_meter("early"), make_meter("future")
+    scheduler.schedule(late, 990.0)
+    scheduler.schedule(early, 980.0)
+    scheduler.schedule(future, 1100.0)
+
+    due = scheduler.pop_due(timeout=0)
+    assert [meter for meter, _ in due] == [early, late]
+    assert len(scheduler) == 1
+    assert scheduler.next_due() == 1100.0
+
+
+def test_pop_due_times_out_when_nothing_is_due():
+    clock = FakeClock(1000.0)
+    scheduler = meter_scheduler(clock=clock)
+    scheduler.schedule(make_meter("future"), 2000.0)
+    assert scheduler.pop_due(timeout=0) == []
+
+
+def test_reschedule_follows_nominal_timeline_without_drift():
+    clock = FakeClock(1000.0)
+    scheduler = meter_scheduler(clock=clock)
+    meter = make_meter("m", polling_interval=60)
+    clock.now = 1015.0  # the poll took 15 seconds to complete
+    assert scheduler.reschedule(meter, 1000.0) == 1060.0
+
+
+def test_reschedule_skips_missed_slots():
+    clock = FakeClock(1000.0)
+    scheduler = meter_scheduler(clock=clock)
+    meter = make_meter("m", polling_interval=60)
+    clock.now = 1150.0
+    assert scheduler.reschedule(meter, 1000.0) == 1180.0
+
+
+def test_jitter_is_bounded_by_fraction_of_interval():
+    clock = FakeClock(1000.0)
+    scheduler = meter_scheduler(jitter=0.1, clock=clock)
+    meter = make_meter("m", polling_interval=100)
+    for _ in range(50):
+        due = scheduler.schedule(meter, 1000.0)
+        assert 1000.0 <= due <= 1010.0
+
+
+def test_meters_on_same_account_share_jitter_phase():
+    clock = FakeClock(1000.0)
+    scheduler = meter_scheduler(jitter=0.5, clock=clock)
+    electric = SimpleNamespace(device_id="e", polling_interval=60, account_number="A-1")
+    gas = SimpleNamespace(device_id="g", polling_interval=60, account_number="A-1")
+    assert scheduler.schedule(electric, 1000.0) == scheduler.schedule(gas, 1000.0)
+
+
+def test_pop_due_coalesces_meters_due_within_window():
+    clock = FakeClock(1000.0)
+    scheduler = meter_scheduler(clock=clock, coalesce=1.0)
+    now, soon = make_meter("now"), make_meter("soon")
+    scheduler.schedule(now, 1000.0)
+    scheduler.schedule(soon, 1000.5)
+    assert [meter for meter, _ in scheduler.pop_due(timeout=0)] == [now, soon]
+
+
+def test_removed_meter_is_dropped_and_never_rescheduled():
+    clock = FakeClock(1000.0)
+    scheduler = meter_scheduler(clock=clock)
+    kept, removed, polling = make_meter("kept"), make_meter("removed"), make_meter("polling")
+    scheduler.schedule(kept, 990.0)
+    scheduler.schedule(removed, 980.0)
+    scheduler.remove(removed)
+    assert [meter for meter, _ in scheduler.pop_due(timeout=0)] == [kept]
+    assert len(scheduler) == 0
+
+    # A meter removed while its poll is in flight is not rescheduled when the poll finishes, and is then forgotten
+    scheduler.schedule(polling, 990.0)
+    assert [meter for meter, _ in scheduler.pop_due(timeout=0)] == [polling]
+    scheduler.remove(polling)
+    assert scheduler.reschedule(polling, 990.0) is None
+    assert len(scheduler) == 0
+    assert scheduler._removed == {} and scheduler._in_flight == {id(kept): kept}
+
+
+def test_replan_moves_a_waiting_meter_but_leaves_one_in_flight():
+    clock = FakeClock(1000.0)
+    scheduler = meter_scheduler(clock=clock)
+    waiting, polling = make_meter("waiting"), make_meter("polling")
+    scheduler.schedule(waiting, 2800.0)
+    scheduler.schedule(polling, 990.0)
+    assert [meter for meter, _ in scheduler.pop_due(timeout=0)] == [polling]
+
+    assert scheduler.replan(waiting, 30) == 1030.0
+    assert scheduler.replan(polling, 30) is None
+    assert len(scheduler) == 1 and scheduler.next_due() == 1030.0
+    # The in flight poll plans its next one itself
+    assert scheduler.reschedule(polling, 990.0) == 1050.0
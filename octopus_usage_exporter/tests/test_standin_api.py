@@ -0,0 +1,69 @@
+from types import SimpleNamespace
+from unittest.mock import patch
+import pytest
+import requests
+from octopus_usage_exporter import octopus_usage_exporter as exporter_module
+from octopus_usage_exporter.benchmarks.standin_api import start, fault_profile, account_number, device_id, GRAPHQL_PATH, JWKS_PATH
+# The connection checks its key cache against the jwks_cache class it imported itself
+from octopus_usage_exporter.octopus_api_connection import octopus_api_connection, jwks_cache
+from octopus_usage_exporter.tariff_cache import tariff_cache
+
+CONFIG = SimpleNamespace(interval=60, tariff_remaining=True, tariff_rates=True)
+
+
+@pytest.fixture
+def standin():
+    servers = []
+
+    def standin(**kwargs):
+        server = start(accounts=10, seed=1, **kwargs)
+        servers.append(server)
+        return server
+    yield standin
+    for server in servers:
+        server.shutdown()
+        server.server_close()
+
+
+def post(server, query, headers=None):
+    return requests.post(server.url + GRAPHQL_PATH, json={"query": query}, headers=headers or {}, timeout=5)
+
+
+def test_real_connection_discovers_and_reads_meters(standin):
+    server = standin()
+    connection = octopus_api_connection(api_key="sk_test", api_url=server.url + GRAPHQL_PATH,
+                                        jwks=jwks_cache(url=server.url + JWKS_PATH))
+    # The token was issued by the stand-in and verified against its key set
+    assert not connection.jwt_needs_refresh()
+
+    account = exporter_module.fetch_account(CONFIG, connection, account_number(3))["account"]
+    meters = exporter_module.select_meters(CONFIG, account, True, True, account_number(3))
+    assert [(meter.meter_type, meter.device_id) for meter in meters] == [("electric", device_id(3, "electric")), ("gas", device_id(3, "gas"))]
+
+    with patch.object(exporter_module, "tariffs", tariff_cache()):
+        readings = dict((meter.meter_type, values) for meter, values in exporter_module.get_energy_readings(connection, meters))
+    assert readings["electric"]["demand"] > 0
+    assert readings["electric"]["tariff_unit_rate"] > 0
+    assert readings["gas"]["tariff_standing_charge"] == 31.381455
+
+    stats = server.stats()
+    assert (stats["requests"], stats["succeeded"], stats["field:obtainKrakenToken"], stats["jwks"]) == (3, 3, 1, 1)
+
+
+def test_injected_faults(standin):
+    rate_limited = post(standin(faults=fault_profile(rate_limit_rate=1.0)), "{ account(accountNumber: \"A-00000001\") { id } }")
+    assert rate_limited.json()["errors"][0]["extensions"]["errorCode"] == "KT-CT-1199"
+
+    server = standin(faults=fault_profile(rate_limit_rate=1.0, rate_limit_status=429))
+    assert post(server, "{ account(accountNumber: \"A-00000001\") { id } }").status_code == 429
+    assert server.stats()["rate_limited"] == 1
+
+    assert post(standin(faults=fault_profile(server_error_rate=1.0)), "{ account(accountNumber: \"A-00000001\") { id } }").status_code in (500, 502, 503)
+
+
+def test_unknown_or_expired_tokens_are_rejected(standin):
+    server = standin(token_ttl=-1)
+    token = post(server, "mutation { obtainKrakenToken(input: { APIKey: \"sk_test\" }) { token } }").json()["data"]["obtainKrakenToken"]["token"]
+    for authorization in ("JWT " + token, "JWT unknown", None):
+        response = post(server, "{ smartMeterTelemetry(deviceId: \"E0-00\") { readAt } }", {"Authorization": authorization} if authorization else None)
+        assert response.json()["errors"][0]["extensions"]["errorCode"] == "KT-CT-1124"
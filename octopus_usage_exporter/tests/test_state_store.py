@@ -0,0 +1,63 @@
+import os
+import stat
+from datetime import datetime
+from types import SimpleNamespace
+from octopus_usage_exporter.state_store import state_store
+
+
+def meter(device_id, meter_type="electric", agreement=1, last_called=None):
+    return SimpleNamespace(device_id=device_id, meter_type=meter_type, agreement=agreement, tariff_name="Agile", last_called=last_called)
+
+
+def test_account_responses_replaced_and_expire(tmp_path):
+    store = state_store(str(tmp_path / "state.db"))
+    store.save_account("A-1", {"account": {"gasAgreements": []}}, 1000.0)
+    store.save_account("A-2", {"account": {"electricityAgreements": []}}, 1000.0)
+    store.save_account("A-1", {"account": {"gasAgreements": [{"id": 1}]}}, 2000.0)
+    assert store.load_account("A-1", 1500.0) == {"account": {"gasAgreements": [{"id": 1}]}}
+    assert store.load_account("A-2", 1500.0) is None
+    assert store.load_account("A-3", 0.0) is None
+
+
+def test_tariffs_survive_reopen_until_expiry(tmp_path):
+    path = str(tmp_path / "state.db")
+    store = state_store(path)
+    store.save_tariff(("ElectricityAgreement", 1), {"validTo": None}, 2000.0)
+    store.save_tariff(("GasAgreement", 2), {"validTo": None}, 1000.0)
+    store.close()
+
+    reopened = state_store(path)
+    assert reopened.load_tariffs(1500.0) == [(("ElectricityAgreement", 1), {"validTo": None}, 2000.0)]
+
+
+def test_tokens_keyed_by_hashed_api_key(tmp_path):
+    path = tmp_path / "state.db"
+    store = state_store(str(path))
+    store.save_token("sk_live_secret", "token", 2000.0)
+    assert store.load_token("sk_live_secret", 1500.0) == ("token", 2000.0)
+    assert store.load_token("sk_live_secret", 2500.0) is None
+    assert store.load_token("other", 1500.0) is None
+    store.close()
+    assert b"sk_live_secret" not in path.read_bytes()
+
+
+def test_last_poll_round_trip(tmp_path):
+    store = state_store(str(tmp_path / "state.db"))
+    called = datetime(2026, 1, 1, 12)
+    assert store.load_poll(meter("E1")) is None
+    store.record_polls([(meter("E1", last_called=called), {"consumption": 12.5, "demand": 300})])
+    assert store.load_poll(meter("E1")) == (called.timestamp(), {"consumption": 12.5, "demand": 300})
+    assert store.load_poll(meter("E1", "gas")) is None
+
+
+def test_database_and_wal_files_are_owner_only(tmp_path):
+    path = str(tmp_path / "state.db")
+    previous_umask = os.umask(0o022)
+    try:
+        store = state_store(path)
+        store.save_token("sk_live_secret", "token", 2000.0)
+    finally:
+        os.umask(previous_umask)
+    for name in (path, path + "-wal", path + "-shm"):
+        assert stat.S_IMODE(os.stat(name).st_mode) == 0o600
+    store.close()
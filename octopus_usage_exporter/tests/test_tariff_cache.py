@@ -0,0 +1,50 @@
+from datetime import datetime, timedelta, timezone
+from octopus_usage_exporter.tariff_cache import tariff_cache, agreement_expiry, build_rate_index
+from octopus_usage_exporter.tests.conftest import FakeClock
+
+
+NOW = datetime(2026, 1, 1, 12, tzinfo=timezone.utc)
+
+
+def iso(offset):
+    return (NOW + offset).isoformat()
+
+
+def test_entries_expire_after_ttl():
+    clock = FakeClock(NOW.timestamp())
+    cache = tariff_cache(ttl=600, clock=clock)
+    cache.put("k", {"validTo": None, "tariff": {"unitRate": 1}})
+    assert cache.get("k") == {"validTo": None, "tariff": {"unitRate": 1}}
+    clock.now += 601
+    assert cache.get("k") is None
+    assert len(cache) == 0
+
+
+def test_expiry_capped_at_agreement_valid_to():
+    agreement = {"validTo": iso(timedelta(minutes=5)), "tariff": {}}
+    assert agreement_expiry(agreement, 3600, NOW.timestamp()) == NOW.timestamp() + 300
+
+
+def test_expiry_capped_at_last_half_hourly_rate():
+    agreement = {"validTo": iso(timedelta(days=30)), "tariff": {"unitRates": [
+        {"validFrom": iso(timedelta(0)), "validTo": iso(timedelta(minutes=30)), "value": 1},
+        {"validFrom": iso(timedelta(minutes=30)), "validTo": iso(timedelta(minutes=60)), "value": 2},
+    ]}}
+    assert agreement_expiry(agreement, 86400, NOW.timestamp(), build_rate_index(agreement)) == NOW.timestamp() + 3600
+
+
+def test_put_indexes_half_hourly_rates():
+    clock = FakeClock(NOW.timestamp())
+    cache = tariff_cache(ttl=600, clock=clock)
+    cache.put("k", {"validTo": None, "tariff": {"unitRates": [
+        {"validFrom": iso(timedelta(0)), "validTo": iso(timedelta(minutes=30)), "value": 12.5}]}})
+    assert cache.rate_index("k").rate_at(NOW.timestamp() + 60) == 12.5
+    cache.put("standard", {"validTo": None, "tariff": {"unitRate": 20}})
+    assert cache.rate_index("standard") is None
+
+
+def test_invalidate_drops_entry():
+    cache = tariff_cache(ttl=600)
+    cache.put("k", {"validTo": None})
+    cache.invalidate("k")
+    assert cache.get("k") is None
@@ -0,0 +1,76 @@
+import threading
+import time
+from unittest.mock import MagicMock, patch
+from octopus_usage_exporter.token_manager import token_manager
+from octopus_usage_exporter.tests.conftest import FakeClock
+
+
+def expiry_in_token(token):
+    # Tokens in these tests are "name:expiry"
+    return float(token.split(":")[1])
+
+
+def make_manager(headers, fetch, clock):
+    return token_manager(headers, fetch, expiry_in_token, refresh_ahead=300, margin=120, clock=clock)
+
+
+@patch.object(token_manager, 'schedule_refresh')
+def test_expiry_verified_once_per_token(schedule):
+    verify = MagicMock(side_effect=expiry_in_token)
+    manager = token_manager({"Authorization": "JWT a:2000"}, MagicMock(), verify, clock=FakeClock(1000))
+    for _ in range(5):
+        assert not manager.needs_refresh()
+    assert verify.call_count == 1
+    schedule.assert_called_once_with(2000.0)
+
+
+@patch.object(token_manager, 'schedule_refresh')
+def test_concurrent_refreshes_share_one_request(schedule):
+    clock = FakeClock(1000)
+    headers = {"Authorization": "JWT old:1050"}
+    seen = []
+    started = threading.Event()
+
+    def fetch():
+        started.set()
+        seen.append(headers.get("Authorization"))
+        time.sleep(0.05)
+        return "new:5000"
+
+    manager = make_manager(headers, fetch, clock)
+    threads = [threading.Thread(target=manager.ensure) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    # One login, and callers waiting on it never saw the header missing
+    assert seen == ["JWT old:1050"]
+    assert headers["Authorization"] == "JWT new:5000"
+
+
+@patch.object(token_manager, 'schedule_refresh')
+def test_background_refresh_skipped_when_token_already_replaced(schedule):
+    headers = {"Authorization": "JWT b:5000"}
+    fetch = MagicMock(return_value="c:9000")
+    manager = make_manager(headers, fetch, FakeClock(1000))
+    manager.background_refresh("a:2000")
+    fetch.assert_not_called()
+    manager.background_refresh("b:5000")
+    fetch.assert_called_once()
+    assert headers["Authorization"] == "JWT c:9000"
+
+
+def test_refresh_timer_fires_ahead_of_expiry():
+    clock = FakeClock(1000)
+    headers = {"Authorization": "JWT a:1300"}
+    refreshed = threading.Event()
+
+    def fetch():
+        refreshed.set()
+        return "b:9000"
+
+    manager = make_manager(headers, fetch, clock)
+    manager.on_refresh = lambda token: None
+    assert not manager.needs_refresh()
+    assert refreshed.wait(2)
+    manager.cancel()
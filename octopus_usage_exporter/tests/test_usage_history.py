@@ -0,0 +1,108 @@
+import pytest
+from octopus_usage_exporter.electric_meter import electric_meter
+from octopus_usage_exporter.usage_history import usage_ring, usage_tracker, telemetry_increment
+from octopus_usage_exporter.tests.conftest import sample
+
+
+def reading(read_at, consumption, delta, cost):
+    return {"read_at": read_at, "consumption": consumption, "consumption_delta": delta, "cost_delta": cost}
+
+
+def test_ring_overwrites_oldest_and_finds_entries_across_the_wrap():
+    ring = usage_ring(4)
+    for t in range(1, 7):
+        ring.append(t * 10, t, t * 2)
+    assert len(ring) == 4
+    assert ring.latest() == (60, 6, 12)
+    assert ring.at_or_before(25) is None
+    assert ring.at_or_before(30) == 0
+    assert ring.at_or_before(45) == 1
+    assert ring.at_or_before(55) == 2
+    assert ring.at_or_before(100) == 3
+    # Half of the increment from 40 to 50 falls after 45
+    assert ring.since(45) == (1.5, 3)
+    assert ring.since(40) == (2, 4)
+    # Older than anything held, so the window is limited to the history kept
+    assert ring.since(0) == (3, 6)
+
+
+def test_ring_before_wrapping_counts_from_zero():
+    ring = usage_ring(8)
+    assert ring.since(0) == (0.0, 0.0)
+    ring.append(100, 1.5, 3)
+    ring.append(200, 2.5, 5)
+    assert ring.since(50) == (2.5, 5)
+    assert ring.since(150) == (0.5, 1)
+    assert ring.since(100) == (1.0, 2)
+
+
+def test_ring_grows_as_readings_arrive_and_resizes_keeping_the_newest():
+    ring = usage_ring(4)
+    assert len(ring.timestamps) == 0
+    for t in range(1, 4):
+        ring.append(t * 10, t, t * 2)
+    assert len(ring.timestamps) == 3
+    for t in range(4, 7):
+        ring.append(t * 10, t, t * 2)
+    assert len(ring.timestamps) == 4
+
+    ring.resize(2)
+    assert (len(ring), ring.latest(), ring.since(0)) == (2, (60, 6, 12), (1, 2))
+    ring.resize(3)
+    ring.append(70, 7, 14)
+    assert (len(ring), ring.at_or_before(55), ring.since(55)) == (3, 0, (1.5, 3))
+
+
+def test_ring_only_spans_the_longest_window_at_the_polling_interval():
+    tracker = usage_tracker(size=2880)
+    meter = electric_meter(device_id="usage-4", meter_type="electric", polling_interval=1800)
+    assert tracker.history(meter).ring.size == 62
+    meter.polling_interval = 30
+    assert tracker.history(meter).ring.size == 2880
+
+
+def test_increment_fills_the_gap_between_polls_from_the_register():
+    assert telemetry_increment(None, reading(0, 100.0, 0.25, 6.0)) == (0.25, 6.0)
+    # Adjacent telemetry, the delta already covers it
+    assert telemetry_increment(99.75, reading(0, 100.0, 0.25, 6.0)) == (0.25, 6.0)
+    assert telemetry_increment(99.0, reading(0, 100.0, 0.25, 6.0)) == (1.0, 24.0)
+    # A register reset falls back to the delta
+    assert telemetry_increment(500.0, reading(0, 100.0, 0.25, 6.0)) == (0.25, 6.0)
+
+
+def test_tracker_accumulates_counters_once_per_reading_and_exports_windows():
+    meter = electric_meter(device_id="usage-1", meter_type="electric")
+    tracker = usage_tracker(size=16)
+    assert tracker.update(meter, reading(1_000.0, 10.0, 0.5, 12.0))
+    assert not tracker.update(meter, reading(1_000.0, 10.0, 0.5, 12.0))
+    assert tracker.update(meter, reading(1_200.0, 10.25, 0.25, 6.0))
+    assert tracker.update(meter, reading(1_600.0, 10.5, 0.25, 7.0))
+
+    assert sample("oe_meter_energy_total", meter) == 1.0
+    assert sample("oe_meter_cost_total", meter) == 25.0
+    # 5 minutes of the 400 seconds since the previous reading
+    assert sample("oe_meter_cost_window", meter, window="5m") == 5.25
+    assert sample("oe_meter_cost_window", meter, window="1h") == 25.0
+    assert sample("oe_meter_energy_window", meter, window="5m") == 0.1875
+
+    tracker.remove(meter)
+    assert sample("oe_meter_cost_total", meter) is None
+    assert sample("oe_meter_cost_window", meter, window="24h") is None
+
+
+def test_windows_shorter_than_the_polling_interval_are_pro_rated():
+    meter = electric_meter(device_id="usage-3", meter_type="electric")
+    tracker = usage_tracker(size=16)
+    tracker.update(meter, reading(0.0, 10.0, 0.5, 12.0))
+    tracker.update(meter, reading(1_800.0, 11.2, 1.2, 30.0))
+    assert sample("oe_meter_energy_window", meter, window="5m") == pytest.approx(0.2)
+    assert sample("oe_meter_cost_window", meter, window="5m") == pytest.approx(5.0)
+    assert sample("oe_meter_cost_window", meter, window="1h") == 42.0
+
+
+def test_tracker_ignores_readings_without_deltas():
+    meter = electric_meter(device_id="usage-2", meter_type="electric")
+    tracker = usage_tracker(size=4)
+    assert not tracker.update(meter, {"read_at": 1.0, "consumption": 5.0})
+    assert not tracker.update(meter, {"tariff_unit_rate": 24.5})
+    assert sample("oe_meter_energy_total", meter) is None
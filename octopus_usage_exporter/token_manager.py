@@ -0,0 +1,102 @@
+import logging
+import threading
+import time
+
+
+class unverified_expiry(float):
+    """Expiry read from a token whose signature could not be checked yet, to be verified again at recheck_at."""
+
+    def __new__(cls, expiry, recheck_at):
+        value = super().__new__(cls, expiry)
+        value.recheck_at = recheck_at
+        return value
+
+
+class token_manager:
+    """Keeps the Authorization header of one connection current. The token is refreshed on a background timer ahead
+    of expiry, concurrent refreshes from any thread share a single request, and the header is replaced in a single
+    assignment so no request is ever sent without a token."""
+
+    def __init__(self, headers, fetch, verify, refresh_ahead=300, margin=120, on_refresh=None, clock=time.time):
+        self.headers = headers
+        self.fetch = fetch
+        self.verify = verify
+        self.refresh_ahead = refresh_ahead
+        self.margin = margin
+        self.on_refresh = on_refresh
+        self.clock = clock
+        self._lock = threading.Lock()
+        self._verified = (None, None, None)
+        self._timer = None
+
+    def token(self):
+        authorization = self.headers.get("Authorization")
+        return authorization.split(" ")[1] if authorization else None
+
+    def expiry(self):
+        """Expiry of the current token in epoch seconds, verifying it the first time it is seen. None if unusable."""
+        token = self.token()
+        if token is None:
+            return None
+        verified_token, expiry, recheck_at = self._verified
+        if verified_token != token or (recheck_at is not None and self.clock() >= recheck_at):
+            expiry = self.verify(token)
+            if expiry is None:
+                return None
+            self._verified = (token, expiry, getattr(expiry, "recheck_at", None))
+            if verified_token != token and expiry > self.clock() + self.margin:
+                self.schedule_refresh(expiry)
+        return expiry
+
+    def needs_refresh(self):
+        expiry = self.expiry()
+        if expiry is None:
+            logging.info("No valid JWT found, fetching new one")
+            return True
+        return expiry <= self.clock() + self.margin
+
+    def ensure(self):
+        if not self.needs_refresh():
+            return
+        with self._lock:
+            # Whoever held the lock before may already have replaced the token
+            if self.needs_refresh():
+                self._refresh()
+
+    def refresh(self):
+        with self._lock:
+            self._refresh()
+
+    def refresh_if_current(self, token):
+        """Refresh unless another caller has already replaced token."""
+        with self._lock:
+            if self.token() in (None, token):
+                self._refresh()
+
+    def set_token(self, token):
+        self.headers["Authorization"] = "JWT {}".format(token)
+
+    def _refresh(self):
+        token = self.fetch()
+        self.set_token(token)
+        if self.on_refresh is not None:
+            self.on_refresh(token)
+        logging.info("JWT refresh success")
+
+    def schedule_refresh(self, expiry):
+        if self._timer is not None:
+            self._timer.cancel()
+        self._timer = threading.Timer(max(0, expiry - self.refresh_ahead - self.clock()), self.background_refresh, (self.token(),))
+        self._timer.daemon = True
+        self._timer.start()
+
+    def background_refresh(self, token):
+        try:
+            self.refresh_if_current(token)
+            self.expiry()
+        except Exception as e:
+            logging.error("Background JWT refresh failed, will retry before the next request: {}".format(e))
+
+    def cancel(self):
+        if self._timer is not None:
+            self._timer.cancel()
@@ -0,0 +1,196 @@
+import threading
+from array import array
+from bisect import bisect_right
+from metrics import meter_energy_total, meter_cost_total, meter_energy_window, meter_cost_window
+from reading_collector import READ_AT
+
+# Keys in a meter's readings holding the telemetry's consumptionDelta and costDelta
+CONSUMPTION_DELTA = "consumption_delta"
+COST_DELTA = "cost_delta"
+
+# Trailing windows summed from each meter's history, as (label, seconds)
+WINDOWS = (("5m", 300), ("1h", 3600), ("24h", 86400))
+
+
+def telemetry_increment(previous_consumption, readings):
+    """(energy, cost) used since the previous poll. consumptionDelta only covers the meter's last telemetry interval,
+    so when polls are further apart the gap is taken from the cumulative consumption register and costed at the
+    price implied by the latest delta."""
+    energy = float(readings.get(CONSUMPTION_DELTA) or 0)
+    cost = float(readings.get(COST_DELTA) or 0)
+    consumption = readings.get("consumption")
+    if previous_consumption is None or consumption is None:
+        return energy, cost
+    used = float(consumption) - previous_consumption
+    if used <= energy:
+        # Register reset or no gap between polls
+        return energy, cost
+    return used, cost * used / energy if energy > 0 else cost
+
+
+class usage_ring:
+    """Bounded history of (timestamp, cumulative energy, cumulative cost) for one meter in parallel arrays, which grow
+    as readings arrive and then overwrite the oldest entry once full. Timestamps only grow, so the ring is searched by
+    bisection."""
+
+    def __init__(self, size):
+        self.size = size
+        self.timestamps = array("d")
+        self.energy = array("d")
+        self.cost = array("d")
+        self.head = 0
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    def _slot(self, position):
+        # Position 0 is the oldest entry held
+        return (self.head - self.count + position) % self.size
+
+    def append(self, timestamp, energy, cost):
+        if len(self.timestamps) < self.size:
+            self.timestamps.append(timestamp)
+            self.energy.append(energy)
+            self.cost.append(cost)
+        else:
+            self.timestamps[self.head] = timestamp
+            self.energy[self.head] = energy
+            self.cost[self.head] = cost
+        self.head = (self.head + 1) % self.size
+        self.count = min(self.count + 1, self.size)
+
+    def resize(self, size):
+        """Keeps the newest entries that fit in size, oldest first."""
+        slots = [self._slot(position) for position in range(self.count)][-size:]
+        self.timestamps = array("d", (self.timestamps[slot] for slot in slots))
+        self.energy = array("d", (self.energy[slot] for slot in slots))
+        self.cost = array("d", (self.cost[slot] for slot in slots))
+        self.size = size
+        self.count = len(slots)
+        self.head = self.count % size
+
+    def latest(self):
+        slot = self._slot(self.count - 1)
+        return self.timestamps[slot], self.energy[slot], self.cost[slot]
+
+    def at_or_before(self, timestamp):
+        """Position of the newest entry no later than timestamp, or None if every entry is later."""
+        oldest = self._slot(0)
+        if self.count == 0 or self.timestamps[oldest] > timestamp:
+            return None
+        # Bisect whichever contiguous run of the arrays the timestamp falls in
+        if oldest + self.count <= self.size or timestamp < self.timestamps[0]:
+            position = bisect_right(self.timestamps, timestamp, oldest, min(oldest + self.count, self.size)) - oldest
+        else:
+            position = self.size - oldest + bisect_right(self.timestamps, timestamp, 0, self.head)
+        return position - 1
+
+    def since(self, timestamp):
+        """(energy, cost) accumulated after timestamp, from the oldest entry held if the history is shorter. An
+        increment spanning timestamp is pro-rated, so a window shorter than the polling interval only takes its
+        share of each poll rather than the whole of the latest one."""
+        if self.count == 0:
+            return 0.0, 0.0
+        _, energy, cost = self.latest()
+        position = self.at_or_before(timestamp)
+        if position is None:
+            if self.count < self.size:
+                # Nothing has been overwritten yet, so the totals started from zero within the window
+                return energy, cost
+            position = 0
+        slot = self._slot(position)
+        start_energy, start_cost = self.energy[slot], self.cost[slot]
+        if position + 1 < self.count and timestamp > self.timestamps[slot]:
+            following = self._slot(position + 1)
+            share = (timestamp - self.timestamps[slot]) / (self.timestamps[following] - self.timestamps[slot])
+            start_energy += (self.energy[following] - start_energy) * share
+            start_cost += (self.cost[following] - start_cost) * share
+        return energy - start_energy, cost - start_cost
+
+
+class meter_usage:
+    __slots__ = ("ring", "read_at", "consumption", "energy", "cost")
+
+    def __init__(self, size):
+        self.ring = usage_ring(size)
+        self.read_at = None
+        self.consumption = None
+        self.energy = 0.0
+        self.cost = 0.0
+
+
+class usage_tracker:
+    """Accumulates each meter's consumptionDelta and costDelta into the oe_meter_energy and oe_meter_cost counters,
+    and keeps a history of the running totals to export trailing window sums without PromQL range queries."""
+
+    def __init__(self, size=2880, windows=WINDOWS):
+        self.size = size
+        self.windows = windows
+        self._meters = {}
+        self._lock = threading.Lock()
+
+    def ring_size(self, meter):
+        """Entries needed to reach back over the longest window at the meter's polling interval, at most size. A
+        quarter more is kept for polls that come early."""
+        if not meter.polling_interval:
+            return self.size
+        longest = max(seconds for _, seconds in self.windows)
+        return min(self.size, longest * 5 // (4 * meter.polling_interval) + 2)
+
+    def history(self, meter):
+        key = (meter.device_id, meter.meter_type)
+        size = self.ring_size(meter)
+        with self._lock:
+            usage = self._meters.get(key)
+            if usage is None:
+                usage = self._meters[key] = meter_usage(size)
+        if usage.ring.size != size:
+            # The polling interval was reloaded
+            usage.ring.resize(size)
+        return usage
+
+    def update(self, meter, readings):
+        """Accounts for readings, returning False when their telemetry was already counted."""
+        read_at = readings.get(READ_AT)
+        if read_at is None or CONSUMPTION_DELTA not in readings:
+            return False
+        usage = self.history(meter)
+        if usage.read_at is not None and read_at <= usage.read_at:
+            return False
+
+        energy, cost = telemetry_increment(usage.consumption, readings)
+        labels = {"device_id": meter.device_id, "meter_type": meter.meter_type}
+        if energy > 0:
+            usage.energy += energy
+            meter_energy_total.labels(**labels).inc(energy)
+        if cost > 0:
+            usage.cost += cost
+            meter_cost_total.labels(**labels).inc(cost)
+        usage.read_at = read_at
+        if readings.get("consumption") is not None:
+            usage.consumption = float(readings["consumption"])
+        usage.ring.append(read_at, usage.energy, usage.cost)
+
+        for window, seconds in self.windows:
+            window_energy, window_cost = usage.ring.since(read_at - seconds)
+            meter_energy_window.labels(window=window, **labels).set(window_energy)
+            meter_cost_window.labels(window=window, **labels).set(window_cost)
+        return True
+
+    def remove(self, meter):
+        with self._lock:
+            usage = self._meters.pop((meter.device_id, meter.meter_type), None)
+        if usage is None:
+            return
+        for metric in (meter_energy_total, meter_cost_total):
+            try:
+                metric.remove(meter.device_id, meter.meter_type)
+            except KeyError:
+                pass
+        for window, _ in self.windows:
+            for gauge in (meter_energy_window, meter_cost_window):
+                try:
+                    gauge.remove(meter.device_id, meter.meter_type, window)
+                except KeyError:
+                    pass